@@ -38,6 +38,8 @@ class Record(Enum):
             Record.psend,
             Record.size,
             Record.time,
+            Record.time_ini,
+            Record.time_fi,
         )
 
     @staticmethod
@@ -60,6 +62,11 @@ class Record(Enum):
     def can_group(self):
         return self in Record._group_attributes()
 
+    @property
+    def dtype(self):
+        """ Storage dtype of the attribute. Values that don't fit in it are stored in a wider dtype """
+        return _RECORD_DTYPES[self]
+
 
 class StateRecord(Enum):
     cpu_id = Record.cpu_id
@@ -74,6 +81,14 @@ class StateRecord(Enum):
     def all_attributes():
         return [attr.name for attr in StateRecord]
 
+    @property
+    def dtype(self):
+        return self.value.dtype
+
+    @staticmethod
+    def dtypes():
+        return {attr.name: attr.dtype for attr in StateRecord}
+
 
 class EventRecord(Enum):
     cpu_id = Record.cpu_id
@@ -88,6 +103,14 @@ class EventRecord(Enum):
     def all_attributes():
         return [attr.name for attr in EventRecord]
 
+    @property
+    def dtype(self):
+        return self.value.dtype
+
+    @staticmethod
+    def dtypes():
+        return {attr.name: attr.dtype for attr in EventRecord}
+
 
 class CommRecord(Enum):
     cpu_send_id = Record.cpu_send_id
@@ -108,3 +131,75 @@ class CommRecord(Enum):
     @staticmethod
     def all_attributes():
         return [attr.name for attr in CommRecord]
+
+    @property
+    def dtype(self):
+        return self.value.dtype
+
+    @staticmethod
+    def dtypes():
+        return {attr.name: attr.dtype for attr in CommRecord}
+
+
+_RECORD_DTYPES = {
+    Record.cpu_id: "int32",
+    Record.appl_id: "uint8",
+    Record.task_id: "int32",
+    Record.thread_id: "int16",
+    Record.time_ini: "int64",
+    Record.time_fi: "int64",
+    Record.state: "uint8",
+    Record.time: "int64",
+    Record.event_t: "int32",
+    Record.event_v: "int64",
+    Record.cpu_send_id: "int32",
+    Record.ptask_send_id: "uint8",
+    Record.task_send_id: "int32",
+    Record.thread_send_id: "int16",
+    Record.lsend: "int64",
+    Record.psend: "int64",
+    Record.cpu_recv_id: "int32",
+    Record.ptask_recv_id: "uint8",
+    Record.task_recv_id: "int32",
+    Record.thread_recv_id: "int16",
+    Record.lrecv: "int64",
+    Record.precv: "int64",
+    Record.size: "int32",
+    Record.tag: "int32",
+}
+
+# Default Paraver state names, as in the STATES section of the .pcf files
+STATE_NAMES = {
+    0: "Idle",
+    1: "Running",
+    2: "Not created",
+    3: "Waiting a message",
+    4: "Blocking Send",
+    5: "Synchronization",
+    6: "Test/Probe",
+    7: "Scheduling and Fork/Join",
+    8: "Wait/WaitAll",
+    9: "Blocked",
+    10: "Immediate Send",
+    11: "Immediate Receive",
+    12: "I/O",
+    13: "Group Communication",
+    14: "Tracing Disabled",
+    15: "Others",
+    16: "Send Receive",
+    17: "Memory transfer",
+    18: "Profiling",
+    19: "On-line analysis",
+    20: "Remote memory access",
+    21: "Atomic memory operation",
+    22: "Memory ordering operation",
+    23: "Distributed locking",
+    24: "Overhead",
+    25: "One-sided op",
+    26: "Startup latency",
+    27: "Waiting links",
+    28: "Data copy",
+    29: "RTT",
+    30: "Allocating memory",
+    31: "Freeing memory",
+}
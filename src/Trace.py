@@ -1,10 +1,12 @@
 import logging
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
-from typing import Dict, List
+from typing import Callable, Dict, List, Optional
 
 import dask.dataframe as dd
 
+from src.core.time_window import max_duration, state_window, window
+
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
@@ -22,6 +24,10 @@ class TraceMetaData:
     nodes: List[int] = None
     # len(Apps) = #Apps | len(Apps[0]) = #Tasks of APP 1 | App[0][0] = {"nThreads": int, "node": int}
     apps: List[List[Dict]] = None
+    # Storage layout of the records in the .hdf file (see persistence.writer.LAYOUT_VERSION)
+    layout_version: int = 0
+    # Records partitioned by thread, sorted by time only within each thread (see persistence.writer.PARTITION_THREADS)
+    partitioned: bool = False
 
 
 @dataclass
@@ -32,3 +38,74 @@ class Trace:
     df_state: dd.DataFrame = None
     df_event: dd.DataFrame = None
     df_comm: dd.DataFrame = None
+
+    # Duration of the longest state, computed the first time a time window is selected
+    _max_state_duration: int = field(default=None, init=False, repr=False)
+
+    @property
+    def is_sorted(self) -> bool:
+        """ Records sorted by time: States by time_ini, Events by time and Comm by lsend """
+        return self.metadata is not None and self.metadata.layout_version >= 1 and not self.metadata.partitioned
+
+    def time_window(self, start=None, end=None) -> "Trace":
+        """ Trace with the records in the time window [start, end): the states that overlap it, and the events and
+        communications (by logical send time) in it. On sorted traces the records are found with binary searches,
+        O(log N) per query
+        """
+        df_state, df_event, df_comm = self.df_state, self.df_event, self.df_comm
+        if df_state is not None:
+            if self.is_sorted and self._max_state_duration is None:
+                self._max_state_duration = max_duration(df_state)
+            df_state = state_window(df_state, start, end, self.is_sorted, self._max_state_duration)
+        if df_event is not None:
+            df_event = window(df_event, "time", start, end, self.is_sorted)
+        if df_comm is not None:
+            df_comm = window(df_comm, "lsend", start, end, self.is_sorted)
+        trace = Trace(self.metadata, df_state, df_event, df_comm)
+        trace._max_state_duration = self._max_state_duration
+        return trace
+
+
+# Record table of each DataFrame of a Trace
+TABLES = {"df_state": "States", "df_event": "Events", "df_comm": "Comm"}
+
+
+def _lazy_table(attribute: str) -> property:
+    def get(self):
+        if attribute not in self._frames:
+            logger.debug(f"Opening the {TABLES[attribute]} of {self.metadata.name}")
+            self._frames[attribute] = self.reader(TABLES[attribute])
+        return self._frames[attribute]
+
+    def set(self, df):
+        self._frames[attribute] = df
+
+    return property(get, set)
+
+
+class LazyTrace(Trace):
+    """ Trace whose DataFrames are opened the first time they are used. reader(key, columns=None, start=None,
+    stop=None) reads the rows [start, stop) of the columns given of the record table `key` (States, Events or Comm,
+    or Intervals, see HDF5Reader.parse_table)
+    """
+
+    df_state = _lazy_table("df_state")
+    df_event = _lazy_table("df_event")
+    df_comm = _lazy_table("df_comm")
+
+    def __init__(self, metadata: TraceMetaData, reader: Callable):
+        self.metadata = metadata
+        self.reader = reader
+        self._frames = dict()
+        self._max_state_duration = None
+
+    def __repr__(self):
+        return f"LazyTrace(metadata={self.metadata!r}, opened={[TABLES[a] for a in self._frames]})"
+
+    def opened(self, attribute: str) -> Optional[dd.DataFrame]:
+        """ The DataFrame `attribute` (e.g. "df_state") if it was already opened, without opening it """
+        return self._frames.get(attribute)
+
+    def read(self, key: str, columns: List[str] = None, start: int = None, stop: int = None) -> dd.DataFrame:
+        """ Reads only the rows [start, stop) of the `columns` of the record table `key`, without keeping them """
+        return self.reader(key, columns=columns, start=start, stop=stop)
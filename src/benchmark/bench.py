@@ -0,0 +1,292 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+import pandas as pd
+
+from src.CONST import Record
+from src.core.filter import Filter
+from src.core.group import Group
+from src.persistence import prv_to_hdf5
+from src.persistence.hdf5_reader import HDF5Reader
+from src.persistence.instrumentation import rss
+from src.persistence.prv_to_hdf5 import ParaverToHDF5
+from src.persistence.synthetic import EVENT_TYPES, generate_trace
+from src.persistence.writer import Writer
+
+logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+GB = 1024 * MB
+# Parser parameters benchmarked: the defaults, smaller chunks, and small steps and preallocations
+PARSER_MATRIX = (
+    {"STEPS": 200000, "MAX_READ_BYTES": GB * 2, "MIN_ELEM": 1000000},
+    {"STEPS": 200000, "MAX_READ_BYTES": MB * 64, "MIN_ELEM": 1000000},
+    {"STEPS": 1000, "MAX_READ_BYTES": MB * 16, "MIN_ELEM": 2000},
+)
+# Slowdown over the baseline flagged as a regression
+TOLERANCE = 0.1
+# Memory growth over the baseline flagged as a regression, once it's above MIN_RSS_GROWTH_MB
+MEMORY_TOLERANCE = 0.25
+MIN_RSS_GROWTH_MB = 64
+# Stages faster than it are not compared, their time is mostly noise
+MIN_SECONDS = 0.1
+# Interval between two samples of the resident memory, in seconds
+RSS_INTERVAL = 0.005
+
+
+class _PeakRSS:
+    """ Peak resident memory while the block runs, sampled every RSS_INTERVAL seconds by a thread. Memory of the
+    parser's worker processes is not included
+    """
+
+    def __enter__(self):
+        self.start = self.peak = rss()
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def _sample(self):
+        while not self._done.wait(RSS_INTERVAL):
+            self.peak = max(self.peak, rss())
+
+    def __exit__(self, *exc):
+        self._done.set()
+        self._thread.join()
+        self.peak = max(self.peak, rss())
+
+
+@contextmanager
+def parser_params(params: Dict[str, int]):
+    """ Sets the STEPS, MAX_READ_BYTES and MIN_ELEM of the parser while the block runs """
+    previous = {name: getattr(prv_to_hdf5, name) for name in params}
+    for name, value in params.items():
+        setattr(prv_to_hdf5, name, value)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            setattr(prv_to_hdf5, name, value)
+
+
+def _frame_bytes(*dfs) -> int:
+    return sum(int(df.memory_usage(index=True).sum()) for df in dfs)
+
+
+def measure(stage: str, params: Dict, function: Callable, nbytes: Callable, records: Callable) -> Dict:
+    """ Runs `function` and measures it. nbytes(result) and records(result) are the bytes and records it processed """
+    with _PeakRSS() as memory:
+        start = time.perf_counter()
+        result = function()
+        seconds = time.perf_counter() - start
+    processed, count = nbytes(result), records(result)
+    measurement = {
+        "stage": stage,
+        "params": params,
+        "seconds": seconds,
+        "bytes": processed,
+        "records": count,
+        "mb_per_s": processed / MB / seconds if seconds > 0 else None,
+        "records_per_s": count / seconds if seconds > 0 else None,
+        "peak_rss_mb": memory.peak / MB,
+        "rss_growth_mb": (memory.peak - memory.start) / MB,
+    }
+    logger.info(
+        f"{stage} {params}: {seconds:.3f} s, {measurement['mb_per_s'] or 0:.1f} MB/s, "
+        f"{measurement['records_per_s'] or 0:.0f} records/s, peak RSS {measurement['peak_rss_mb']:.0f} MB"
+    )
+    return {"result": result, "measurement": measurement}
+
+
+def run_benchmarks(trace: str, workdir: str, matrix=PARSER_MATRIX) -> List[Dict]:
+    """ Measures the parse, write, convert (streaming parse and write), read, filter and group stages on the
+    .prv file `trace`, for each parameters of the parser of `matrix`
+    """
+    results = []
+    trace_bytes = os.path.getsize(trace)
+    for params in matrix:
+        params = dict(params)
+        hdf_file = os.path.join(workdir, "bench.hdf")
+        with parser_params(params):
+            parse = measure(
+                "parse",
+                params,
+                lambda: ParaverToHDF5().parse_as_dataframe(trace, use_dask=False),
+                lambda dfs: trace_bytes,
+                lambda dfs: sum(len(df) for df in dfs),
+            )
+            results.append(parse["measurement"])
+            df_state, df_event, df_comm = parse.pop("result")
+            records = len(df_state) + len(df_event) + len(df_comm)
+            results.append(
+                measure(
+                    "write",
+                    params,
+                    lambda: Writer().dataframe_to_hdf5(hdf_file, df_state, df_event, df_comm),
+                    lambda _: _frame_bytes(df_state, df_event, df_comm),
+                    lambda _: records,
+                )["measurement"]
+            )
+            # Frees the records before the next stage
+            df_state = df_event = df_comm = None
+            os.remove(hdf_file)
+            results.append(
+                measure(
+                    "convert",
+                    params,
+                    lambda: Writer().records_to_hdf5(hdf_file, ParaverToHDF5().iter_records(trace)),
+                    lambda _: trace_bytes,
+                    lambda rows: sum(rows.values()),
+                )["measurement"]
+            )
+        read = measure(
+            "read",
+            params,
+            lambda: HDF5Reader().parse_records(hdf_file),
+            lambda _: os.path.getsize(hdf_file),
+            lambda dfs: sum(len(df) for df in dfs),
+        )
+        results.append(read["measurement"])
+        df_state, df_event, _ = read.pop("result")
+        end = int(df_event["time"].max()) if len(df_event) > 0 else 0
+        results.append(
+            measure(
+                "filter",
+                params,
+                lambda: Filter()
+                .add_operator(df_event, Record.event_t, "in", list(EVENT_TYPES[:2]))
+                .add_operator(df_event, Record.time, "from_to", end // 4, end // 2)
+                .execute(df_event),
+                lambda _: _frame_bytes(df_event),
+                lambda _: len(df_event),
+            )["measurement"]
+        )
+        results.append(
+            measure(
+                "group",
+                params,
+                lambda: Group().group_by(df_state, Record.thread_id)["time_fi"].sum(),
+                lambda _: _frame_bytes(df_state),
+                lambda _: len(df_state),
+            )["measurement"]
+        )
+        df_state = df_event = None
+        os.remove(hdf_file)
+    return results
+
+
+def _key(measurement: Dict) -> str:
+    return f"{measurement['stage']} {json.dumps(measurement['params'], sort_keys=True)}"
+
+
+def best_results(runs: List[List[Dict]]) -> List[Dict]:
+    """ Fastest measurement of each stage and parameters over several `runs` """
+    best = dict()
+    for results in runs:
+        for measurement in results:
+            key = _key(measurement)
+            if key not in best or measurement["seconds"] < best[key]["seconds"]:
+                best[key] = measurement
+    return list(best.values())
+
+
+def compare_results(results: List[Dict], baseline: List[Dict], tolerance: float = TOLERANCE) -> List[str]:
+    """ Regressions of `results` over `baseline`: stages whose throughput dropped more than `tolerance` or whose
+    memory grew more than MEMORY_TOLERANCE. Stages missing from the baseline are not compared
+    """
+    regressions = []
+    previous = {_key(measurement): measurement for measurement in baseline}
+    for measurement in results:
+        before = previous.get(_key(measurement))
+        if before is None:
+            continue
+        timed = min(measurement["seconds"], before["seconds"]) >= MIN_SECONDS
+        if timed and before["mb_per_s"] and measurement["mb_per_s"] < before["mb_per_s"] * (1 - tolerance):
+            regressions.append(
+                f"{_key(measurement)}: {measurement['mb_per_s']:.1f} MB/s, {before['mb_per_s']:.1f} MB/s before"
+            )
+        growth = measurement["rss_growth_mb"] - before["rss_growth_mb"]
+        if growth > MIN_RSS_GROWTH_MB and growth > before["rss_growth_mb"] * MEMORY_TOLERANCE:
+            regressions.append(
+                f"{_key(measurement)}: {measurement['rss_growth_mb']:.0f} MB of memory, "
+                f"{before['rss_growth_mb']:.0f} MB before"
+            )
+    return regressions
+
+
+def _environment() -> Dict:
+    return {
+        "date": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "pandas": pd.__version__,
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmarks the conversion and analysis of a synthetic trace.")
+    parser.add_argument("--size-mb", type=float, default=64, help="Size of the synthetic trace.")
+    parser.add_argument("--tasks", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=2, help="Threads per task.")
+    parser.add_argument("--mix", default="0.6,0.3,0.1", help="Fraction of State, Event and Comm lines.")
+    parser.add_argument("--events-per-line", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--trace", help="Benchmark this .prv file instead of a synthetic one.")
+    parser.add_argument("--output", help="JSON file where the results are written.")
+    parser.add_argument("--baseline", help="JSON file of a previous run, regressions over it fail the run.")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    parser.add_argument("--repeat", type=int, default=1, help="Runs, the fastest one of each stage is kept.")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        trace = args.trace
+        generator = None
+        if trace is None:
+            generator = {
+                "size": int(args.size_mb * MB),
+                "tasks": args.tasks,
+                "threads": args.threads,
+                "mix": [float(fraction) for fraction in args.mix.split(",")],
+                "events_per_line": args.events_per_line,
+                "seed": args.seed,
+            }
+            trace = os.path.join(workdir, "synthetic.prv")
+            generate_trace(trace, **generator)
+        report = {
+            "environment": _environment(),
+            "trace": {"file": args.trace, "bytes": os.path.getsize(trace), "generator": generator},
+            "results": best_results([run_benchmarks(trace, workdir) for _ in range(args.repeat)]),
+        }
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        logger.info(f"Results written to {args.output}")
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("trace") != report["trace"]:
+            logger.warning("The baseline was measured on another trace, the results may not be comparable")
+        regressions = compare_results(report["results"], baseline["results"], args.tolerance)
+        for regression in regressions:
+            logger.error(f"Regression: {regression}")
+        if len(regressions) > 0:
+            return 1
+        logger.info(f"No regressions over {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
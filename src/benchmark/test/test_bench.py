@@ -0,0 +1,57 @@
+import json
+import logging
+
+import pytest
+
+from src.benchmark.bench import best_results, compare_results, main
+
+logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+STAGES = ["parse", "write", "convert", "read", "filter", "group"]
+
+
+def measurement(stage, mb_per_s, rss_growth_mb=100, seconds=1.0):
+    return {
+        "stage": stage,
+        "params": {"STEPS": 1000},
+        "seconds": seconds,
+        "mb_per_s": mb_per_s,
+        "rss_growth_mb": rss_growth_mb,
+    }
+
+
+def test_bench_main(tmp_path):
+    output = str(tmp_path / "bench.json")
+    assert main(["--size-mb", "0.2", "--output", output]) == 0
+    with open(output) as f:
+        report = json.load(f)
+    assert report["trace"]["bytes"] >= 0.2 * 1024 * 1024
+    results = report["results"]
+    assert [m["stage"] for m in results] == STAGES * 3
+    for m in results:
+        assert m["seconds"] > 0 and m["mb_per_s"] > 0 and m["records_per_s"] > 0 and m["peak_rss_mb"] > 0
+    # Compared with itself
+    assert main(["--size-mb", "0.2", "--baseline", output, "--tolerance", "100"]) == 0
+
+
+@pytest.mark.parametrize(
+    "current, regressions",
+    [
+        (measurement("parse", 95), 0),
+        (measurement("parse", 80), 1),
+        (measurement("parse", 80, seconds=0.01), 0),
+        (measurement("parse", 100, rss_growth_mb=200), 1),
+        # Growths below MIN_RSS_GROWTH_MB are noise
+        (measurement("parse", 100, rss_growth_mb=150), 0),
+        (measurement("read", 10), 0),
+    ],
+)
+def test_compare_results(current, regressions):
+    baseline = [measurement("parse", 100)]
+    assert len(compare_results([current], baseline, tolerance=0.1)) == regressions
+
+
+def test_best_results():
+    runs = [[measurement("parse", 90, seconds=2)], [measurement("parse", 100, seconds=1)]]
+    assert best_results(runs) == [measurement("parse", 100, seconds=1)]
@@ -0,0 +1,156 @@
+import logging
+import os
+from dataclasses import dataclass
+from typing import Iterable
+
+import dask.dataframe as dd
+import numpy as np
+import pandas as pd
+
+from src.core.profile import split_thread_keys, thread_keys
+from src.core.time_window import window
+
+logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+GRANULARITIES = ("task", "thread")
+# Pairs of participants up to which the pair ids are accumulated with a dense bincount. Above it the pairs that
+# appear are numbered first (pd.factorize), so the memory doesn't grow with the square of the participants
+DENSE_PAIRS = int(os.environ.get("DENSE_PAIRS", 1 << 22))
+
+_COLUMNS = {
+    "send": ("ptask_send_id", "task_send_id", "thread_send_id"),
+    "recv": ("ptask_recv_id", "task_recv_id", "thread_recv_id"),
+}
+
+
+@dataclass
+class CommMatrix:
+    """ Point to point traffic between participants, (appl, task, thread) rows (thread 0 at task granularity).
+    Sparse (COO): the messages sent by participants[senders[i]] to participants[receivers[i]] are counts[i], of
+    bytes[i] bytes in total, and their latencies (lrecv - lsend) add up to latency[i] ns
+    """
+
+    participants: np.ndarray
+    senders: np.ndarray
+    receivers: np.ndarray
+    counts: np.ndarray
+    bytes: np.ndarray
+    latency: np.ndarray
+
+    def mean_latency(self) -> np.ndarray:
+        return np.divide(self.latency, self.counts, out=np.full(self.counts.shape, np.nan), where=self.counts > 0)
+
+    def dense(self, values: str = "counts") -> np.ndarray:
+        """ participants x participants matrix of `values`: counts, bytes, latency or mean_latency (NaN for the
+        pairs without messages)
+        """
+        data = self.mean_latency() if values == "mean_latency" else getattr(self, values)
+        fill = np.nan if values == "mean_latency" else 0
+        size = self.participants.shape[0]
+        matrix = np.full((size, size), fill, dtype=data.dtype)
+        matrix[self.senders, self.receivers] = data
+        return matrix
+
+    def to_frame(self) -> pd.DataFrame:
+        """ One row per pair of participants with messages """
+        send, recv = self.participants[self.senders], self.participants[self.receivers]
+        return pd.DataFrame(
+            {
+                "appl_send": send[:, 0],
+                "task_send": send[:, 1],
+                "thread_send": send[:, 2],
+                "appl_recv": recv[:, 0],
+                "task_recv": recv[:, 1],
+                "thread_recv": recv[:, 2],
+                "count": self.counts,
+                "bytes": self.bytes,
+                "mean_latency": self.mean_latency(),
+            }
+        )
+
+
+def _empty_matrix() -> CommMatrix:
+    empty = np.empty(0, dtype="int64")
+    return CommMatrix(np.empty((0, 3), dtype="int64"), empty, empty, empty, empty, empty)
+
+
+def _keys(df: pd.DataFrame, side: str, granularity: str) -> np.ndarray:
+    appl, task, thread = (df[column].to_numpy() for column in _COLUMNS[side])
+    if granularity == "task":
+        thread = np.zeros_like(thread)
+    return thread_keys(appl, task, thread)
+
+
+def _reduce(send_keys: np.ndarray, recv_keys: np.ndarray, counts, sizes, latencies) -> CommMatrix:
+    """ Adds up the `counts`, `sizes` and `latencies` (None for 1 per message) of each (sender, receiver) pair with a
+    bincount over the pair ids sender * participants + receiver. The participants are numbered by hashing
+    (pd.factorize), O(N)
+    """
+    if send_keys.size == 0:
+        return _empty_matrix()
+    codes, participants = pd.factorize(np.concatenate((send_keys, recv_keys)), sort=True)
+    size = participants.size
+    pairs = codes[: send_keys.size].astype("int64") * size + codes[send_keys.size:]
+    if size * size <= DENSE_PAIRS:
+        cells = size * size
+    else:
+        # Only the pairs that appear are accumulated
+        pairs, pair_ids = pd.factorize(pairs)
+        cells = pair_ids.size
+    # float64 weights add integers exactly while the total of a pair is below 2**53
+    sums = [np.bincount(pairs, weights=weights, minlength=cells) for weights in (counts, sizes, latencies)]
+    used = np.flatnonzero(sums[0])
+    pair_ids = used if size * size <= DENSE_PAIRS else pair_ids[used]
+    counts, sizes, latencies = (np.rint(values[used]).astype("int64") for values in sums)
+    return CommMatrix(
+        split_thread_keys(participants.astype("int64")), pair_ids // size, pair_ids % size, counts, sizes, latencies
+    )
+
+
+def _partition_matrix(df: pd.DataFrame, granularity: str) -> CommMatrix:
+    latencies = df["lrecv"].to_numpy(dtype="int64") - df["lsend"].to_numpy(dtype="int64")
+    return _reduce(
+        _keys(df, "send", granularity),
+        _keys(df, "recv", granularity),
+        None,
+        df["size"].to_numpy(dtype="float64"),
+        latencies.astype("float64"),
+    )
+
+
+def merge_matrices(matrices: Iterable[CommMatrix]) -> CommMatrix:
+    """ Matrix of the union of the messages of `matrices` """
+    parts = [matrix for matrix in matrices if matrix.counts.size > 0]
+    if len(parts) == 0:
+        return _empty_matrix()
+    send_keys = np.concatenate([thread_keys(*m.participants[m.senders].T) for m in parts])
+    recv_keys = np.concatenate([thread_keys(*m.participants[m.receivers].T) for m in parts])
+    counts, sizes, latencies = (
+        np.concatenate([getattr(m, name) for m in parts]).astype("float64") for name in ("counts", "bytes", "latency")
+    )
+    return _reduce(send_keys, recv_keys, counts, sizes, latencies)
+
+
+def comm_matrix(df_comm, granularity: str = "task", start=None, end=None, is_sorted=False) -> CommMatrix:
+    """ Traffic between tasks, or threads, of the messages sent (by logical send time) in the time window
+    [start, end). Dask DataFrames are aggregated partition by partition (chunked mode), so only one partition of an
+    out of core trace is in memory at a time
+    """
+    if granularity not in GRANULARITIES:
+        raise Exception(f"Cannot aggregate messages by {granularity}. Granularities are: {', '.join(GRANULARITIES)}.")
+    if "lsend" not in df_comm.columns:
+        # Empty tables are read without columns
+        return _empty_matrix()
+    if start is not None or end is not None:
+        df_comm = window(df_comm, "lsend", start, end, is_sorted)
+    if isinstance(df_comm, dd.DataFrame):
+        return merge_matrices(_partition_matrix(partition.compute(), granularity) for partition in df_comm.partitions)
+    return _partition_matrix(df_comm, granularity)
+
+
+def trace_comm_matrix(trace, granularity: str = "task", start=None, end=None) -> CommMatrix:
+    """ Communication matrix of `trace` in [start, end), see comm_matrix """
+    if trace.df_comm is None:
+        return _empty_matrix()
+    return comm_matrix(trace.df_comm, granularity, start, end, trace.is_sorted)
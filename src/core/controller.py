@@ -1,18 +1,17 @@
-import itertools
-
 from src import Trace
+from src.CONST import STATE_NAMES
+from src.core.profile import trace_profile
 
 
-def get_table_data(trace: Trace):
-    cols_header = ["MPI_call", "MPI_exec", "MPI_otracosa"]
+def get_table_data(trace: Trace, start=None, end=None):
+    """ Percentage of the time of each thread spent in each state, in the time window [start, end) """
+    profile = trace_profile(trace, start, end)
+    cols_header = [STATE_NAMES.get(state, f"State {state}") for state in profile.states]
+    values = profile.percentages().round(2)
     table_data = [
-        ["Thread 1.1", 1.0, 2.0, 1.4],
-        ["Thread 1.2", 4.0, 3.0, 7.0],
-        ["Thread 2.1", 0.5, 2.0, 1.0],
-        ["Thread 2.2", 5.0, 1.0, 6.4],
+        [f"Thread {appl}.{task}.{thread}", *row.tolist()] for (appl, task, thread), row in zip(profile.threads, values)
     ]
 
-    flattened_data = list(itertools.chain.from_iterable(table_data))
-    min_value = min([value for value in flattened_data if isinstance(value, (float, int))])
-    max_value = max([value for value in flattened_data if isinstance(value, (float, int))])
+    min_value = float(values.min()) if values.size > 0 else 0.0
+    max_value = float(values.max()) if values.size > 0 else 0.0
     return cols_header, table_data, min_value, max_value
@@ -1,9 +1,14 @@
 import logging
-from typing import Iterable
+from typing import Iterable, Optional, Tuple
 
 import dask.dataframe as dd
+import numpy as np
+import pandas as pd
 
 from src.CONST import Record
+from src.core.mask_cache import MaskCache, freeze, index_key
+from src.core.time_window import is_sorted_by, sorted_range
+from src.persistence.event_index import EVENT_INDEX_ATTR, EVENT_INDEX_FRAME_ATTR
 
 logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -16,6 +21,21 @@ def _check_attribute(attribute: Record):
         )
 
 
+def _event_index(df):
+    """ EventIndex of the Events read from a file (see HDF5Reader.parse_records), if `df` is the DataFrame it was
+    attached to and still has all its rows. The frames derived from it inherit its attrs but not the index
+    """
+    if not isinstance(df, pd.DataFrame) or EVENT_INDEX_ATTR not in df.attrs:
+        return None
+    frame = df.attrs.get(EVENT_INDEX_FRAME_ATTR)
+    if frame is None or frame() is not df:
+        return None
+    event_index = df.attrs[EVENT_INDEX_ATTR]
+    if df.shape[0] != event_index.nrows or not df.index.equals(pd.RangeIndex(event_index.nrows)):
+        return None
+    return event_index
+
+
 # this functions compute the bit mask of the DataFrame indices that meet the condition
 
 
@@ -63,6 +83,31 @@ def _filter_contains(df, attribute, values: Iterable):
     return mask
 
 
+# these ones compute the [first, last) rows that meet the condition when the DataFrame is sorted by the attribute
+
+
+def _range_lesser(values, value):
+    return sorted_range(values, end=value)
+
+
+def _range_greater(values, value):
+    return int(np.searchsorted(values, value, side="right")), len(values)
+
+
+def _range_lesser_or_equal(values, value):
+    return sorted_range(values, end=value, include_end=True)
+
+
+def _range_greater_or_equal(values, value):
+    return sorted_range(values, start=value)
+
+
+def _range_from_to(values, start_value=None, end_value=None):
+    if start_value is None and end_value is None:
+        raise Exception(f"Cannot filter from {start_value} to {end_value}.")
+    return sorted_range(values, start_value, end_value)
+
+
 # Not used for now, useful in the future
 # def _filter_by_attribute_names(df, attributes: List):
 #     bad_attributes = [attribute for attribute in attributes if attribute not in filter_attributes]
@@ -87,16 +132,86 @@ class Filter:
         "in": _filter_contains,
         "from_to": _filter_from_to,
     }
+    _sorted_operator_function = {
+        "<=": _range_lesser_or_equal,
+        ">=": _range_greater_or_equal,
+        "<": _range_lesser,
+        ">": _range_greater,
+        "from_to": _range_from_to,
+    }
 
-    def __init__(self):
+    def __init__(self, cache: Optional[MaskCache] = None, key: Optional[Tuple] = None):
+        """
+        With a cache, the masks of the operators added over pandas DataFrames are memoized in it. `key` identifies
+        the table filtered, (trace, table), e.g. (trace.metadata.name, "Events"), and the index of the DataFrame its
+        rows (see mask_cache.index_key).
+        """
         self.mask = None
+        self.cache = cache
+        self.key = key
+        # Operators whose masks are combined in self.mask, the key of the combined mask in the cache
+        self.operators = frozenset()
+        # [first, last) rows selected by the operators on the column the DataFrame is sorted by
+        self.row_range = None
+        # Sorted positions of the rows selected by the event types filters that used the EventIndex
+        self.positions = None
+
+    def _add_row_range(self, df, attribute: Record, operator: str, *args):
+        first, last = self._sorted_operator_function[operator](df[attribute.name].to_numpy(), *args)
+        if self.row_range is not None:
+            first, last = max(first, self.row_range[0]), min(last, self.row_range[1])
+        self.row_range = (first, max(first, last))
+        logger.debug(f"adding operator {attribute} {operator} {args}, rows {self.row_range}")
+        return self
+
+    def _add_positions(self, event_index, operator: str, value):
+        positions = event_index.positions(value if operator == "in" else [value])
+        if self.positions is not None:
+            positions = np.intersect1d(self.positions, positions, assume_unique=True)
+        self.positions = positions
+        logger.debug(f"adding operator {Record.event_t} {operator} {value}, {positions.size} rows")
+        return self
+
+    def _add_cached_operator(self, df: pd.DataFrame, attribute: Record, operator: str, *args):
+        # The order of the values of `in` doesn't change its mask
+        arguments = freeze((set(args[0]),) if operator == "in" else args)
+        operator_key = (attribute.name, "==" if operator == "=" else operator, arguments)
+        operators = self.operators | {operator_key}
+        # Masks of other rows of the same table, e.g. another time window, don't apply to these ones
+        key = (*self.key, index_key(df.index))
+        size = df.shape[0]
+        mask = self.cache.get((*key, operators), size)
+        if mask is None:
+            added_operator = self.cache.get((*key, frozenset([operator_key])), size)
+            if added_operator is None:
+                added_operator = self._operator_function[operator](df, attribute.name, *args).to_numpy()
+                self.cache.put((*key, frozenset([operator_key])), added_operator)
+            mask = added_operator if self.mask is None else self.mask.to_numpy() & added_operator
+            if len(operators) > 1:
+                self.cache.put((*key, operators), mask)
+        logger.debug(f"adding cached operator {attribute} {operator} {args}")
+        self.mask = pd.Series(mask, index=df.index)
+        self.operators = operators
+        return self
 
     def add_operator(self, df: dd.DataFrame, attribute: Record, operator: str, *args):
         """
         Stores the result bit mask after adding an operator. Only filters in execute(), doesn't do any additional
         computation besides computing the bit masks.
+        If df is a persistence.hdf5_reader.HDF5Table the "mask" is a Predicate, and execute() reads from disk only
+        the rows that satisfy it. If it's a pandas DataFrame sorted by the attribute (see core.time_window.tag_sorted),
+        range operators are a binary search that selects a range of rows instead. Equality and `in` filters of
+        event types use the inverted index of the event types of the file, if the Events were read with it.
         """
         _check_attribute(attribute)
+        if operator in self._sorted_operator_function and is_sorted_by(df, attribute.name):
+            return self._add_row_range(df, attribute, operator, *args)
+        if attribute is Record.event_t and operator in ("==", "=", "in"):
+            event_index = _event_index(df)
+            if event_index is not None:
+                return self._add_positions(event_index, operator, *args)
+        if self.cache is not None and self.key is not None and isinstance(df, pd.DataFrame):
+            return self._add_cached_operator(df, attribute, operator, *args)
         added_operator = self._operator_function[operator](df, attribute.name, *args)
         logger.debug(f"adding operator {attribute} {operator} {args}")
         if self.mask is None:
@@ -107,4 +222,12 @@ class Filter:
         return self
 
     def execute(self, df):
-        return df.loc[self.mask]
+        if self.row_range is None and self.positions is None:
+            return df.loc[self.mask]
+        first, last = self.row_range if self.row_range is not None else (0, df.shape[0])
+        if self.positions is None:
+            rows = slice(first, last)
+        else:
+            rows = self.positions[np.searchsorted(self.positions, first): np.searchsorted(self.positions, last)]
+        df = df.iloc[rows]
+        return df if self.mask is None else df.loc[self.mask.iloc[rows]]
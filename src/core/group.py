@@ -1,12 +1,20 @@
 import logging
 
 import dask.dataframe as dd
+import pandas as pd
 
 from src.CONST import Record
+from src.persistence.hdf5_reader import THREAD_PARTITIONS, HDF5Reader, HDF5Table, thread_rows
+from src.persistence.writer import THREAD_COLUMNS
 
 logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Functions of Group.aggregate, and the partial aggregations of each partition they are combined from
+AGGREGATIONS = {"sum": ("sum",), "count": ("count",), "min": ("min",), "max": ("max",), "mean": ("sum", "count")}
+# How the partial aggregations of the partitions are combined
+_COMBINE = {"sum": "sum", "count": "sum", "min": "min", "max": "max"}
+
 
 def _check_attribute(attribute: Record):
     if not attribute.can_group:
@@ -15,7 +23,49 @@ def _check_attribute(attribute: Record):
         )
 
 
+def _partial(df: pd.DataFrame, attribute: str, column: str, func: str) -> pd.DataFrame:
+    return df.groupby(attribute)[column].agg(list(AGGREGATIONS[func]))
+
+
 class Group:
     def group_by(self, df: dd.DataFrame, attribute: Record):
         _check_attribute(attribute)
         return df.groupby(attribute.name)
+
+    def thread(self, df, appl: int, task: int, thread: int) -> pd.DataFrame:
+        """ Records of the thread appl.task.thread of `df`, the sending thread for communications. An HDF5Table
+        partitioned by thread reads just the rows of the thread (see HDF5Table.thread_rows), and a Dask DataFrame of
+        it just the partitions of those rows, found from its divisions. DataFrames are masked
+        """
+        if isinstance(df, HDF5Table):
+            return df.read_thread(appl, task, thread)
+        if isinstance(df, dd.DataFrame) and THREAD_PARTITIONS in df._meta.attrs and df.known_divisions:
+            start, stop = thread_rows(df._meta.attrs[THREAD_PARTITIONS], appl, task, thread)
+            # Row numbers, .loc includes its upper bound
+            return df.loc[start: stop - 1] if start < stop else dd.from_pandas(df._meta, npartitions=1)
+        columns = THREAD_COLUMNS["States"] if "appl_id" in df.columns else THREAD_COLUMNS["Comm"]
+        mask = (df[columns[0]] == appl) & (df[columns[1]] == task) & (df[columns[2]] == thread)
+        return df[mask]
+
+    def aggregate(self, df, attribute: Record, column: str, func: str = "sum") -> pd.Series:
+        """ `func` (sum, count, min, max or mean) of the `column` of the records of `df` grouped by `attribute`.
+        Each partition of a Dask DataFrame is aggregated on its own and the partial results, one row per group of
+        the partition, are combined, with no shuffle of the records. The partitions of a table partitioned by
+        thread hold whole threads, so grouping by thread gives almost no overlapping partial results
+        """
+        _check_attribute(attribute)
+        if func not in AGGREGATIONS:
+            raise Exception(f"Cannot aggregate with {func}. List of possible functions: {', '.join(AGGREGATIONS)}.")
+        columns = list(dict.fromkeys((attribute.name, column)))
+        if isinstance(df, HDF5Table):
+            df = HDF5Reader().parse_table(df.file, df.key, columns, use_dask=True)
+        if isinstance(df, dd.DataFrame):
+            partials = df[columns].map_partitions(_partial, attribute.name, column, func).compute()
+        else:
+            partials = _partial(df[columns], attribute.name, column, func)
+        totals = partials.groupby(level=0).agg({name: _COMBINE[name] for name in partials.columns})
+        if func == "mean":
+            result = totals["sum"] / totals["count"]
+        else:
+            result = totals[func]
+        return result.rename(column)
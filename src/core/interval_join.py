@@ -0,0 +1,200 @@
+import logging
+from typing import Iterable, Iterator, Optional
+
+import dask.dataframe as dd
+import numpy as np
+import pandas as pd
+
+from src.core.profile import thread_keys
+from src.core.time_window import max_duration, state_window
+
+logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# state and state_index of the events outside every state of their thread
+NO_STATE = -1
+
+
+def _thread_keys(df: pd.DataFrame) -> np.ndarray:
+    return thread_keys(df["appl_id"].to_numpy(), df["task_id"].to_numpy(), df["thread_id"].to_numpy())
+
+
+def _sort_keys(state_threads: np.ndarray, time_ini: np.ndarray, event_threads: np.ndarray, times: np.ndarray):
+    """ int64 keys ordered by (thread, time) of the states and the events: thread * span + time. When they don't
+    fit in int64 the times are replaced by their ranks, which keep their order
+    """
+    all_times = np.concatenate((time_ini, times))
+    low, span = int(all_times.min()), int(all_times.max()) - int(all_times.min()) + 1
+    if (int(max(state_threads.max(initial=0), event_threads.max(initial=0))) + 1) * span >= 2**62:
+        ranks, values = pd.factorize(all_times, sort=True)
+        low, span = 0, values.size
+        time_ini, times = ranks[: time_ini.size], ranks[time_ini.size:]
+    state_keys = state_threads.astype("int64") * span + (time_ini.astype("int64") - low)
+    return state_keys, event_threads.astype("int64") * span + (times.astype("int64") - low)
+
+
+def enclosing_states(df_event: pd.DataFrame, df_state: pd.DataFrame) -> np.ndarray:
+    """ Position in `df_state` of the state of the thread of each event when it fired (time_ini <= time < time_fi),
+    NO_STATE if there's none. The states are sorted by (thread, time_ini) and each event is searched in them with a
+    single np.searchsorted over the (thread, time) keys, O((N + M) log N). If the states of a thread overlap, the
+    event gets the last one started
+    """
+    if df_event.shape[0] == 0 or "time_ini" not in df_state.columns:
+        return np.full(df_event.shape[0], NO_STATE, dtype="int64")
+    time_ini, time_fi = df_state["time_ini"].to_numpy("int64"), df_state["time_fi"].to_numpy("int64")
+    times = df_event["time"].to_numpy("int64")
+    # Empty states don't enclose any event
+    nonempty = np.flatnonzero(time_fi > time_ini)
+    if nonempty.size == 0:
+        return np.full(df_event.shape[0], NO_STATE, dtype="int64")
+    state_keys, event_keys = _thread_keys(df_state)[nonempty], _thread_keys(df_event)
+    threads, _ = pd.factorize(np.concatenate((state_keys, event_keys)))
+    state_sort_keys, event_sort_keys = _sort_keys(
+        threads[: nonempty.size], time_ini[nonempty], threads[nonempty.size:], times
+    )
+    order = np.argsort(state_sort_keys, kind="stable")
+    found = np.searchsorted(state_sort_keys[order], event_sort_keys, side="right") - 1
+    last_started = order[np.maximum(found, 0)]
+    candidates = nonempty[last_started]
+    hit = (found >= 0) & (state_keys[last_started] == event_keys) & (times < time_fi[candidates])
+    return np.where(hit, candidates, NO_STATE)
+
+
+def _join(df_event: pd.DataFrame, df_state: pd.DataFrame) -> pd.DataFrame:
+    positions = enclosing_states(df_event, df_state)
+    hit = positions != NO_STATE
+    df = df_event.copy()
+    state_index = np.full(positions.size, NO_STATE, dtype="int64")
+    state = np.full(positions.size, NO_STATE, dtype="int64")
+    if "time_ini" in df_state.columns:
+        state_index[hit] = df_state.index.to_numpy()[positions[hit]]
+        state[hit] = df_state["state"].to_numpy()[positions[hit]]
+    df["state_index"] = state_index
+    df["state"] = state
+    return df
+
+
+def _partitions(df) -> Iterable[pd.DataFrame]:
+    if isinstance(df, dd.DataFrame):
+        return (partition.compute() for partition in df.partitions)
+    return [df]
+
+
+class _StateStream:
+    """ States of a Dask DataFrame sorted by time_ini, read partition by partition while the time windows asked move
+    forward in time, each partition once. Only the partitions that can have states overlapping the current window
+    are kept: the ones whose last state starts less than the duration of the longest state (`longest`) before it
+    """
+
+    def __init__(self, df_state: dd.DataFrame, longest: int):
+        self.df_state = df_state
+        self.longest = longest
+        self.reads = 0
+        self._restart()
+
+    def _restart(self):
+        self._next = 0
+        # (states, time_ini of the last one) of the partitions kept
+        self._kept = []
+        # time_ini of the last state of the partitions dropped
+        self._dropped = None
+
+    def window(self, start: int, end: int) -> pd.DataFrame:
+        """ States that overlap [start, end), see time_window.state_window """
+        if self._dropped is not None and self._dropped >= start - self.longest:
+            # The windows went back in time
+            self._restart()
+        while self._next < self.df_state.npartitions and (len(self._kept) == 0 or self._kept[-1][1] < end):
+            states = self.df_state.partitions[self._next].compute()
+            self._next += 1
+            self.reads += 1
+            if states.shape[0] > 0:
+                self._kept.append((states, int(states["time_ini"].iloc[-1])))
+        while len(self._kept) > 0 and self._kept[0][1] < start - self.longest:
+            self._dropped = self._kept.pop(0)[1]
+        if len(self._kept) == 0:
+            return self.df_state._meta
+        states = pd.concat([kept for kept, _ in self._kept]) if len(self._kept) > 1 else self._kept[0][0]
+        return state_window(states, start, end, True, self.longest)
+
+
+def iter_join_states(df_event, df_state, is_sorted=False, longest: Optional[int] = None) -> Iterator[pd.DataFrame]:
+    """ The events of `df_event` with the `state_index` (index label in `df_state`) and `state` of the state of
+    their thread when they fired, NO_STATE if none. Dask DataFrames of events are joined partition by partition
+    (chunked mode), each one with the states that overlap its time range, found with binary searches when the
+    states are sorted (`is_sorted`, see time_window.state_window). Sorted Dask DataFrames of states are read along
+    with the events, each partition once (see _StateStream). `longest` is the duration of the longest state,
+    computed if not given
+    """
+    if "time" not in df_event.columns:
+        # Empty tables are read without columns
+        return
+    has_states = "time_ini" in df_state.columns
+    if is_sorted and has_states and longest is None:
+        longest = max_duration(df_state)
+    stream = None
+    if is_sorted and has_states and isinstance(df_state, dd.DataFrame):
+        stream = _StateStream(df_state, longest)
+    for events in _partitions(df_event):
+        if events.shape[0] == 0:
+            continue
+        states = df_state
+        if has_states:
+            times = events["time"].to_numpy()
+            start, end = int(times.min()), int(times.max()) + 1
+            if stream is not None:
+                states = stream.window(start, end)
+            else:
+                states = state_window(df_state, start, end, is_sorted, longest)
+                states = states.compute() if isinstance(states, dd.DataFrame) else states
+        yield _join(events, states)
+
+
+def join_states(df_event, df_state, is_sorted=False, longest: Optional[int] = None) -> pd.DataFrame:
+    """ In-memory version of iter_join_states """
+    parts = list(iter_join_states(df_event, df_state, is_sorted, longest))
+    if len(parts) == 0:
+        return pd.DataFrame(columns=[*df_event.columns, "state_index", "state"])
+    return pd.concat(parts) if len(parts) > 1 else parts[0]
+
+
+def counter_deltas(df_event, df_state, types=None, is_sorted=False, longest: Optional[int] = None) -> pd.DataFrame:
+    """ Value of the counters of event `types` (all of them by default) in each state: the sum of the values of
+    their events fired in it, the counters being read as the increment since the previous reading. One row per
+    state_index with any of those events and one column per type. Each chunk of the join is reduced with a bincount
+    over the (state, type) pairs before the next one is read
+    """
+    types = None if types is None else np.unique(np.fromiter(types, dtype="int64"))
+    totals = None
+    for joined in iter_join_states(df_event, df_state, is_sorted, longest):
+        mask = joined["state_index"].to_numpy() != NO_STATE
+        if types is not None:
+            mask &= np.isin(joined["event_t"].to_numpy(), types)
+        joined = joined.loc[mask]
+        if joined.shape[0] == 0:
+            continue
+        state_idx, state_labels = pd.factorize(joined["state_index"].to_numpy())
+        type_idx, type_labels = pd.factorize(joined["event_t"].to_numpy(), sort=True)
+        cells = state_labels.size * type_labels.size
+        # float64 weights add integers exactly while the total of a cell is below 2**53
+        sums = np.bincount(
+            state_idx * type_labels.size + type_idx, weights=joined["event_v"].to_numpy("float64"), minlength=cells
+        )
+        part = pd.DataFrame(
+            np.rint(sums).astype("int64").reshape(state_labels.size, type_labels.size),
+            index=pd.Index(state_labels.astype("int64"), name="state_index"),
+            columns=type_labels.astype("int64"),
+        )
+        # A state that spans several chunks has events in more than one of them
+        totals = part if totals is None else totals.add(part, fill_value=0).astype("int64")
+    if totals is None:
+        return pd.DataFrame(index=pd.Index([], dtype="int64", name="state_index"))
+    return totals.sort_index().sort_index(axis=1)
+
+
+def trace_counter_deltas(trace, types=None, start=None, end=None) -> pd.DataFrame:
+    """ counter_deltas of the events of `trace` in [start, end) """
+    if trace.df_event is None or trace.df_state is None:
+        return pd.DataFrame(index=pd.Index([], dtype="int64", name="state_index"))
+    windowed = trace.time_window(start, end) if start is not None or end is not None else trace
+    return counter_deltas(windowed.df_event, trace.df_state, types, trace.is_sorted, windowed._max_state_duration)
@@ -0,0 +1,185 @@
+import logging
+from typing import Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+import dask.dataframe as dd
+import numpy as np
+import pandas as pd
+
+from src.core.profile import thread_keys
+
+logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Table of the intervals of the paired events, stored next to the record tables of a converted trace
+INTERVALS = "Intervals"
+INTERVAL_COLUMNS = ["appl_id", "task_id", "thread_id", "event_t", "event_v", "time_ini", "time_fi", "depth"]
+
+_EVENT_COLUMNS = ["appl_id", "task_id", "thread_id", "time", "event_t", "event_v"]
+
+
+def _empty_intervals() -> pd.DataFrame:
+    return pd.DataFrame({name: np.empty(0, dtype="int64") for name in INTERVAL_COLUMNS})
+
+
+def _partitions(df) -> Iterable[pd.DataFrame]:
+    if isinstance(df, dd.DataFrame):
+        return (partition.compute() for partition in df.partitions)
+    return [df]
+
+
+def _pairable_types(chunks: Iterable[pd.DataFrame]) -> np.ndarray:
+    types = np.empty(0, dtype="int64")
+    for chunk in chunks:
+        if "event_t" in chunk.columns:
+            event_t, event_v = chunk["event_t"].to_numpy(), chunk["event_v"].to_numpy()
+            types = np.union1d(types, event_t[event_v == 0].astype("int64"))
+    return types
+
+
+def pairable_types(df_event) -> np.ndarray:
+    """ Sorted event types with exit events (value 0): the ones whose entry events open an interval, e.g. MPI calls
+    or user functions. Types never 0, like most hardware counters, are left out. Dask DataFrames are read partition by partition
+    """
+    return _pairable_types(_partitions(df_event))
+
+
+def _intervals(columns: Dict[str, np.ndarray], rows: np.ndarray, time_fi: np.ndarray, depth: np.ndarray):
+    """ Intervals opened by the entry events `rows` of the event `columns` """
+    return pd.DataFrame(
+        {
+            "appl_id": columns["appl_id"][rows],
+            "task_id": columns["task_id"][rows],
+            "thread_id": columns["thread_id"][rows],
+            "event_t": columns["event_t"][rows],
+            "event_v": columns["event_v"][rows],
+            "time_ini": columns["time"][rows],
+            "time_fi": time_fi,
+            "depth": depth.astype("int32"),
+        }
+    )
+
+
+def _pair(columns: Dict[str, np.ndarray]) -> Tuple[pd.DataFrame, np.ndarray, np.ndarray]:
+    """ Pairs each entry event (value != 0) with the exit event (value 0) of the same type and thread that closes
+    it, handling nested entries as a stack. Returns the intervals closed, sorted by time_ini, and the positions and
+    depths of the entries left open.
+    The events are stably sorted by (thread, type, time), so each run of events of a thread and type is in time
+    order. In a run, the depth after each event is the running sum of +1 per entry and -1 per exit reflected at 0
+    (exits without an open entry are ignored): depth = sum - min(0, running min of sum). An entry at depth d is
+    closed by the next exit from depth d of its run, and between them there's no other event at depth d, so after
+    a stable sort by (run, depth) every entry is followed by its exit, if it has one
+    """
+    keys = thread_keys(columns["appl_id"], columns["task_id"], columns["thread_id"])
+    values, times = columns["event_v"], columns["time"]
+    n = keys.size
+    if n == 0:
+        return _empty_intervals(), np.empty(0, dtype="int64"), np.empty(0, dtype="int64")
+    order = np.lexsort((times, columns["event_t"], keys))
+    sorted_keys, sorted_types = keys[order], columns["event_t"][order]
+    first = np.ones(n, dtype=bool)
+    first[1:] = (sorted_keys[1:] != sorted_keys[:-1]) | (sorted_types[1:] != sorted_types[:-1])
+    run = np.cumsum(first) - 1
+    step = np.where(values[order] != 0, 1, -1)
+    total = np.cumsum(step)
+    total -= (total - step)[first][run]
+    # The runs are offset downwards by more than the range of their sums, so the running min of the whole array
+    # never carries over from the previous run
+    offset = run * (2 * n + 1)
+    lowest = np.minimum.accumulate(total - offset) + offset
+    depth = total - np.minimum(lowest, 0)
+    before = np.concatenate(([0], depth[:-1]))
+    before[first] = 0
+
+    entry = step > 0
+    level = np.where(entry, depth, before)
+    candidates = np.flatnonzero(entry | (before > 0))
+    ranked = candidates[np.lexsort((candidates, level[candidates], run[candidates]))]
+    ranked_run, ranked_level, ranked_entry = run[ranked], level[ranked], entry[ranked]
+    closed = np.zeros(ranked.size, dtype=bool)
+    closed[:-1] = (ranked_run[1:] == ranked_run[:-1]) & (ranked_level[1:] == ranked_level[:-1]) & ~ranked_entry[1:]
+    closed &= ranked_entry
+    still_open = np.sort(ranked[ranked_entry & ~closed])
+    starts, ends = ranked[closed], ranked[np.flatnonzero(closed) + 1]
+    time_order = np.argsort(times[order[starts]], kind="stable")
+    starts, ends = starts[time_order], ends[time_order]
+    intervals = _intervals(columns, order[starts], times[order[ends]], level[starts] - 1)
+    return intervals, order[still_open], level[still_open] - 1
+
+
+class IntervalBuilder:
+    """ Turns Event records, added chunk by chunk in time order, into the intervals (thread, type, value, start,
+    end) of their entry and exit events. Only the entries still open are kept between chunks, so an out of core
+    Events table is paired in bounded memory
+    """
+
+    def __init__(self, types: Optional[Iterable[int]] = None):
+        self.types = None if types is None else np.unique(np.fromiter(types, dtype="int64"))
+        self.end = None
+        self._open: Optional[Dict[str, np.ndarray]] = None
+
+    def add(self, df_event: pd.DataFrame) -> pd.DataFrame:
+        """ Intervals closed by the events of `df_event`, sorted by time_ini """
+        columns = {name: df_event[name].to_numpy() for name in _EVENT_COLUMNS}
+        if self.types is not None:
+            mask = np.isin(columns["event_t"], self.types)
+            columns = {name: values[mask] for name, values in columns.items()}
+        if columns["time"].size > 0:
+            last = int(columns["time"].max())
+            self.end = last if self.end is None else max(self.end, last)
+        if self._open is not None:
+            columns = {name: np.concatenate((self._open[name], values)) for name, values in columns.items()}
+        intervals, still_open, _ = _pair(columns)
+        self._open = {name: values[still_open] for name, values in columns.items()}
+        return intervals
+
+    def close(self, end: Optional[int] = None) -> pd.DataFrame:
+        """ Intervals of the entries left open, ending at `end` (the time of the last event by default) """
+        if self._open is None or self._open["time"].size == 0:
+            return _empty_intervals()
+        _, still_open, depth = _pair(self._open)
+        columns = {name: values[still_open] for name, values in self._open.items()}
+        self._open = None
+        logger.debug(f"Closing {still_open.size} unmatched entry events at {end if end is not None else self.end}")
+        time_order = np.argsort(columns["time"], kind="stable")
+        time_fi = np.full(time_order.size, self.end if end is None else end, dtype="int64")
+        return _intervals(columns, time_order, time_fi, depth[time_order])
+
+
+def iter_intervals(read_chunks: Callable[[], Iterable[pd.DataFrame]], types=None, end=None) -> Iterator[pd.DataFrame]:
+    """ Intervals of the Events read in time order by read_chunks(), chunk by chunk. Without `types`, the pairable
+    types are found first in another pass over the chunks. The entries never closed end at `end`, the time of the
+    last event by default
+    """
+    types = _pairable_types(read_chunks()) if types is None else types
+    builder = IntervalBuilder(types)
+    for chunk in read_chunks():
+        yield builder.add(chunk)
+    yield builder.close(end)
+
+
+def event_intervals(df_event, types=None, end=None) -> pd.DataFrame:
+    """ Intervals (thread, type, value, start, end) of the entry and exit events of `df_event`, sorted by time_ini.
+    Nested entries of a type are closed by the exits in reverse order, each interval has its nesting `depth` (0 for
+    the outermost). Exits without an open entry are ignored and the entries never closed end at `end`. Dask
+    DataFrames are paired partition by partition
+    """
+    if "event_t" not in df_event.columns:
+        # Empty tables are read without columns
+        return _empty_intervals()
+    parts = list(iter_intervals(lambda: _partitions(df_event), types, end))
+    df = pd.concat(parts, ignore_index=True)
+    return df.iloc[np.argsort(df["time_ini"].to_numpy(), kind="stable")].reset_index(drop=True)
+
+
+def trace_intervals(trace):
+    """ Intervals of the paired events of `trace`: the Intervals table of its converted trace if it has one, computed
+    from its Events otherwise
+    """
+    read = getattr(trace, "read", None)
+    if read is not None:
+        intervals = read(INTERVALS)
+        if "time_ini" in intervals.columns:
+            return intervals
+    if trace.df_event is None:
+        return _empty_intervals()
+    return event_intervals(trace.df_event)
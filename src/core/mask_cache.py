@@ -0,0 +1,141 @@
+import hashlib
+import logging
+import os
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+# Memory used by the cached masks, the least recently used ones are evicted above it
+MASK_CACHE_BYTES = int(os.environ.get("MASK_CACHE_BYTES", MB * 256))
+
+
+def freeze(value) -> Hashable:
+    """ Hashable version of the arguments of a Filter operator """
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (list, tuple, set, frozenset, np.ndarray)):
+        values = tuple(freeze(v) for v in value)
+        return tuple(sorted(values, key=repr)) if isinstance(value, (set, frozenset)) else values
+    return value
+
+
+# index_key of the indexes that are not a RangeIndex, by id, while they are alive
+_index_keys: Dict[int, Tuple[weakref.ref, Hashable]] = dict()
+
+
+def index_key(index: pd.Index) -> Hashable:
+    """ Fingerprint of the rows of a DataFrame, its index. The rows of the tables of a trace are numbered, so it tells
+    apart the subsets of a table with the same number of rows, e.g. two time windows of the same size. The tables are
+    read with a RangeIndex, keyed by its bounds. Other indexes, of the rows selected from them, are hashed once
+    """
+    if isinstance(index, pd.RangeIndex):
+        return "range", index.start, index.stop, index.step
+    cached = _index_keys.get(id(index))
+    if cached is not None and cached[0]() is index:
+        return cached[1]
+    digest = hashlib.blake2b(pd.util.hash_array(index.to_numpy()).tobytes(), digest_size=16).hexdigest()
+    key = ("hash", len(index), digest)
+    index_id = id(index)
+    _index_keys[index_id] = (weakref.ref(index, lambda _: _index_keys.pop(index_id, None)), key)
+    return key
+
+
+class _CompressedMask:
+    """ Boolean mask stored as the positions of its True values if it's sparse, bit-packed otherwise """
+
+    __slots__ = ("size", "positions", "bits")
+
+    def __init__(self, mask: np.ndarray):
+        self.size = mask.size
+        count = int(np.count_nonzero(mask))
+        dtype = np.dtype("uint32") if mask.size <= np.iinfo("uint32").max else np.dtype("int64")
+        if count * dtype.itemsize < (mask.size + 7) // 8:
+            self.positions, self.bits = np.flatnonzero(mask).astype(dtype), None
+        else:
+            self.positions, self.bits = None, np.packbits(mask)
+
+    @property
+    def nbytes(self) -> int:
+        return self.positions.nbytes if self.positions is not None else self.bits.nbytes
+
+    def unpack(self) -> np.ndarray:
+        if self.positions is None:
+            return np.unpackbits(self.bits, count=self.size).view(bool)
+        mask = np.zeros(self.size, dtype=bool)
+        mask[self.positions] = True
+        return mask
+
+
+class MaskCache:
+    """ LRU cache of the boolean masks computed by Filter, keyed by (trace, table, rows, operators), where the rows
+    are the index_key of the DataFrame filtered and the operators are a frozenset of (attribute, operator, arguments)
+    so the masks of combined operators are found in any order.
+    Masks are stored compressed, within a budget of `max_bytes`
+    """
+
+    def __init__(self, max_bytes: int = MASK_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._masks: "OrderedDict[Tuple, _CompressedMask]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._masks)
+
+    def __contains__(self, key: Tuple):
+        return key in self._masks
+
+    def get(self, key: Tuple, size: int) -> Optional[np.ndarray]:
+        """ The mask of `key` if it's cached and has `size` values, None otherwise """
+        with self._lock:
+            compressed = self._masks.get(key)
+            if compressed is None or compressed.size != size:
+                self.misses += 1
+                return None
+            self._masks.move_to_end(key)
+            self.hits += 1
+        return compressed.unpack()
+
+    def put(self, key: Tuple, mask: np.ndarray):
+        compressed = _CompressedMask(mask)
+        if compressed.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._masks:
+                self.nbytes -= self._masks.pop(key).nbytes
+            self._masks[key] = compressed
+            self.nbytes += compressed.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._masks.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                self.evictions += 1
+
+    def invalidate(self, trace) -> int:
+        """ Drops the masks of `trace` (the first element of their keys). Returns how many were dropped """
+        with self._lock:
+            keys = [key for key in self._masks if key[0] == trace]
+            for key in keys:
+                self.nbytes -= self._masks.pop(key).nbytes
+        if len(keys) > 0:
+            logger.debug(f"Dropped {len(keys)} cached masks of {trace}")
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._masks.clear()
+            self.nbytes = 0
+
+
+# Shared by the Filters of the traces loaded in the interface
+MASK_CACHE = MaskCache()
@@ -0,0 +1,185 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Iterable, Tuple
+
+import dask.dataframe as dd
+import numpy as np
+import pandas as pd
+
+from src.CONST import Record
+from src.core.filter import Filter
+from src.core.mask_cache import MASK_CACHE
+from src.core.time_window import state_window
+
+logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Profiles cached, one per trace and time window
+PROFILE_CACHE_SIZE = int(os.environ.get("PROFILE_CACHE_SIZE", 64))
+
+# Bits of the task and thread ids in the thread keys: appl_id << 48 | task_id << 16 | thread_id
+_TASK_SHIFT = 16
+_APPL_SHIFT = 48
+
+
+@dataclass
+class Profile:
+    """ Time spent in each state by each thread. durations[i, j] is the time (ns) threads[i] = (appl, task, thread)
+    spent in states[j]
+    """
+
+    threads: np.ndarray
+    states: np.ndarray
+    durations: np.ndarray
+
+    def percentages(self) -> np.ndarray:
+        """ Durations as the percentage of the time of each thread """
+        totals = self.durations.sum(axis=1, keepdims=True)
+        return np.divide(self.durations * 100.0, totals, out=np.zeros(self.durations.shape), where=totals > 0)
+
+
+def thread_keys(appl: np.ndarray, task: np.ndarray, thread: np.ndarray) -> np.ndarray:
+    """ int64 key of each (appl, task, thread), in the same order. split_thread_keys reverses it """
+    if thread.size > 0 and (thread.max() >> _TASK_SHIFT > 0 or task.max() >> (_APPL_SHIFT - _TASK_SHIFT) > 0):
+        raise Exception(f"Cannot profile task ids >= 2**{_APPL_SHIFT - _TASK_SHIFT} or thread ids >= 2**{_TASK_SHIFT}.")
+    return (appl.astype("int64") << _APPL_SHIFT) | (task.astype("int64") << _TASK_SHIFT) | thread.astype("int64")
+
+
+def split_thread_keys(keys: np.ndarray) -> np.ndarray:
+    mask = (1 << (_APPL_SHIFT - _TASK_SHIFT)) - 1
+    return np.stack((keys >> _APPL_SHIFT, (keys >> _TASK_SHIFT) & mask, keys & ((1 << _TASK_SHIFT) - 1)), axis=1)
+
+
+def _reduce(keys: np.ndarray, states: np.ndarray, durations: np.ndarray) -> Profile:
+    """ Sums the `durations` of each (thread key, state) pair with a single bincount. Thread keys are numbered by
+    hashing (pd.factorize), O(N) instead of the sort of np.unique
+    """
+    thread_idx, unique_keys = pd.factorize(keys, sort=True)
+    state_idx, state_values = pd.factorize(states, sort=True)
+    cells = unique_keys.size * state_values.size
+    # float64 weights add integers exactly while the total of a cell is below 2**53 ns (104 days)
+    sums = np.bincount(thread_idx * state_values.size + state_idx, weights=durations, minlength=cells)
+    durations = np.rint(sums).astype("int64").reshape(unique_keys.size, state_values.size)
+    return Profile(split_thread_keys(unique_keys.astype("int64")), state_values.astype("int64"), durations)
+
+
+def _empty_profile() -> Profile:
+    return Profile(np.empty((0, 3), dtype="int64"), np.empty(0, dtype="int64"), np.empty((0, 0), dtype="int64"))
+
+
+def _partition_profile(df: pd.DataFrame, start=None, end=None) -> Profile:
+    time_ini = df["time_ini"].to_numpy(dtype="int64")
+    time_fi = df["time_fi"].to_numpy(dtype="int64")
+    if start is not None:
+        time_ini = np.maximum(time_ini, start)
+    if end is not None:
+        time_fi = np.minimum(time_fi, end)
+    durations = np.maximum(time_fi - time_ini, 0)
+    keys = thread_keys(df["appl_id"].to_numpy(), df["task_id"].to_numpy(), df["thread_id"].to_numpy())
+    return _reduce(keys, df["state"].to_numpy(), durations)
+
+
+def merge_profiles(profiles: Iterable[Profile]) -> Profile:
+    """ Profile of the union of the records of `profiles` """
+    parts = [profile for profile in profiles if profile.durations.size > 0]
+    if len(parts) == 0:
+        return _empty_profile()
+    keys = np.concatenate([np.repeat(thread_keys(*p.threads.T), p.states.size) for p in parts])
+    states = np.concatenate([np.tile(p.states, p.threads.shape[0]) for p in parts])
+    return _reduce(keys, states, np.concatenate([p.durations.ravel() for p in parts]))
+
+
+def state_profile(df_state, start=None, end=None, is_sorted=False) -> Profile:
+    """ Time per state of each thread in the time window [start, end), the states that overlap its limits being
+    clipped to it. Dask DataFrames are profiled partition by partition (chunked mode), so only one partition of
+    an out of core trace is in memory at a time
+    """
+    if "time_ini" in df_state.columns and (start is not None or end is not None):
+        df_state = state_window(df_state, start, end, is_sorted)
+    return _window_profile(df_state, start, end)
+
+
+def _window_profile(df_state, start=None, end=None) -> Profile:
+    """ Profile of the states of the window [start, end), already selected """
+    if "time_ini" not in df_state.columns:
+        # Empty tables are read without columns
+        return _empty_profile()
+    if isinstance(df_state, dd.DataFrame):
+        return merge_profiles(_partition_profile(partition.compute(), start, end) for partition in df_state.partitions)
+    return _partition_profile(df_state, start, end)
+
+
+def _cached_state_window(df_state: pd.DataFrame, trace_name: str, start=None, end=None) -> pd.DataFrame:
+    """ States of `df_state` that overlap [start, end) (see time_window.state_window). The masks of the time_ini and
+    time_fi bounds are memoized in MASK_CACHE, so windows that share a bound reuse them
+    """
+    filter_util = Filter(MASK_CACHE, (trace_name, "States"))
+    if end is not None:
+        filter_util.add_operator(df_state, Record.time_ini, "<", end)
+    if start is not None:
+        filter_util.add_operator(df_state, Record.time_fi, ">=", start)
+    candidates = df_state if filter_util.mask is None else filter_util.execute(df_state)
+    if start is None:
+        return candidates
+    # Of the states ending at start, only the empty ones starting there are in the window
+    return candidates.loc[(candidates["time_fi"] > start) | (candidates["time_ini"] >= start)]
+
+
+def _unsorted_window_profile(df_state, trace_name: str, start=None, end=None) -> Profile:
+    """ Profile of the window [start, end) of the unsorted `df_state`, selected partition by partition """
+    if "time_ini" not in df_state.columns:
+        return _empty_profile()
+    partitions = (p.compute() for p in df_state.partitions) if isinstance(df_state, dd.DataFrame) else [df_state]
+    return merge_profiles(
+        _partition_profile(_cached_state_window(partition, trace_name, start, end), start, end)
+        for partition in partitions
+    )
+
+
+_profiles: "OrderedDict[Tuple, Profile]" = OrderedDict()
+_profiles_lock = threading.Lock()
+
+
+def trace_profile(trace, start=None, end=None) -> Profile:
+    """ State profile of `trace` in [start, end), cached per trace and window (the last PROFILE_CACHE_SIZE). The
+    window of a sorted trace is found with binary searches, the masks that select it in an unsorted one are cached
+    in MASK_CACHE
+    """
+    key = (trace.metadata.name, trace.metadata.path, start, end)
+    with _profiles_lock:
+        if key in _profiles:
+            _profiles.move_to_end(key)
+            return _profiles[key]
+    if trace.df_state is None:
+        profile = _empty_profile()
+    elif start is None and end is None:
+        profile = _window_profile(trace.df_state)
+    elif trace.is_sorted:
+        # Trace.time_window keeps the duration of the longest state of the trace between windows
+        profile = _window_profile(trace.time_window(start, end).df_state, start, end)
+    else:
+        profile = _unsorted_window_profile(trace.df_state, trace.metadata.name, start, end)
+    with _profiles_lock:
+        _profiles[key] = profile
+        while len(_profiles) > PROFILE_CACHE_SIZE:
+            _profiles.popitem(last=False)
+    return profile
+
+
+def profiles_nbytes(trace_name: str) -> int:
+    """ Memory used by the cached profiles of the trace `trace_name` """
+    with _profiles_lock:
+        profiles = [profile for key, profile in _profiles.items() if key[0] == trace_name]
+    return sum(profile.threads.nbytes + profile.states.nbytes + profile.durations.nbytes for profile in profiles)
+
+
+def drop_profiles(trace_name: str) -> int:
+    """ Drops the cached profiles of the trace `trace_name`. Returns how many were dropped """
+    with _profiles_lock:
+        keys = [key for key in _profiles if key[0] == trace_name]
+        for key in keys:
+            del _profiles[key]
+    return len(keys)
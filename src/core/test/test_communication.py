@@ -0,0 +1,98 @@
+import logging
+from unittest.mock import patch
+
+import dask.dataframe as dd
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.core.communication import comm_matrix, merge_matrices, trace_comm_matrix
+from src.persistence.hdf5_reader import HDF5Reader
+from src.persistence.prv_to_hdf5 import ParaverToHDF5
+from src.persistence.writer import LAYOUT_VERSION, Writer
+from src.Trace import Trace, TraceMetaData
+
+logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+tiny_trace = "src/persistence/test/test_files/traces/tiny.test.prv"
+
+comms = pd.DataFrame(
+    {
+        "ptask_send_id": [1, 1, 1, 1, 1, 1, 1],
+        "task_send_id": [1, 1, 2, 1, 70000, 2, 1],
+        "thread_send_id": [1, 2, 1, 1, 1, 1, 2],
+        "lsend": [0, 5, 10, 15, 20, 25, 30],
+        "ptask_recv_id": [1, 1, 1, 1, 1, 1, 1],
+        "task_recv_id": [2, 2, 1, 2, 1, 1, 1],
+        "thread_recv_id": [1, 1, 1, 3, 1, 1, 1],
+        "lrecv": [4, 6, 20, 30, 21, 26, 32],
+        "size": [100, 200, 300, 400, 500, 600, 700],
+    }
+)
+
+
+def expected_matrix(df, granularity, start=None, end=None):
+    df = df[(df["lsend"] >= (start if start is not None else -np.inf)) & (df["lsend"] < (end or np.inf))].copy()
+    if granularity == "task":
+        df["thread_send_id"] = df["thread_recv_id"] = 0
+    df["latency"] = df["lrecv"] - df["lsend"]
+    columns = ["ptask_send_id", "task_send_id", "thread_send_id", "ptask_recv_id", "task_recv_id", "thread_recv_id"]
+    grouped = df.groupby(columns).agg(count=("size", "size"), bytes=("size", "sum"), latency=("latency", "mean"))
+    grouped.index.names = ["appl_send", "task_send", "thread_send", "appl_recv", "task_recv", "thread_recv"]
+    return grouped
+
+
+def matrix_frame(matrix):
+    df = matrix.to_frame()
+    df = df.set_index(["appl_send", "task_send", "thread_send", "appl_recv", "task_recv", "thread_recv"])
+    return df.rename(columns={"mean_latency": "latency"}).sort_index()
+
+
+@pytest.mark.parametrize("granularity", ("task", "thread"))
+@pytest.mark.parametrize("start,end", ((None, None), (5, 25), (12, None), (40, 50)))
+@pytest.mark.parametrize("use_dask", (False, True))
+def test_comm_matrix(granularity, start, end, use_dask):
+    df = dd.from_pandas(comms, npartitions=3) if use_dask else comms
+    matrix = comm_matrix(df, granularity, start, end)
+    expected = expected_matrix(comms, granularity, start, end)
+    pd.testing.assert_frame_equal(matrix_frame(matrix), expected, check_dtype=False, check_index_type=False)
+
+
+@pytest.mark.parametrize("dense_pairs", (0, 1 << 22))
+def test_dense_matrix(dense_pairs):
+    with patch("src.core.communication.DENSE_PAIRS", dense_pairs):
+        matrix = comm_matrix(comms, "thread")
+    participants = [tuple(participant) for participant in matrix.participants]
+    assert participants == [(1, 1, 1), (1, 1, 2), (1, 2, 1), (1, 2, 3), (1, 70000, 1)]
+    counts = matrix.dense()
+    assert counts.shape == (5, 5) and counts.sum() == 7
+    assert counts[1, 2] == 1 and counts[2, 0] == 2 and counts[0, 2] == 1
+    assert matrix.dense("bytes")[2, 0] == 900
+    latency = matrix.dense("mean_latency")
+    assert latency[2, 0] == 5.5 and np.isnan(latency[0, 1])
+
+
+def test_merge_matrices():
+    parts = [comm_matrix(comms.iloc[:3], "thread"), comm_matrix(comms.iloc[3:], "thread")]
+    merged = merge_matrices(parts)
+    pd.testing.assert_frame_equal(matrix_frame(merged), matrix_frame(comm_matrix(comms, "thread")))
+    assert merge_matrices([]).counts.size == 0
+
+
+def test_unknown_granularity():
+    with pytest.raises(Exception, match="Cannot aggregate messages by node"):
+        comm_matrix(comms, "node")
+
+
+def test_trace_comm_matrix(tmp_path):
+    hdf_file = str(tmp_path / "tiny.hdf")
+    Writer().records_to_hdf5(hdf_file, ParaverToHDF5().iter_records(tiny_trace))
+    metadata = TraceMetaData(name="tiny.hdf", path=hdf_file, layout_version=LAYOUT_VERSION)
+    trace = Trace(metadata, *HDF5Reader().parse_records(hdf_file, use_dask=True))
+    df_comm = trace.df_comm.compute()
+    for granularity in ("task", "thread"):
+        matrix = trace_comm_matrix(trace, granularity)
+        expected = expected_matrix(df_comm, granularity)
+        pd.testing.assert_frame_equal(matrix_frame(matrix), expected, check_dtype=False, check_index_type=False)
+    assert trace_comm_matrix(trace, start=0, end=0).counts.size == 0
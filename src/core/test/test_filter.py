@@ -1,5 +1,5 @@
 import logging
-from unittest.mock import Mock
+from unittest.mock import Mock, PropertyMock, patch
 
 import dask.dataframe as dd
 import numpy as np
@@ -8,6 +8,8 @@ import pytest
 
 from src.CONST import Record
 from src.core.filter import Filter
+from src.core.time_window import SORTED_BY, is_sorted_by, tag_sorted
+from src.persistence.event_index import EVENT_INDEX_ATTR
 
 logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -165,3 +167,123 @@ def test_filter_from_to_another(df, attribute, start_value, end_value, expected_
     filter_util = filter_util.add_operator(df, attribute, "from_to", start_value, end_value)
     result = filter_util.execute(df).compute()
     assert np.array_equal(result, expected_df)
+
+
+@pytest.fixture(scope="module")
+def hdf_trace(tmp_path_factory):
+    from src.persistence.prv_to_hdf5 import ParaverToHDF5
+    from src.persistence.writer import Writer
+
+    hdf_file = str(tmp_path_factory.mktemp("filter") / "tiny.hdf")
+    with patch("src.persistence.writer.CHUNK_ROWS", 8):
+        Writer().records_to_hdf5(hdf_file, ParaverToHDF5().iter_records("src/persistence/test/test_files/traces/tiny.test.prv"))
+    return hdf_file
+
+
+def test_sorted_tag_checked_once():
+    df = pd.DataFrame(np.array([[0, 3, 0], [0, 1, 1], [1, 2, 2], [0, 0, 3]]), columns=columns)
+    assert not is_sorted_by(tag_sorted(df.iloc[::-1].copy(), "time"), "time")
+    tag_sorted(df, "time")
+    with patch.object(pd.Series, "is_monotonic_increasing", new_callable=PropertyMock) as is_monotonic:
+        filter_util = Filter().add_operator(df, Record.time, ">=", 1).add_operator(df, Record.time, "<", 3)
+    # The column is not compared again on every operator
+    is_monotonic.assert_not_called()
+    assert filter_util.row_range == (1, 3)
+
+
+@pytest.mark.parametrize(
+    "attributes,operators,args",
+    (
+        ((Record.event_t,), ("==",), (50000001,)),
+        ((Record.event_t,), ("in",), ([50000001, 60000019],)),
+        ((Record.time,), ("from_to",), ((400000, 900000),)),
+        ((Record.time, Record.event_t), ("from_to", "!="), ((1, 900000), 0)),
+        ((Record.time, Record.event_v), (">=", "<"), (900000, 5)),
+        ((Record.time,), ("<",), (0,)),
+        ((Record.event_t,), ("in",), ([],)),
+    ),
+)
+def test_filter_push_down(hdf_trace, attributes, operators, args):
+    from src.persistence.hdf5_reader import HDF5Reader
+
+    _, events, _ = HDF5Reader().parse_tables(hdf_trace)
+    df = HDF5Reader().parse_records(hdf_trace)[1]
+    lazy_filter, filter_util = Filter(), Filter()
+    for attribute, operator, arg in zip(attributes, operators, args):
+        arg = arg if operator == "from_to" else (arg,)
+        lazy_filter = lazy_filter.add_operator(events, attribute, operator, *arg)
+        filter_util = filter_util.add_operator(df, attribute, operator, *arg)
+    result = lazy_filter.execute(events)
+    expected = filter_util.execute(df)
+    assert result.dtypes.equals(expected.dtypes)
+    assert np.array_equal(result.values, expected.values)
+    assert np.array_equal(result.index, expected.index)
+
+
+@pytest.mark.parametrize(
+    "operators,args",
+    (
+        (("from_to",), ((1, 3),)),
+        (("from_to",), ((None, 3),)),
+        (("from_to",), ((2, None),)),
+        ((">", "<="), ((1,), (3,))),
+        ((">=", "<", "!="), ((1,), (4,), (2,))),
+        (("<", ">"), ((1,), (3,))),
+    ),
+)
+def test_filter_sorted_time(operators, args):
+    df = pd.DataFrame(np.array([[0, 0, 0], [0, 1, 1], [1, 2, 1], [0, 1, 2], [1, 2, 3], [1, 2, 5]]), columns=columns)
+    sorted_df = tag_sorted(df.copy(), "time")
+    filter_util, sorted_filter = Filter(), Filter()
+    for operator, arg in zip(operators, args):
+        attribute = Record.event_t if operator == "!=" else Record.time
+        filter_util = filter_util.add_operator(df, attribute, operator, *arg)
+        sorted_filter = sorted_filter.add_operator(sorted_df, attribute, operator, *arg)
+    assert sorted_filter.row_range is not None
+    assert sorted_filter.execute(sorted_df).equals(filter_util.execute(df))
+
+
+@pytest.mark.parametrize(
+    "derive", (lambda df: df.sort_values("event_t"), lambda df: pd.concat([df, df]), lambda df: df.sample(frac=1))
+)
+def test_filter_reordered_sorted_time(derive):
+    df = pd.DataFrame(np.array([[0, 3, 0], [0, 1, 1], [1, 2, 2], [0, 0, 3], [1, 4, 4], [1, 5, 5]]), columns=columns)
+    tag_sorted(df, "time")
+    derived = derive(df).iloc[::-1]
+    # The frames derived from a sorted one keep its attrs, but not the frame they were checked on
+    assert derived.attrs[SORTED_BY] == "time" and not is_sorted_by(derived, "time")
+    filter_util = Filter().add_operator(derived, Record.time, "<", 3)
+    assert filter_util.row_range is None
+    assert filter_util.execute(derived).equals(derived.loc[derived["time"] < 3])
+
+
+@pytest.mark.parametrize(
+    "attributes,operators,args",
+    (
+        ((Record.event_t,), ("==",), (50000001,)),
+        ((Record.event_t, Record.event_t), ("in", "in"), ([50000001, 60000019], [60000019, 1])),
+        ((Record.time, Record.event_t, Record.event_v), ("from_to", "in", "!="), ((1, 900000), [50000001], 0)),
+        ((Record.event_t,), ("in",), ([-1],)),
+    ),
+)
+def test_filter_event_index(hdf_trace, attributes, operators, args):
+    from src.persistence.hdf5_reader import HDF5Reader
+
+    df = HDF5Reader().parse_records(hdf_trace)[1]
+    unindexed = df.copy()
+    unindexed.attrs = {}
+    filter_util, indexed_filter = Filter(), Filter()
+    for attribute, operator, arg in zip(attributes, operators, args):
+        arg = arg if operator == "from_to" else (arg,)
+        filter_util = filter_util.add_operator(unindexed, attribute, operator, *arg)
+        indexed_filter = indexed_filter.add_operator(df, attribute, operator, *arg)
+    assert indexed_filter.positions is not None
+    assert indexed_filter.execute(df).equals(filter_util.execute(unindexed))
+    # A slice of the Events doesn't match the index anymore
+    assert Filter().add_operator(df.iloc[1:], Record.event_t, "in", [50000001]).positions is None
+    # Nor a reordered copy with the same shape and index
+    reordered = df.sort_values("event_v").reset_index(drop=True)
+    assert EVENT_INDEX_ATTR in reordered.attrs
+    reordered_filter = Filter().add_operator(reordered, Record.event_t, "in", [50000001])
+    assert reordered_filter.positions is None
+    assert reordered_filter.execute(reordered).equals(reordered.loc[reordered["event_t"] == 50000001])
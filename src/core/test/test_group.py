@@ -0,0 +1,83 @@
+import logging
+from unittest.mock import patch
+
+import dask.dataframe as dd
+import pandas as pd
+import pytest
+
+from src.CONST import Record
+from src.core.group import AGGREGATIONS, Group
+from src.persistence import hdf5_reader
+from src.persistence.hdf5_reader import HDF5Reader, HDF5Table
+from src.persistence.prv_to_hdf5 import ParaverToHDF5
+from src.persistence.writer import Writer
+
+logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+tiny_trace = "src/persistence/test/test_files/traces/tiny.test.prv"
+
+
+@pytest.fixture(scope="module")
+def partitioned_trace(tmp_path_factory):
+    hdf_file = str(tmp_path_factory.mktemp("group") / "tiny.hdf")
+    Writer(partition_threads=True).records_to_hdf5(hdf_file, ParaverToHDF5().iter_records(tiny_trace))
+    return hdf_file
+
+
+@pytest.mark.parametrize("func", AGGREGATIONS)
+@pytest.mark.parametrize("attribute", (Record.cpu_id, Record.task_id, Record.thread_id))
+@pytest.mark.parametrize("source", ("pandas", "dask", "table"))
+def test_aggregate(partitioned_trace, func, attribute, source):
+    states = HDF5Reader().parse_table(partitioned_trace, "States")
+    df = {
+        "pandas": states,
+        "dask": dd.from_pandas(states, npartitions=3),
+        "table": HDF5Table(partitioned_trace, "States"),
+    }[source]
+    result = Group().aggregate(df, attribute, "time_fi", func)
+    expected = states.groupby(attribute.name)["time_fi"].agg(func)
+    pd.testing.assert_series_equal(result, expected, check_dtype=False)
+
+
+def test_aggregate_checks_arguments():
+    states = pd.DataFrame({"thread_id": [1], "time_fi": [2]})
+    with pytest.raises(Exception):
+        Group().aggregate(states, Record.time_fi, "time_fi")
+    with pytest.raises(Exception):
+        Group().aggregate(states, Record.thread_id, "time_fi", "median")
+
+
+@pytest.mark.parametrize("key", ("States", "Comm"))
+def test_thread(partitioned_trace, key):
+    df = HDF5Reader().parse_table(partitioned_trace, key)
+    for thread in ((1, 1, 2), (1, 2, 1), (9, 9, 9)):
+        expected = Group().thread(df, *thread)
+        assert Group().thread(HDF5Table(partitioned_trace, key), *thread).equals(expected)
+        assert Group().thread(dd.from_pandas(df, npartitions=2), *thread).compute().equals(expected)
+
+
+@pytest.mark.parametrize("key", ("States", "Comm"))
+def test_thread_reads_its_partitions(partitioned_trace, key):
+    df = HDF5Reader().parse_table(partitioned_trace, key)
+    table = HDF5Table(partitioned_trace, key)
+    read_rows = hdf5_reader._read_rows
+    for thread in ((1, 1, 2), (1, 2, 1), (9, 9, 9)):
+        reads = []
+
+        def count_reads(rows, *args, **kwargs):
+            reads.append(rows)
+            return read_rows(rows, *args, **kwargs)
+
+        # Partitions of at most 4 rows
+        with patch("src.persistence.hdf5_reader.READ_ROWS", 4), patch(
+            "src.persistence.hdf5_reader._read_rows", count_reads
+        ):
+            partitioned = HDF5Reader().parse_table(partitioned_trace, key, use_dask=True)
+            selected = Group().thread(partitioned, *thread).compute()
+        assert selected.equals(Group().thread(df, *thread))
+        # Only the partitions with the rows of the thread
+        start, stop = table.thread_rows(*thread)
+        bounds = list(partitioned.divisions[:-1]) + [len(df)]
+        read = sum(1 for low, high in zip(bounds[:-1], bounds[1:]) if low < stop and start < high)
+        assert partitioned.npartitions > 1 and len(reads) == read
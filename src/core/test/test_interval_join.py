@@ -0,0 +1,143 @@
+import logging
+
+import dask.dataframe as dd
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.core.interval_join import NO_STATE, counter_deltas, join_states, trace_counter_deltas
+from src.persistence.hdf5_reader import HDF5Reader
+from src.persistence.prv_to_hdf5 import ParaverToHDF5
+from src.persistence.writer import LAYOUT_VERSION, Writer
+from src.Trace import Trace, TraceMetaData
+
+logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+tiny_trace = "src/persistence/test/test_files/traces/tiny.test.prv"
+
+rng = np.random.default_rng(7)
+threads = [(1, 1, 1), (1, 1, 2), (1, 70000, 1)]
+
+
+def random_states():
+    rows = []
+    for appl, task, thread in threads:
+        bounds = np.sort(rng.choice(np.arange(0, 1000), size=40, replace=False))
+        for time_ini, time_fi in zip(bounds[:-1:2], bounds[1::2]):
+            rows.append((1, appl, task, thread, time_ini, time_fi, rng.integers(1, 4)))
+    rows.append((1, 1, 1, 1, 500, 500, 9))
+    df = pd.DataFrame(rows, columns=["cpu_id", "appl_id", "task_id", "thread_id", "time_ini", "time_fi", "state"])
+    df = df.sort_values("time_ini", kind="stable").reset_index(drop=True)
+    # Row numbers as in a converted trace
+    df.index = df.index + 100
+    return df
+
+
+def random_events(n=300):
+    thread = rng.integers(0, len(threads), n)
+    return pd.DataFrame(
+        {
+            "cpu_id": 1,
+            "appl_id": [threads[i][0] for i in thread],
+            "task_id": [threads[i][1] for i in thread],
+            "thread_id": [threads[i][2] for i in thread] + np.array(rng.integers(0, 2, n) * 10),
+            "time": np.sort(rng.integers(0, 1100, n)),
+            "event_t": rng.choice([42000050, 42000059, 50000001], n),
+            "event_v": rng.integers(0, 100, n),
+        }
+    )
+
+
+states, events = random_states(), random_events()
+
+
+def expected_join(df_event, df_state):
+    state_index, state = [], []
+    for event in df_event.itertuples():
+        enclosing = df_state[
+            (df_state["appl_id"] == event.appl_id)
+            & (df_state["task_id"] == event.task_id)
+            & (df_state["thread_id"] == event.thread_id)
+            & (df_state["time_ini"] <= event.time)
+            & (df_state["time_fi"] > event.time)
+        ]
+        state_index.append(enclosing.index[-1] if enclosing.shape[0] > 0 else NO_STATE)
+        state.append(enclosing["state"].iloc[-1] if enclosing.shape[0] > 0 else NO_STATE)
+    return np.array(state_index), np.array(state)
+
+
+@pytest.mark.parametrize("use_dask", (False, True))
+@pytest.mark.parametrize("is_sorted", (False, True))
+def test_join_states(use_dask, is_sorted):
+    df_event = dd.from_pandas(events, npartitions=4) if use_dask else events
+    df_state = dd.from_pandas(states, npartitions=3) if use_dask else states
+    joined = join_states(df_event, df_state, is_sorted)
+    state_index, state = expected_join(events, states)
+    assert joined.shape[0] == events.shape[0] and (state_index != NO_STATE).sum() > 0
+    assert np.array_equal(joined["state_index"].to_numpy(), state_index)
+    assert np.array_equal(joined["state"].to_numpy(), state)
+    pd.testing.assert_frame_equal(joined[events.columns], events)
+
+
+def test_join_with_time_ranks():
+    # (thread, time) keys that don't fit in int64
+    huge = events.assign(time=events["time"] * 2**52)
+    huge_states = states.assign(time_ini=states["time_ini"] * 2**52, time_fi=states["time_fi"] * 2**52)
+    joined = join_states(huge, huge_states)
+    assert np.array_equal(joined["state_index"].to_numpy(), expected_join(events, states)[0])
+
+
+@pytest.mark.parametrize("types", (None, [42000050]))
+@pytest.mark.parametrize("use_dask", (False, True))
+def test_counter_deltas(types, use_dask):
+    df_event = dd.from_pandas(events, npartitions=4) if use_dask else events
+    deltas = counter_deltas(df_event, states, types)
+    joined = events.assign(state_index=expected_join(events, states)[0])
+    joined = joined[joined["state_index"] != NO_STATE]
+    if types is not None:
+        joined = joined[joined["event_t"].isin(types)]
+    expected = joined.pivot_table(index="state_index", columns="event_t", values="event_v", aggfunc="sum", fill_value=0)
+    pd.testing.assert_frame_equal(deltas, expected, check_dtype=False, check_names=False, check_column_type=False)
+
+
+def test_trace_counter_deltas(tmp_path):
+    hdf_file = str(tmp_path / "tiny.hdf")
+    Writer().records_to_hdf5(hdf_file, ParaverToHDF5().iter_records(tiny_trace))
+    metadata = TraceMetaData(name="tiny.hdf", path=hdf_file, layout_version=LAYOUT_VERSION)
+    trace = Trace(metadata, *HDF5Reader().parse_records(hdf_file, use_dask=True))
+    df_state, df_event = trace.df_state.compute(), trace.df_event.compute()
+    deltas = trace_counter_deltas(trace, [42000050])
+    assert list(deltas.columns) == [42000050]
+    state_index, _ = expected_join(df_event, df_state)
+    counters = df_event.assign(state_index=state_index)
+    counters = counters[(counters["state_index"] != NO_STATE) & (counters["event_t"] == 42000050)]
+    assert deltas[42000050].to_dict() == counters.groupby("state_index")["event_v"].sum().to_dict()
+    window = trace_counter_deltas(trace, [42000050], 300000, 700000)
+    assert set(window.index) <= set(deltas.index) and window.shape[0] < deltas.shape[0]
+
+
+@pytest.mark.parametrize("backwards", (False, True))
+def test_join_reads_each_state_partition_once(backwards):
+    reads = []
+
+    def read_states(rows):
+        reads.append(rows)
+        return states.iloc[rows[0]: rows[1]]
+
+    ranges = [(low, min(low + 8, states.shape[0])) for low in range(0, states.shape[0], 8)]
+    df_state = dd.from_map(read_states, ranges, meta=states.iloc[:0])
+    chunks = [events.iloc[low: low + 30] for low in range(0, events.shape[0], 30)]
+    # Windows that go back in time read the partitions again
+    chunks = chunks[::-1] if backwards else chunks
+    df_event = dd.from_map(lambda chunk: chunk, chunks, meta=events.iloc[:0])
+    # Stored with the States of a converted trace
+    longest = int((states["time_fi"] - states["time_ini"]).max())
+    joined = join_states(df_event, df_state, is_sorted=True, longest=longest)
+    expected = pd.concat([chunk.assign(state_index=expected_join(chunk, states)[0]) for chunk in chunks])
+    assert np.array_equal(joined["state_index"].to_numpy(), expected["state_index"].to_numpy())
+    # Instead of reading every partition of the States for each partition of the Events
+    if backwards:
+        assert len(reads) < len(chunks) * len(ranges)
+    else:
+        assert sorted(reads) == ranges
@@ -0,0 +1,90 @@
+import logging
+import shutil
+
+import dask.dataframe as dd
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.core.intervals import INTERVALS, IntervalBuilder, event_intervals, pairable_types, trace_intervals
+from src.persistence.controller import parse_trace
+from src.persistence.prv_reader import ParaverReader
+
+logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+tiny_trace = "src/persistence/test/test_files/traces/tiny.test.prv"
+
+MPI, USER, COUNTER = 50000001, 60000019, 42000050
+
+# Thread 1.1.1: an MPI call inside two nested user functions, an exit without entry and a counter.
+# Thread 1.2.1: an MPI call never closed
+events = pd.DataFrame(
+    [
+        (1, 1, 1, 0, USER, 3),
+        (1, 1, 1, 5, USER, 4),
+        (1, 1, 1, 5, COUNTER, 100),
+        (1, 2, 1, 6, MPI, 10),
+        (1, 1, 1, 10, MPI, 1),
+        (1, 1, 1, 12, MPI, 0),
+        (1, 1, 1, 12, MPI, 0),
+        (1, 1, 1, 20, USER, 0),
+        (1, 1, 1, 20, COUNTER, 300),
+        (1, 1, 1, 30, USER, 0),
+        (1, 1, 1, 35, MPI, 2),
+        (1, 1, 1, 40, MPI, 0),
+    ],
+    columns=["appl_id", "task_id", "thread_id", "time", "event_t", "event_v"],
+)
+events.insert(0, "cpu_id", 1)
+
+expected = pd.DataFrame(
+    [
+        (1, 1, 1, USER, 3, 0, 30, 0),
+        (1, 1, 1, USER, 4, 5, 20, 1),
+        (1, 2, 1, MPI, 10, 6, 40, 0),
+        (1, 1, 1, MPI, 1, 10, 12, 0),
+        (1, 1, 1, MPI, 2, 35, 40, 0),
+    ],
+    columns=["appl_id", "task_id", "thread_id", "event_t", "event_v", "time_ini", "time_fi", "depth"],
+)
+
+
+def as_tuples(df):
+    return sorted(map(tuple, df[list(expected.columns)].to_numpy().tolist()))
+
+
+def test_pairable_types():
+    assert pairable_types(events).tolist() == [MPI, USER]
+
+
+@pytest.mark.parametrize("use_dask", (False, True))
+def test_event_intervals(use_dask):
+    df = dd.from_pandas(events, npartitions=4) if use_dask else events
+    intervals = event_intervals(df)
+    assert as_tuples(intervals) == as_tuples(expected)
+    assert intervals["time_ini"].is_monotonic_increasing
+    closed_at = event_intervals(df, end=100)
+    assert closed_at.loc[closed_at["task_id"] == 2, "time_fi"].tolist() == [100]
+    assert event_intervals(df, types=[USER]).shape[0] == 2
+
+
+def test_builder_carries_open_entries():
+    builder = IntervalBuilder([MPI, USER])
+    parts = [builder.add(events.iloc[start: start + 1]) for start in range(events.shape[0])]
+    assert sum(part.shape[0] for part in parts) == 4
+    parts.append(builder.close())
+    assert as_tuples(pd.concat(parts)) == as_tuples(expected)
+    assert event_intervals(pd.DataFrame([])).shape == (0, len(expected.columns))
+
+
+@pytest.mark.parametrize("storage", ("hdf", "parquet", "arrow"))
+def test_intervals_are_persisted(tmp_path, storage):
+    shutil.copy(tiny_trace, tmp_path / "tiny.prv")
+    metadata = ParaverReader().convert(str(tmp_path / "tiny.prv"), storage=storage)
+    trace = parse_trace(metadata.path)
+    stored = trace.read(INTERVALS).compute()
+    computed = event_intervals(trace.df_event.compute())
+    assert stored.shape[0] > 0 and as_tuples(stored) == as_tuples(computed)
+    assert np.all(stored["time_fi"].to_numpy() >= stored["time_ini"].to_numpy())
+    assert as_tuples(trace_intervals(trace).compute()) == as_tuples(computed)
@@ -0,0 +1,111 @@
+import logging
+import time
+from unittest.mock import Mock, patch
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.CONST import Record
+from src.core import filter as filter_module
+from src.core.filter import Filter
+from src.core.mask_cache import MaskCache, freeze
+
+logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+columns = ["cpu_id", "event_t", "time"]
+df = pd.DataFrame(np.array([[0, 0, 0], [0, 1, 2], [1, 2, 3], [1, 1, 4], [0, 2, 5]]), columns=columns)
+
+
+@pytest.mark.parametrize("mask", ([True, False, False, True, True] * 7, [False] * 1000 + [True], [False] * 3, []))
+def test_mask_cache_round_trip(mask):
+    cache = MaskCache()
+    mask = np.array(mask, dtype=bool)
+    cache.put(("trace", "Events", 1), mask)
+    assert np.array_equal(cache.get(("trace", "Events", 1), mask.size), mask)
+    assert cache.get(("trace", "Events", 1), mask.size + 1) is None
+    assert cache.nbytes <= max(1, (mask.size + 7) // 8)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_mask_cache_eviction():
+    cache = MaskCache(max_bytes=24)
+    for i in range(4):
+        cache.put(("trace", "Events", i), np.ones(80, dtype=bool))
+    assert len(cache) == 2 and cache.nbytes == 20 and cache.evictions == 2
+    assert ("trace", "Events", 0) not in cache and ("trace", "Events", 3) in cache
+    # Using a mask makes it the most recently used
+    cache.get(("trace", "Events", 2), 80)
+    cache.put(("trace", "Events", 4), np.ones(80, dtype=bool))
+    assert ("trace", "Events", 2) in cache and ("trace", "Events", 3) not in cache
+    # Masks bigger than the whole budget are not cached
+    cache.put(("trace", "Events", 5), np.ones(800, dtype=bool))
+    assert ("trace", "Events", 5) not in cache
+
+
+def test_mask_cache_invalidate():
+    cache = MaskCache()
+    cache.put(("a", "Events", 1), np.ones(8, dtype=bool))
+    cache.put(("a", "States", 1), np.ones(8, dtype=bool))
+    cache.put(("b", "Events", 1), np.ones(8, dtype=bool))
+    assert cache.invalidate("a") == 2
+    assert len(cache) == 1 and cache.nbytes == 1
+
+
+def test_freeze():
+    assert freeze(([1, np.int64(2)], {3, 1})) == ((1, 2), (1, 3))
+    assert hash(freeze((np.array([1, 2]),)))
+
+
+def test_filter_reuses_cached_masks():
+    cache = MaskCache()
+    expected = Filter().add_operator(df, Record.event_t, "in", [1, 2]).add_operator(df, Record.time, ">", 2)
+    expected = expected.execute(df)
+    with patch.dict(Filter._operator_function, {"in": Mock(wraps=filter_module._filter_contains)}) as functions:
+        for _ in range(2):
+            filter_util = Filter(cache, ("trace", "Events"))
+            filter_util.add_operator(df, Record.event_t, "in", [1, 2]).add_operator(df, Record.time, ">", 2)
+            assert filter_util.execute(df).equals(expected)
+        assert functions["in"].call_count == 1
+    # Three masks: both operators and their combination, found in any order
+    assert len(cache) == 3
+    hits = cache.hits
+    filter_util = Filter(cache, ("trace", "Events")).add_operator(df, Record.time, ">", 2)
+    assert filter_util.add_operator(df, Record.event_t, "in", (2, 1)).execute(df).equals(expected)
+    assert cache.hits == hits + 2
+    assert cache.invalidate("trace") == 3
+
+
+def test_filter_tells_row_subsets_apart():
+    cache = MaskCache()
+    # Two windows of the same size of the same table
+    first, second = df.iloc[:2], df.iloc[2:4]
+    for window in (first, second, first.reset_index(drop=True).set_axis([7, 3])):
+        filter_util = Filter(cache, ("trace", "Events")).add_operator(window, Record.event_t, "==", 1)
+        assert filter_util.execute(window).equals(window.loc[window["event_t"] == 1])
+    assert len(cache) == 3 and cache.hits == 0
+
+
+def test_cache_hit_cheaper_than_mask():
+    cache = MaskCache()
+    rows = 2000000
+    rng = np.random.default_rng(0)
+    # Rows selected from a table, not numbered by a RangeIndex
+    events = pd.DataFrame({"event_t": rng.integers(0, 1000000, rows)}, index=np.arange(rows) * 2)
+    values = list(range(0, 1000000, 10000))
+    Filter(cache, ("trace", "Events")).add_operator(events, Record.event_t, "in", values)
+
+    def best_of(function):
+        times = []
+        for _ in range(5):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    with patch("src.core.mask_cache.pd.util.hash_array", wraps=pd.util.hash_array) as hash_array:
+        hit = best_of(lambda: Filter(cache, ("trace", "Events")).add_operator(events, Record.event_t, "in", values))
+    # The index is hashed once, not on every hit
+    assert hash_array.call_count == 0 and cache.hits == 5
+    assert hit < best_of(lambda: filter_module._filter_contains(events, "event_t", values))
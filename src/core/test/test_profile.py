@@ -0,0 +1,113 @@
+import logging
+
+import dask.dataframe as dd
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.CONST import STATE_NAMES
+from src.core.controller import get_table_data
+from src.core.mask_cache import MASK_CACHE
+from src.core.profile import drop_profiles, merge_profiles, state_profile, trace_profile
+from src.persistence.hdf5_reader import HDF5Reader
+from src.persistence.prv_to_hdf5 import ParaverToHDF5
+from src.persistence.writer import LAYOUT_VERSION, Writer
+from src.Trace import Trace, TraceMetaData
+
+logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+tiny_trace = "src/persistence/test/test_files/traces/tiny.test.prv"
+
+states = pd.DataFrame(
+    {
+        "appl_id": [1, 1, 1, 1, 1, 1],
+        "task_id": [1, 1, 2, 2, 1, 70000],
+        "thread_id": [1, 2, 1, 1, 1, 3],
+        "time_ini": [0, 0, 0, 10, 10, 5],
+        "time_fi": [10, 30, 10, 40, 20, 15],
+        "state": [1, 1, 3, 1, 3, 1],
+    }
+)
+
+
+def expected_profile(df, start=None, end=None):
+    df = df.copy()
+    df["time_ini"] = df["time_ini"].clip(lower=start)
+    df["time_fi"] = df["time_fi"].clip(upper=end)
+    df["duration"] = (df["time_fi"] - df["time_ini"]).clip(lower=0)
+    return df.groupby(["appl_id", "task_id", "thread_id", "state"])["duration"].sum()
+
+
+def profile_series(profile):
+    index = pd.MultiIndex.from_tuples(
+        [(*thread, state) for thread in profile.threads.tolist() for state in profile.states.tolist()],
+        names=["appl_id", "task_id", "thread_id", "state"],
+    )
+    series = pd.Series(profile.durations.ravel(), index=index, name="duration")
+    return series[series > 0]
+
+
+@pytest.mark.parametrize("start,end", ((None, None), (5, 25), (12, None), (None, 8), (50, 60)))
+@pytest.mark.parametrize("use_dask", (False, True))
+def test_state_profile(start, end, use_dask):
+    df = dd.from_pandas(states, npartitions=3) if use_dask else states
+    profile = state_profile(df, start, end)
+    expected = expected_profile(states, start, end)
+    assert profile_series(profile).equals(expected[expected > 0])
+
+
+def test_profile_percentages():
+    profile = state_profile(states)
+    percentages = profile.percentages()
+    assert np.allclose(percentages.sum(axis=1), 100)
+    # Thread 1.2.1: 10 ns in state 3 and 30 ns in state 1
+    row = profile.threads.tolist().index([1, 2, 1])
+    assert percentages[row].tolist() == [75.0, 25.0]
+
+
+def test_merge_profiles():
+    profile = merge_profiles([state_profile(states.iloc[:2]), state_profile(states.iloc[2:]), state_profile(states[:0])])
+    assert profile_series(profile).equals(profile_series(state_profile(states)))
+
+
+@pytest.mark.parametrize("start,end", ((None, None), (300000, 700000)))
+def test_trace_profile(tmp_path, start, end):
+    hdf_file = str(tmp_path / "tiny.hdf")
+    Writer().records_to_hdf5(hdf_file, ParaverToHDF5().iter_records(tiny_trace))
+    metadata = TraceMetaData(name="tiny.hdf", path=hdf_file, layout_version=LAYOUT_VERSION)
+    trace = Trace(metadata, *HDF5Reader().parse_records(hdf_file, use_dask=True))
+    profile = trace_profile(trace, start, end)
+    expected = expected_profile(trace.df_state.compute(), start, end)
+    assert profile_series(profile).equals(expected[expected > 0])
+    assert trace_profile(trace, start, end) is profile
+
+    cols_header, table_data, min_value, max_value = get_table_data(trace, start, end)
+    assert cols_header == [STATE_NAMES[state] for state in profile.states]
+    assert len(table_data) == profile.threads.shape[0]
+    assert table_data[0][0] == "Thread 1.1.1"
+    assert 0 <= min_value <= max_value <= 100
+    assert drop_profiles("tiny.hdf") == 1
+
+
+def test_unsorted_trace_profile(tmp_path):
+    traces = []
+    for partition_threads in (False, True):
+        hdf_file = str(tmp_path / f"tiny_{partition_threads}.hdf")
+        Writer(partition_threads).records_to_hdf5(hdf_file, ParaverToHDF5().iter_records(tiny_trace))
+        name = f"tiny_{partition_threads}.hdf"
+        metadata = TraceMetaData(name, hdf_file, layout_version=LAYOUT_VERSION, partitioned=partition_threads)
+        traces.append(Trace(metadata, *HDF5Reader().parse_records(hdf_file, use_dask=True)))
+    sorted_trace, unsorted_trace = traces
+    assert not unsorted_trace.is_sorted
+    MASK_CACHE.invalidate(unsorted_trace.metadata.name)
+    hits = MASK_CACHE.hits
+    for start, end in ((300000, 700000), (400000, 700000), (None, 500000), (500000, None)):
+        profile, expected = trace_profile(unsorted_trace, start, end), trace_profile(sorted_trace, start, end)
+        assert np.array_equal(profile.threads, expected.threads) and np.array_equal(profile.states, expected.states)
+        assert np.array_equal(profile.durations, expected.durations)
+    # The time_ini < 700000 mask of the first window was reused by the second one
+    assert MASK_CACHE.hits > hits
+    assert MASK_CACHE.invalidate(unsorted_trace.metadata.name) > 0
+    drop_profiles(sorted_trace.metadata.name)
+    drop_profiles(unsorted_trace.metadata.name)
@@ -0,0 +1,106 @@
+import logging
+from unittest.mock import patch
+
+import dask.dataframe as dd
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.core.time_window import MAX_DURATION, SORTED_BY, is_sorted_by, max_duration, sorted_range, state_window, window
+from src.persistence.hdf5_reader import HDF5Reader
+from src.persistence.prv_to_hdf5 import ParaverToHDF5
+from src.persistence.writer import LAYOUT_VERSION, Writer
+from src.Trace import Trace, TraceMetaData
+
+logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+tiny_trace = "src/persistence/test/test_files/traces/tiny.test.prv"
+
+states = pd.DataFrame(
+    {"thread_id": [1, 2, 1, 2, 1], "time_ini": [0, 5, 10, 10, 30], "time_fi": [10, 40, 30, 12, 30], "state": 1}
+)
+
+
+@pytest.mark.parametrize(
+    "values,start,end,include_end,expected",
+    (
+        ([0, 1, 1, 2, 5], 1, 2, False, (1, 3)),
+        ([0, 1, 1, 2, 5], 1, 2, True, (1, 4)),
+        ([0, 1, 1, 2, 5], None, 1, False, (0, 1)),
+        ([0, 1, 1, 2, 5], 3, None, False, (4, 5)),
+        ([0, 1, 1, 2, 5], 3, 1, False, (4, 4)),
+        ([], 3, 4, False, (0, 0)),
+    ),
+)
+def test_sorted_range(values, start, end, include_end, expected):
+    assert sorted_range(np.array(values), start, end, include_end) == expected
+
+
+@pytest.mark.parametrize(
+    "start,end,expected",
+    ((11, 20, [1, 2, 3]), (0, 5, [0]), (12, 30, [1, 2]), (30, 31, [1, 4]), (None, 10, [0, 1]), (41, None, [])),
+)
+@pytest.mark.parametrize("use_dask", (False, True))
+@pytest.mark.parametrize("is_sorted", (False, True))
+def test_state_window(start, end, expected, use_dask, is_sorted):
+    df = dd.from_pandas(states, npartitions=2) if use_dask else states
+    result = state_window(df, start, end, is_sorted=is_sorted)
+    result = result.compute() if use_dask else result
+    assert list(result.index) == expected
+
+
+@pytest.mark.parametrize("use_dask", (False, True))
+def test_max_duration(use_dask):
+    df = dd.from_pandas(states, npartitions=2) if use_dask else states
+    assert max_duration(df) == 35
+    assert max_duration(df.loc[df["time_ini"] > 100]) == 0
+
+
+def _tiny_trace(tmp_path, use_dask):
+    hdf_file = str(tmp_path / "tiny.hdf")
+    with patch("src.persistence.writer.CHUNK_ROWS", 8):
+        Writer().records_to_hdf5(hdf_file, ParaverToHDF5().iter_records(tiny_trace))
+    return Trace(TraceMetaData(layout_version=LAYOUT_VERSION), *HDF5Reader().parse_records(hdf_file, use_dask))
+
+
+@pytest.mark.parametrize("start,end", ((400000, 900000), (None, 200000), (900000, None), (0, 1)))
+@pytest.mark.parametrize("use_dask", (False, True))
+def test_trace_time_window(tmp_path, start, end, use_dask):
+    trace = _tiny_trace(tmp_path, use_dask)
+    unsorted = Trace(TraceMetaData(), trace.df_state, trace.df_event, trace.df_comm)
+    result, expected = trace.time_window(start, end), unsorted.time_window(start, end)
+    for df, expected_df in (
+        (result.df_state, expected.df_state),
+        (result.df_event, expected.df_event),
+        (result.df_comm, expected.df_comm),
+    ):
+        if use_dask:
+            df, expected_df = df.compute(), expected_df.compute()
+        assert np.array_equal(df.values, expected_df.values)
+    assert result._max_state_duration == trace._max_state_duration == max_duration(trace.df_state)
+    events = trace.df_event.compute() if use_dask else trace.df_event
+    selected = trace.time_window(start, end).df_event
+    selected = selected.compute() if use_dask else selected
+    low = -np.inf if start is None else start
+    high = np.inf if end is None else end
+    assert selected.shape[0] == ((events["time"] >= low) & (events["time"] < high)).sum()
+
+
+def test_window_of_empty_table():
+    df = dd.from_array(np.array([[]]))
+    assert window(df, "time", 0, 1) is df
+    assert state_window(df, 0, 1) is df
+
+
+def test_sorted_by_attr(tmp_path):
+    trace = _tiny_trace(tmp_path, False)
+    assert trace.df_state.attrs[SORTED_BY] == "time_ini"
+    assert trace.df_event.attrs[SORTED_BY] == "time"
+    assert trace.df_comm.attrs[SORTED_BY] == "lsend"
+    assert is_sorted_by(trace.df_state, "time_ini") and is_sorted_by(trace.df_event, "time")
+    # Windows of a sorted frame are sorted too
+    assert is_sorted_by(trace.time_window(10, 1000000).df_event, "time")
+    # Stored with the table when it was written
+    durations = trace.df_state["time_fi"] - trace.df_state["time_ini"]
+    assert trace.df_state.attrs[MAX_DURATION] == durations.max() == max_duration(trace.df_state)
@@ -0,0 +1,101 @@
+import logging
+import weakref
+from typing import Optional, Tuple
+
+import dask.dataframe as dd
+import numpy as np
+import pandas as pd
+
+logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# pandas DataFrame.attrs key of the column a DataFrame is known to be sorted by (see tag_sorted)
+SORTED_BY = "sorted_by"
+# pandas DataFrame.attrs key of a weak reference to the DataFrame tagged as sorted. The frames derived from it inherit
+# its attrs, but not the frame (e.g. sort_values)
+SORTED_FRAME = "sorted_frame"
+# pandas DataFrame.attrs key of the duration of the longest state of the table a DataFrame was read from, stored with
+# the table when it's written. An upper bound of the duration of the states of the frames derived from it
+MAX_DURATION = "max_duration"
+
+
+def tag_sorted(df: pd.DataFrame, column: str, check: bool = True) -> pd.DataFrame:
+    """ Tags `df` as sorted by `column`, if it is. The readers check it once when they read the table, and
+    is_sorted_by trusts the tag of that same frame afterwards. With check=False the caller knows it's sorted
+    """
+    if check and not df[column].is_monotonic_increasing:
+        logger.warning(f"Table stored as sorted by {column} isn't sorted, filtering it with masks")
+        return df
+    df.attrs[SORTED_BY] = column
+    df.attrs[SORTED_FRAME] = weakref.ref(df)
+    return df
+
+
+def is_sorted_by(df, column: str) -> bool:
+    """ True if `df` is a pandas DataFrame tagged as sorted by `column` (see tag_sorted). O(1), the frames that only
+    inherited the tag of another one are not trusted
+    """
+    if not isinstance(df, pd.DataFrame) or df.attrs.get(SORTED_BY) != column:
+        return False
+    frame = df.attrs.get(SORTED_FRAME)
+    return frame is not None and frame() is df
+
+
+def sorted_range(values: np.ndarray, start=None, end=None, include_end=False) -> Tuple[int, int]:
+    """ [first, last) positions of the sorted `values` in [start, end), or [start, end] with include_end """
+    first = 0 if start is None else int(np.searchsorted(values, start, side="left"))
+    last = len(values) if end is None else int(np.searchsorted(values, end, side="right" if include_end else "left"))
+    return first, max(first, last)
+
+
+def _slice_sorted(df: pd.DataFrame, column: str, start, end) -> pd.DataFrame:
+    first, last = sorted_range(df[column].to_numpy(), start, end)
+    rows = df.iloc[first:last]
+    # A range of the rows of a sorted frame is sorted too
+    return tag_sorted(rows, column, check=False) if is_sorted_by(df, column) else rows
+
+
+def window(df, column: str, start=None, end=None, is_sorted=True):
+    """ Rows of `df` whose `column` is in [start, end). If `df` is sorted by `column` the rows are found with a
+    binary search, O(log N), per partition for Dask DataFrames. Otherwise the whole column is compared
+    """
+    if column not in df.columns:
+        # Empty tables are read without columns
+        return df
+    if not is_sorted:
+        mask = df[column] >= start if start is not None else None
+        if end is not None:
+            mask = df[column] < end if mask is None else mask & (df[column] < end)
+        return df if mask is None else df.loc[mask]
+    if isinstance(df, dd.DataFrame):
+        return df.map_partitions(_slice_sorted, column, start, end)
+    return _slice_sorted(df, column, start, end)
+
+
+def max_duration(df_state) -> int:
+    """ Duration of the longest state. States starting farther than this before a window can't overlap it. Read from
+    the attrs of the pandas DataFrames (MAX_DURATION), computed for the rest
+    """
+    if "time_ini" not in df_state.columns:
+        return 0
+    if isinstance(df_state, pd.DataFrame) and MAX_DURATION in df_state.attrs:
+        return int(df_state.attrs[MAX_DURATION])
+    duration = (df_state["time_fi"] - df_state["time_ini"]).max()
+    duration = duration.compute() if isinstance(duration, dd.Scalar) else duration
+    # NaN for empty tables
+    return 0 if pd.isna(duration) else int(duration)
+
+
+def state_window(df_state, start=None, end=None, is_sorted=True, longest: Optional[int] = None):
+    """ States that overlap [start, end): the ones with time_ini < end and time_fi > start, plus the empty states
+    starting in the window. `df_state` sorted by time_ini only has to be searched from start - the duration of the
+    longest state (`longest`, see max_duration), stored with the table it was read from or computed if not given
+    """
+    if "time_ini" not in df_state.columns or start is None:
+        return window(df_state, "time_ini", None, end, is_sorted)
+    if is_sorted:
+        longest = max_duration(df_state) if longest is None else longest
+        candidates = window(df_state, "time_ini", start - longest, end)
+    else:
+        candidates = window(df_state, "time_ini", None, end, is_sorted=False)
+    return candidates.loc[(candidates["time_fi"] > start) | (candidates["time_ini"] >= start)]
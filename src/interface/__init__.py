@@ -4,11 +4,12 @@ import uuid
 
 from flask import Flask
 
-from src.interface import routes
-
 logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
 app = Flask(__name__)
-app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", uuid.uuid4())
+app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", uuid.uuid4().hex)
+
+# The routes use the app, they have to be imported once it exists
+from src.interface import routes  # noqa: E402,F401 isort:skip
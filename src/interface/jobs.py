@@ -0,0 +1,190 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from src.persistence.controller import parse_trace
+from src.Trace import Trace
+
+logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Traces converted at the same time, each conversion may use WORKERS processes to parse
+CONVERSION_WORKERS = int(os.environ.get("CONVERSION_WORKERS", 2))
+# Finished jobs whose status is kept, the oldest ones are forgotten above it
+FINISHED_JOBS = int(os.environ.get("FINISHED_JOBS", 100))
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class ConversionJob:
+    """ Conversion of the trace `file` in the background. Its progress is updated from the chunk loop of the
+    parser, which also stops the conversion once the job is cancelled
+    """
+
+    def __init__(self, file: str):
+        self.id = uuid.uuid4().hex
+        self.file = file
+        self.state = QUEUED
+        self.bytes_total = os.path.getsize(file) if os.path.exists(file) else 0
+        self.bytes_parsed = 0
+        self.records_parsed = 0
+        self.submitted = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.error: Optional[str] = None
+        self.trace_name: Optional[str] = None
+        self._cancelled = threading.Event()
+
+    @property
+    def is_finished(self) -> bool:
+        return self.state in (DONE, FAILED, CANCELLED)
+
+    def progress(self, bytes_parsed: int, records_parsed: int):
+        if self._cancelled.is_set():
+            raise JobCancelled(f"The conversion of {self.file} was cancelled.")
+        self.bytes_parsed = bytes_parsed
+        self.records_parsed = records_parsed
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def status(self) -> Dict:
+        """ JSON serializable status. records_per_second and eta_seconds are None until the first chunk is parsed """
+        elapsed = ((self.finished or time.time()) - self.started) if self.started is not None else 0
+        records_per_second, eta_seconds = None, None
+        if elapsed > 0 and self.bytes_parsed > 0:
+            records_per_second = self.records_parsed / elapsed
+            if not self.is_finished:
+                eta_seconds = (self.bytes_total - self.bytes_parsed) * elapsed / self.bytes_parsed
+        return {
+            "id": self.id,
+            "file": self.file,
+            "state": self.state,
+            "bytes_parsed": self.bytes_parsed,
+            "bytes_total": self.bytes_total,
+            "records_parsed": self.records_parsed,
+            "records_per_second": records_per_second,
+            "elapsed_seconds": elapsed,
+            "eta_seconds": eta_seconds,
+            "error": self.error,
+            "trace_name": self.trace_name,
+        }
+
+
+class JobManager:
+    """ Pool of `workers` threads that convert traces with `converter` (parse_trace). `on_done` receives every
+    trace converted, once its job is complete
+    """
+
+    def __init__(
+        self,
+        workers: int = CONVERSION_WORKERS,
+        converter: Callable[..., Trace] = parse_trace,
+        on_done: Callable[[Trace], None] = None,
+    ):
+        self.converter = converter
+        self.on_done = on_done
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="conversion")
+        self._jobs: "OrderedDict[str, ConversionJob]" = OrderedDict()
+        self._futures = dict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, job_id: str):
+        return job_id in self._jobs
+
+    def get(self, job_id: str) -> ConversionJob:
+        """ The job `job_id`. Raises KeyError if there's none """
+        return self._jobs[job_id]
+
+    def jobs(self) -> List[ConversionJob]:
+        return list(self._jobs.values())
+
+    def submit(self, file: str) -> ConversionJob:
+        """ Queues the conversion of `file`. If it's already queued or running, e.g. the trace was submitted twice,
+        returns that job instead of converting it again at the same time
+        """
+        with self._lock:
+            path = os.path.realpath(file)
+            for job in self._jobs.values():
+                if not job.is_finished and os.path.realpath(job.file) == path:
+                    logger.info(f"The conversion of {file} is already job {job.id}")
+                    return job
+            job = ConversionJob(file)
+            self._jobs[job.id] = job
+            self._futures[job.id] = self._executor.submit(self._run, job)
+            self._forget_finished()
+        logger.info(f"Queued the conversion of {file} as job {job.id}")
+        return job
+
+    def cancel(self, job_id: str) -> bool:
+        """ Cancels the job `job_id`. A running conversion stops after the chunk being parsed. Returns False if the
+        job had already finished
+        """
+        job = self._jobs[job_id]
+        if job.is_finished:
+            return False
+        job.cancel()
+        future = self._futures.get(job_id)
+        if future is not None and future.cancel():
+            self._finish(job, CANCELLED)
+        return True
+
+    def wait(self, job_id: str, timeout: float = None) -> ConversionJob:
+        """ Waits until the job `job_id` finishes """
+        future = self._futures.get(job_id)
+        if future is not None and not future.cancelled():
+            future.result(timeout)
+        return self._jobs[job_id]
+
+    def shutdown(self, wait: bool = True):
+        for job in self.jobs():
+            if not job.is_finished:
+                self.cancel(job.id)
+        self._executor.shutdown(wait=wait)
+
+    def _forget_finished(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.is_finished]
+        for job_id in finished[: max(0, len(finished) - FINISHED_JOBS)]:
+            del self._jobs[job_id]
+            self._futures.pop(job_id, None)
+
+    def _finish(self, job: ConversionJob, state: str, error: str = None):
+        job.finished = time.time()
+        job.error = error
+        job.state = state
+        self._futures.pop(job.id, None)
+
+    def _run(self, job: ConversionJob):
+        if job._cancelled.is_set():
+            self._finish(job, CANCELLED)
+            return
+        job.started = time.time()
+        job.state = RUNNING
+        try:
+            trace = self.converter(job.file, progress=job.progress)
+            job.trace_name = trace.metadata.name
+            job.bytes_parsed = job.bytes_total
+            if self.on_done is not None:
+                self.on_done(trace)
+        except JobCancelled:
+            logger.info(f"Cancelled the conversion of {job.file}")
+            self._finish(job, CANCELLED)
+        except Exception as e:
+            logger.exception(f"The conversion of {job.file} failed")
+            self._finish(job, FAILED, str(e))
+        else:
+            logger.info(f"Converted {job.file} in {time.time() - job.started:.3f} s")
+            self._finish(job, DONE)
@@ -1,27 +1,47 @@
 import logging
 import os
-from typing import Dict, Optional
+from typing import Optional
 
-from flask import flash, redirect, render_template, request, url_for
+from flask import abort, flash, jsonify, redirect, render_template, request, url_for
 
 from src.core.controller import get_table_data
+from src.core.mask_cache import MASK_CACHE
+from src.core.profile import drop_profiles
 from src.interface import app
-from src.persistence.controller import parse_trace
+from src.interface.jobs import JobManager
+from src.interface.trace_store import TraceStore
+from src.persistence import instrumentation
 from src.Trace import Trace
 
 logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 traces_path: Optional[str] = None
-traces: Dict[str, Trace] = dict()
-current_trace: Optional[Trace] = None
+traces = TraceStore()
+current_trace_name: Optional[str] = None
 
 
-ALLOWED_EXTENSIONS = {"prv", "hdf"}
+def register_trace(trace: Trace):
+    """ Adds a converted trace to the loaded ones, selecting it if there's no trace selected """
+    global current_trace_name
+    # The masks of a previous version of the trace are stale
+    MASK_CACHE.invalidate(trace.metadata.name)
+    drop_profiles(trace.metadata.name)
+    traces.add(trace)
+    if current_trace_name is None:
+        current_trace_name = trace.metadata.name
+    logger.info(f"Trace {trace.metadata.name} uploaded.")
+
+
+# Traces are converted in the background, the requests only start and poll the conversions
+jobs = JobManager(on_done=register_trace)
+
+
+ALLOWED_EXTENSIONS = {"prv", "prv.gz", "prv.bz2", "prv.xz", "hdf", "parquet", "arrow"}
 
 
 def allowed_file(filename):
-    return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
+    return any(filename.lower().endswith(f".{extension}") for extension in ALLOWED_EXTENSIONS)
 
 
 @app.route("/")
@@ -29,13 +49,13 @@ def allowed_file(filename):
 def index():
     trace_options = []
     if traces_path is not None:
-        files = [f for f in os.listdir(traces_path) if os.path.isfile(os.path.join(traces_path, f))]
-        trace_options = [f for f in files if allowed_file(f)]
+        # Parquet and Arrow traces are directories
+        trace_options = [f for f in os.listdir(traces_path) if allowed_file(f)]
     if traces_path is not None:
         path_text = traces_path
     else:
         path_text = "No path selected yet."
-    return render_template("index.html", trace_options=trace_options, path_text=path_text)
+    return render_template("index.html", trace_options=trace_options, path_text=path_text, jobs=jobs.jobs())
 
 
 @app.route("/select_path", methods=["GET", "POST"])
@@ -56,9 +76,8 @@ def select_path():
 
 @app.route("/upload_trace", methods=["GET", "POST"])
 def upload_trace():
-    global traces, current_trace
     selected_trace = request.form.get("selected_trace")
-    if selected_trace == "":
+    if selected_trace == "" or selected_trace is None or traces_path is None:
         flash("No trace selected.")
         logger.info("No trace selected.")
         return redirect(url_for("index"))
@@ -66,13 +85,8 @@ def upload_trace():
     trace_file = os.path.join(traces_path, selected_trace)
     logger.info(selected_trace)
     if allowed_file(selected_trace):
-        trace = parse_trace(trace_file)
-
-        current_trace = trace
-        traces[trace.metadata.name] = trace
-
-        flash(f"Trace {selected_trace} uploaded.")
-        logger.info(f"Trace {selected_trace} uploaded.")
+        job = jobs.submit(trace_file)
+        flash(f"Uploading trace {selected_trace} (job {job.id}).")
     else:
         logger.info(f"Invalid file format. Allowed formats are: {', '.join(ALLOWED_EXTENSIONS)}")
         flash(f"Invalid file format. Allowed formats are: {', '.join(ALLOWED_EXTENSIONS)}")
@@ -80,35 +94,87 @@ def upload_trace():
     return redirect(url_for("index"))
 
 
+@app.route("/jobs")
+def list_jobs():
+    return jsonify([job.status() for job in jobs.jobs()])
+
+
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    if job_id not in jobs:
+        abort(404)
+    return jsonify(jobs.get(job_id).status())
+
+
+@app.route("/jobs/<job_id>/cancel", methods=["POST"])
+def cancel_job(job_id):
+    if job_id not in jobs:
+        abort(404)
+    cancelled = jobs.cancel(job_id)
+    return jsonify(dict(jobs.get(job_id).status(), cancelled=cancelled))
+
+
+@app.route("/diagnostics")
+def diagnostics():
+    return render_template(
+        "diagnostics.html", enabled=instrumentation.is_enabled(), reports=instrumentation.reports()
+    )
+
+
+@app.route("/diagnostics.json")
+def diagnostics_json():
+    return jsonify({"enabled": instrumentation.is_enabled(), "reports": instrumentation.reports()})
+
+
+@app.route("/diagnostics/toggle", methods=["POST"])
+def toggle_diagnostics():
+    if instrumentation.is_enabled():
+        instrumentation.disable()
+    else:
+        instrumentation.enable()
+    logger.info(f"Instrumentation {'enabled' if instrumentation.is_enabled() else 'disabled'}")
+    return redirect(url_for("diagnostics"))
+
+
 @app.route("/analyze")
 def analyze():
-    logger.info(traces)
+    logger.info(f"Traces: {traces.keys()}, {traces.stats()}")
+    # Only the metadata is shown, the records of the trace don't have to be loaded
+    current_trace = traces.peek(current_trace_name) if current_trace_name is not None else None
     return render_template("analyze.html", traces=traces, current_trace=current_trace)
 
 
 @app.route("/select_trace")
 def select_trace():
-    global current_trace
+    global current_trace_name
     logger.info(request.args)
     selected_trace_name = request.args["selected_trace_name"]
-    current_trace = traces[selected_trace_name]
+    if selected_trace_name in traces:
+        current_trace_name = selected_trace_name
     return redirect(url_for("analyze"))
 
 
 @app.route("/drop_trace")
 def drop_trace():
-    global traces, current_trace
+    global current_trace_name
     logger.info(request.args)
     droped_trace_name = request.args["droped_trace_name"]
-    if droped_trace_name == current_trace.metadata.name:
-        current_trace = None
-    del traces[droped_trace_name]
+    if droped_trace_name == current_trace_name:
+        current_trace_name = None
+    traces.drop(droped_trace_name)
+    MASK_CACHE.invalidate(droped_trace_name)
+    drop_profiles(droped_trace_name)
     return redirect(url_for("analyze"))
 
 
 @app.route("/visualize_table")
 def visualize_table():
-    cols_header, table_data, min_value, max_value = get_table_data(current_trace)
+    if current_trace_name is None:
+        flash("No trace selected.")
+        return redirect(url_for("analyze"))
+    # Optional time window of the table, in ns
+    start, end = request.args.get("start", type=int), request.args.get("end", type=int)
+    cols_header, table_data, min_value, max_value = get_table_data(traces.get(current_trace_name), start, end)
     logger.info(f"min_value {min_value}, max_value {max_value}")
 
     return render_template("visualization_table.html", cols_header=cols_header,
@@ -0,0 +1,26 @@
+import pytest
+
+from src.interface import app
+from src.persistence import instrumentation
+from src.persistence.instrumentation import record, span
+
+
+@pytest.fixture
+def instrumented():
+    instrumentation.clear()
+    instrumentation.enable()
+    yield
+    instrumentation.disable()
+    instrumentation.clear()
+
+
+def test_diagnostics_routes(instrumented):
+    with record("trace"), span("stage") as stage:
+        stage.add(bytes=1024, records=10)
+    client = app.test_client()
+    response = client.get("/diagnostics")
+    assert response.status_code == 200 and b"stage" in response.data
+    diagnostics = client.get("/diagnostics.json").get_json()
+    assert diagnostics["enabled"] and diagnostics["reports"][0]["name"] == "trace"
+    client.post("/diagnostics/toggle")
+    assert not instrumentation.is_enabled()
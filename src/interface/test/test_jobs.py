@@ -0,0 +1,134 @@
+import logging
+import threading
+import time
+
+import pytest
+
+from src.interface import app, routes
+from src.interface.jobs import CANCELLED, DONE, FAILED, JobManager
+from src.interface.trace_store import TraceStore
+from src.persistence.format_converter import open_trace_file
+from src.Trace import Trace, TraceMetaData
+
+logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+tiny_trace = "src/persistence/test/test_files/traces/tiny.test.prv"
+
+
+def chunked_converter(chunks, release=None):
+    """ Converter that reports `chunks` chunks of 100 bytes and 10 records, waiting for `release` after the first """
+
+    def convert(file, progress=None):
+        for chunk in range(1, chunks + 1):
+            progress(chunk * 100, chunk * 10)
+            if release is not None:
+                release.wait(5)
+        return Trace(TraceMetaData(name="converted", path=file))
+
+    return convert
+
+
+def test_job_progress(tmp_path):
+    file = tmp_path / "trace.prv"
+    file.write_bytes(b"x" * 400)
+    release = threading.Event()
+    done = []
+    manager = JobManager(workers=1, converter=chunked_converter(4, release), on_done=done.append)
+    job = manager.submit(str(file))
+    while job.records_parsed == 0:
+        time.sleep(0.01)
+    status = job.status()
+    assert status["state"] == "running" and status["bytes_parsed"] == 100 and status["bytes_total"] == 400
+    assert status["records_per_second"] > 0 and status["eta_seconds"] > 0
+    release.set()
+    manager.wait(job.id, timeout=5)
+    status = job.status()
+    assert status["state"] == DONE and status["trace_name"] == "converted" and status["eta_seconds"] is None
+    assert status["bytes_parsed"] == 400 and status["records_parsed"] == 40
+    assert [trace.metadata.name for trace in done] == ["converted"]
+    manager.shutdown()
+
+
+def test_job_cancel(tmp_path):
+    release = threading.Event()
+    done = []
+    manager = JobManager(workers=1, converter=chunked_converter(4, release), on_done=done.append)
+    running = manager.submit(str(tmp_path / "a.prv"))
+    queued = manager.submit(str(tmp_path / "b.prv"))
+    while running.records_parsed == 0:
+        time.sleep(0.01)
+    # The queued job never starts, the running one stops at its next chunk
+    assert manager.cancel(queued.id) and queued.state == CANCELLED
+    assert manager.cancel(running.id)
+    release.set()
+    manager.wait(running.id, timeout=5)
+    assert running.state == CANCELLED and running.records_parsed == 10
+    assert not manager.cancel(running.id)
+    assert done == []
+    manager.shutdown()
+
+
+def test_job_deduplicated(tmp_path):
+    release = threading.Event()
+    done = []
+    manager = JobManager(workers=2, converter=chunked_converter(2, release), on_done=done.append)
+    running = manager.submit(str(tmp_path / "a.prv"))
+    queued = manager.submit(str(tmp_path / "b.prv"))
+    # The same files, e.g. a double click, while they are running or queued
+    assert manager.submit(str(tmp_path / "a.prv")) is running
+    assert manager.submit(str(tmp_path / "." / "b.prv")) is queued
+    assert len(manager.jobs()) == 2
+    release.set()
+    manager.wait(running.id, timeout=5)
+    manager.wait(queued.id, timeout=5)
+    assert len(done) == 2
+    # Once finished, the file can be converted again
+    assert manager.submit(str(tmp_path / "a.prv")) is not running
+    manager.shutdown()
+
+
+def test_job_failed(tmp_path):
+    manager = JobManager(workers=1)
+    job = manager.submit(str(tmp_path / "missing.prv"))
+    manager.wait(job.id, timeout=5)
+    assert job.state == FAILED and job.error is not None
+    manager.shutdown()
+
+
+@pytest.mark.parametrize("extension", ["prv", "prv.gz"])
+def test_job_routes(tmp_path, monkeypatch, extension):
+    with open(tiny_trace, "rb") as f, open_trace_file(str(tmp_path / f"tiny.{extension}"), "wb") as trace_file:
+        trace_file.write(f.read())
+    store = TraceStore()
+    manager = JobManager(workers=1, on_done=routes.register_trace)
+    monkeypatch.setattr(routes, "traces", store)
+    monkeypatch.setattr(routes, "jobs", manager)
+    monkeypatch.setattr(routes, "traces_path", str(tmp_path))
+    monkeypatch.setattr(routes, "current_trace_name", None)
+    client = app.test_client()
+
+    response = client.post("/upload_trace", data={"selected_trace": f"tiny.{extension}"})
+    assert response.status_code == 302
+    job_id = manager.jobs()[0].id
+    manager.wait(job_id, timeout=60)
+    status = client.get(f"/jobs/{job_id}").get_json()
+    assert status["state"] == DONE and status["trace_name"] == "tiny.hdf"
+    assert status["bytes_parsed"] == status["bytes_total"] == (tmp_path / f"tiny.{extension}").stat().st_size
+    assert status["records_parsed"] == 52 + 60 + 6
+    # Registered once converted
+    assert "tiny.hdf" in store and routes.current_trace_name == "tiny.hdf"
+    assert [job["id"] for job in client.get("/jobs").get_json()] == [job_id]
+    assert client.post(f"/jobs/{job_id}/cancel").get_json()["cancelled"] is False
+    assert client.get("/jobs/unknown").status_code == 404
+    manager.shutdown()
+
+
+@pytest.mark.parametrize("selected_trace", ["", "tiny.txt", "tiny.hdf.gz"])
+def test_job_routes_invalid(tmp_path, monkeypatch, selected_trace):
+    manager = JobManager(workers=1)
+    monkeypatch.setattr(routes, "jobs", manager)
+    monkeypatch.setattr(routes, "traces_path", str(tmp_path))
+    response = app.test_client().post("/upload_trace", data={"selected_trace": selected_trace})
+    assert response.status_code == 302 and manager.jobs() == []
+    manager.shutdown()
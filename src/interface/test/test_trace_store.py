@@ -0,0 +1,137 @@
+import logging
+import shutil
+from unittest.mock import Mock, patch
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.core.profile import drop_profiles, trace_profile
+from src.interface import app, routes
+from src.interface.trace_store import TRACE_STORE_TRACES, TraceStore, trace_nbytes
+from src.persistence.controller import parse_trace
+from src.persistence.hdf5_reader import HDF5Reader
+from src.persistence.prv_to_hdf5 import ParaverToHDF5
+from src.persistence.writer import Writer
+from src.Trace import Trace, TraceMetaData
+
+logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+tiny_trace = "src/persistence/test/test_files/traces/tiny.test.prv"
+
+
+def make_trace(name, rows):
+    df = pd.DataFrame({"time": np.arange(rows, dtype="int64")})
+    return Trace(TraceMetaData(name=name, path=f"{name}.hdf"), df, df.copy(), df.copy())
+
+
+def loader(path):
+    return make_trace(path[: -len(".hdf")], 100)
+
+
+def test_trace_nbytes():
+    trace = make_trace("a", 100)
+    # 3 tables of 100 int64 plus their RangeIndex
+    assert trace_nbytes(trace) == 3 * (800 + pd.RangeIndex(100).memory_usage())
+    assert trace_nbytes(Trace(TraceMetaData(name="a"))) == 0
+
+
+def test_trace_store_eviction():
+    size = trace_nbytes(make_trace("a", 100))
+    store = TraceStore(max_bytes=2 * size, loader=Mock(side_effect=loader))
+    for name in ("a", "b", "c"):
+        store.add(make_trace(name, 100))
+    assert store.keys() == ["a", "b", "c"]
+    assert not store.is_loaded("a") and store.is_loaded("b") and store.is_loaded("c")
+    assert store.nbytes == 2 * size and store.evictions == 1
+    # The metadata of the evicted traces is kept
+    assert store.peek("a").metadata.name == "a" and store.peek("a").df_state is None
+
+    assert store.get("b").df_state is not None
+    reloaded = store.get("a")
+    store.loader.assert_called_once_with("a.hdf")
+    assert reloaded.metadata is store.peek("a").metadata
+    assert reloaded.df_state.shape[0] == 100
+    # "c" was the least recently used
+    assert not store.is_loaded("c") and store.is_loaded("b")
+    assert store.stats() == {
+        "traces": 3,
+        "loaded": 2,
+        "nbytes": 2 * size,
+        "max_bytes": 2 * size,
+        "max_traces": TRACE_STORE_TRACES,
+        "hits": 1,
+        "misses": 1,
+        "evictions": 2,
+    }
+
+
+def test_trace_store_bigger_than_budget():
+    store = TraceStore(max_bytes=10, loader=loader)
+    store.add(make_trace("a", 100))
+    store.add(make_trace("b", 100))
+    # The last trace used is never evicted
+    assert store.is_loaded("b") and not store.is_loaded("a")
+
+
+def test_trace_store_drop_and_replace():
+    store = TraceStore(loader=loader)
+    store.add(make_trace("a", 100))
+    store.add(make_trace("a", 10))
+    assert len(store) == 1 and store.nbytes == trace_nbytes(make_trace("a", 10))
+    store.drop("a")
+    assert "a" not in store and store.nbytes == 0
+    with pytest.raises(KeyError):
+        store.get("a")
+
+
+def test_trace_store_dask_trace(tmp_path):
+    hdf_file = str(tmp_path / "tiny.hdf")
+    Writer().records_to_hdf5(hdf_file, ParaverToHDF5().iter_records(tiny_trace))
+    trace = Trace(TraceMetaData(name="tiny.hdf", path=hdf_file), *HDF5Reader().parse_records(hdf_file, use_dask=True))
+    computed = Trace(trace.metadata, trace.df_state.compute(), trace.df_event.compute(), trace.df_comm.compute())
+    # Dask DataFrames hold no records, only the computed ones count
+    assert trace_nbytes(trace) == 0
+    assert trace_nbytes(computed) == sum(
+        df.memory_usage(index=True, deep=True).sum() for df in (computed.df_state, computed.df_event, computed.df_comm)
+    )
+    # So do the cached profiles of the trace, measured again each time it's used
+    drop_profiles("tiny.hdf")
+    store = TraceStore(loader=lambda path: trace)
+    store.add(trace)
+    assert store.nbytes == 0
+    profile = trace_profile(store.get("tiny.hdf"))
+    store.get("tiny.hdf")
+    assert store.nbytes == profile.threads.nbytes + profile.states.nbytes + profile.durations.nbytes > 0
+    # Evicting the trace drops its profiles
+    store.max_bytes = store.nbytes
+    store.add(make_trace("b", 10))
+    assert not store.is_loaded("tiny.hdf") and drop_profiles("tiny.hdf") == 0
+
+
+def test_trace_store_max_traces():
+    store = TraceStore(loader=loader, max_traces=2)
+    for name in ("a", "b", "c"):
+        store.add(make_trace(name, 1))
+    assert store.stats()["loaded"] == 2 and not store.is_loaded("a") and store.evictions == 1
+
+
+def test_trace_store_lazy_trace(tmp_path, monkeypatch):
+    shutil.copy(tiny_trace, tmp_path / "tiny.prv")
+    trace = parse_trace(str(tmp_path / "tiny.prv"))
+    opened = Trace(trace.metadata, *HDF5Reader().parse_records(trace.metadata.path, use_dask=True))
+    store = TraceStore()
+    monkeypatch.setattr(routes, "traces", store)
+    monkeypatch.setattr(routes, "current_trace_name", "tiny.hdf")
+    with patch.object(HDF5Reader, "parse_table") as parse_table:
+        # Neither the tables not opened nor the Dask DataFrames of their records hold memory
+        assert trace_nbytes(trace) == trace_nbytes(opened) == 0
+        store.add(trace)
+        response = app.test_client().get("/analyze")
+        assert response.status_code == 200 and b"tiny.hdf" in response.data
+        parse_table.assert_not_called()
+    assert trace.opened("df_state") is None
+    response = app.test_client().get("/visualize_table?start=300000&end=700000")
+    assert response.status_code == 200 and b"Thread 1.1.1" in response.data
+    drop_profiles("tiny.hdf")
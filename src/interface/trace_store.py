@@ -0,0 +1,149 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+import pandas as pd
+
+from src.core.profile import drop_profiles, profiles_nbytes
+from src.persistence.controller import parse_trace
+from src.Trace import LazyTrace, Trace
+
+logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+GB = 1024 * 1024 * 1024
+# Memory held by the loaded traces, the least recently used ones are evicted above it
+TRACE_STORE_BYTES = int(os.environ.get("TRACE_STORE_BYTES", GB * 4))
+# Traces loaded at once. Lazy traces hold almost no memory until they are used, so they are also capped by number
+TRACE_STORE_TRACES = int(os.environ.get("TRACE_STORE_TRACES", 16))
+
+_TABLES = ("df_state", "df_event", "df_comm")
+
+
+def trace_nbytes(trace: Trace) -> int:
+    """ Memory held by `trace`: its pandas DataFrames and its cached profiles. Dask DataFrames, and the tables of a
+    LazyTrace not opened yet, hold no records, they are read from the converted trace each time they are used
+    """
+    nbytes = 0
+    for attribute in _TABLES:
+        df = trace.opened(attribute) if isinstance(trace, LazyTrace) else getattr(trace, attribute)
+        if isinstance(df, pd.DataFrame):
+            nbytes += int(df.memory_usage(index=True, deep=True).sum())
+    if trace.metadata is not None:
+        nbytes += profiles_nbytes(trace.metadata.name)
+    return nbytes
+
+
+def _load_trace(path: str) -> Trace:
+    return parse_trace(path)
+
+
+class TraceStore:
+    """ Traces loaded in the interface by name, within a budget of `max_bytes` of memory held (see trace_nbytes) and
+    of `max_traces` traces. Above them, the records and profiles of the least recently used traces are evicted,
+    keeping their metadata, and reloaded with `loader` from their converted file (metadata.path) the next time
+    they are used. The memory of a trace is measured again each time it's used, since it grows as its tables are
+    opened and profiled
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = TRACE_STORE_BYTES,
+        loader: Callable[[str], Trace] = _load_trace,
+        max_traces: int = TRACE_STORE_TRACES,
+    ):
+        self.max_bytes = max_bytes
+        self.max_traces = max_traces
+        self.loader = loader
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Every trace, in least recently used order. The evicted ones only have their metadata
+        self._traces: "OrderedDict[str, Trace]" = OrderedDict()
+        # Memory held by the loaded traces
+        self._sizes: Dict[str, int] = dict()
+        self._lock = threading.RLock()
+
+    def __contains__(self, name: str):
+        return name in self._traces
+
+    def __len__(self):
+        return len(self._traces)
+
+    def __iter__(self):
+        return iter(list(self._traces))
+
+    def keys(self):
+        return list(self._traces)
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self._sizes
+
+    def stats(self) -> Dict:
+        return {
+            "traces": len(self._traces),
+            "loaded": len(self._sizes),
+            "nbytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "max_traces": self.max_traces,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _evict(self, keep: str):
+        for name in list(self._sizes):
+            if self.nbytes <= self.max_bytes and len(self._sizes) <= self.max_traces:
+                break
+            if name == keep:
+                continue
+            self.nbytes -= self._sizes.pop(name)
+            self._traces[name] = Trace(self._traces[name].metadata)
+            drop_profiles(name)
+            self.evictions += 1
+            logger.info(f"Evicted the records of the trace {name}")
+        if self.nbytes > self.max_bytes:
+            logger.warning(f"The trace {keep} alone takes {self.nbytes} bytes, more than the {self.max_bytes} allowed")
+
+    def _load(self, name: str, trace: Trace):
+        size = trace_nbytes(trace)
+        self.nbytes -= self._sizes.pop(name, 0)
+        self._traces[name] = trace
+        self._traces.move_to_end(name)
+        self._sizes[name] = size
+        self.nbytes += size
+        self._evict(keep=name)
+
+    def add(self, trace: Trace):
+        """ Adds `trace`, replacing the one with the same name """
+        with self._lock:
+            self._load(trace.metadata.name, trace)
+
+    def get(self, name: str) -> Trace:
+        """ The trace `name`, reloading its records if they were evicted. Raises KeyError if it was never added """
+        with self._lock:
+            trace = self._traces[name]
+            if name in self._sizes:
+                self.hits += 1
+                # The trace may hold more memory since it was last used
+                self._load(name, trace)
+                return trace
+            self.misses += 1
+            logger.info(f"Reloading the records of the trace {name} from {trace.metadata.path}")
+            reloaded = self.loader(trace.metadata.path)
+            # Keeps the metadata shown, the loader may open the records lazily
+            reloaded.metadata = trace.metadata
+            self._load(name, reloaded)
+            return self._traces[name]
+
+    def peek(self, name: str) -> Optional[Trace]:
+        """ The trace `name` as it is, without reloading its records nor counting as a use. None if there's none """
+        return self._traces.get(name)
+
+    def drop(self, name: str):
+        with self._lock:
+            del self._traces[name]
+            self.nbytes -= self._sizes.pop(name, 0)
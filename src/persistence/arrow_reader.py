@@ -0,0 +1,281 @@
+import logging
+from datetime import datetime
+from functools import partial
+from typing import Dict, List, Optional, Tuple, Union
+
+import dask.dataframe as dd
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src.core.time_window import MAX_DURATION, tag_sorted
+from src.persistence.arrow_writer import read_metadata, storage_format, table_path
+from src.persistence.hdf5_reader import READ_ROWS, RECORDS
+from src.persistence.instrumentation import record, span
+from src.persistence.predicate import Column, Predicate
+from src.Trace import LazyTrace, TraceMetaData
+
+logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def _read_groups(path: str, file_format: str, groups: List[int], columns: Optional[List[str]]) -> pa.Table:
+    """ Row groups (Parquet) or record batches (Arrow IPC) `groups` of the file, through a memory map. The columns
+    of an Arrow IPC file are not copied, they point to the mapped file
+    """
+    if file_format == "parquet":
+        return pq.ParquetFile(path, memory_map=True).read_row_groups(groups, columns=columns)
+    # The mapping is released once no column points to it
+    reader = pa.ipc.open_file(pa.memory_map(path))
+    table = pa.Table.from_batches([reader.get_batch(group) for group in groups], schema=reader.schema)
+    return table if columns is None else table.select(columns)
+
+
+def _footer_statistics(path: str) -> List[Dict[str, List]]:
+    """ [min, max] of every column of each row group, from the footer of the Parquet file. None if not stored """
+    metadata = pq.ParquetFile(path, memory_map=True).metadata
+    statistics = []
+    for group in range(metadata.num_row_groups):
+        row_group = metadata.row_group(group)
+        group_statistics = dict()
+        for column in range(row_group.num_columns):
+            chunk = row_group.column(column)
+            stats = chunk.statistics
+            has_min_max = stats is not None and stats.has_min_max
+            group_statistics[chunk.path_in_schema] = [stats.min, stats.max] if has_min_max else [None, None]
+        statistics.append(group_statistics)
+    return statistics
+
+
+def _to_pandas(table: pa.Table, index) -> pd.DataFrame:
+    # A single chunk of numeric columns without nulls is converted without copying it
+    df = table.to_pandas(split_blocks=True)
+    df.index = index
+    return df
+
+
+def _read_rows(rows: Tuple[int, int], path: str, file_format: str, group_rows: int, columns) -> pd.DataFrame:
+    """ Rows [start, stop) of the table file, reading only the row groups that contain them """
+    start, stop = rows
+    first, last = start // group_rows, -(-stop // group_rows)
+    table = _read_groups(path, file_format, list(range(first, last)), columns)
+    table = table.slice(start - first * group_rows, stop - start)
+    return _to_pandas(table, pd.RangeIndex(start, stop))
+
+
+class _Loc:
+    def __init__(self, table: "ArrowTable"):
+        self.table = table
+
+    def __getitem__(self, predicate: Predicate) -> pd.DataFrame:
+        return self.table.read(predicate)
+
+
+class ArrowTable:
+    """ Lazy handle of a record table of a Parquet or Arrow IPC trace directory, the counterpart of HDF5Table: a
+    Filter chain over it is only evaluated when it is executed, reading just the row groups that can match
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        key: str,
+        columns: Optional[List[str]] = None,
+        layout: Optional[Dict] = None,
+        statistics: Optional[List[Dict[str, List]]] = None,
+    ):
+        self.file = directory
+        self.key = key
+        self.columns = columns
+        self._layout = layout
+        self._statistics = statistics
+
+    @property
+    def layout(self) -> Dict:
+        if self._layout is None:
+            self._layout = ArrowReader().parse_layout(self.file)
+        return self._layout
+
+    @property
+    def statistics(self) -> List[Dict[str, List]]:
+        """ [min, max] of every column of each row group. Read once from the footer of Parquet files, Arrow IPC files
+        have none so they are stored in the layout
+        """
+        if self._statistics is None:
+            if self.key not in self.layout["rows"]:
+                self._statistics = []
+            elif self.layout["format"] == "parquet":
+                self._statistics = _footer_statistics(table_path(self.file, self.key, "parquet"))
+            else:
+                self._statistics = self.layout["statistics"].get(self.key, [])
+        return self._statistics
+
+    @property
+    def loc(self) -> _Loc:
+        return _Loc(self)
+
+    def __getitem__(self, item: Union[str, List[str]]):
+        if isinstance(item, str):
+            return Column(item)
+        return ArrowTable(self.file, self.key, list(item), self._layout, self._statistics)
+
+    def __len__(self):
+        return self.layout["rows"].get(self.key, 0)
+
+    def row_groups(self, predicate: Predicate) -> List[int]:
+        """ Row groups that can contain matches of `predicate`, from the min/max of their columns """
+        if predicate.is_unsatisfiable():
+            return []
+        bounds = [(column, *predicate.bounds(column)) for column in predicate.columns]
+        groups = []
+        for group, group_statistics in enumerate(self.statistics):
+            for column, low, high in bounds:
+                minimum, maximum = group_statistics[column]
+                if minimum is None:
+                    continue
+                if (low is not None and maximum < low) or (high is not None and minimum > high):
+                    break
+            else:
+                groups.append(group)
+        return groups
+
+    def read(self, predicate: Optional[Predicate] = None) -> pd.DataFrame:
+        return ArrowReader().read_table(self.file, self.key, self.columns, predicate, table=self)
+
+
+class ArrowReader:
+    """ Reads the trace directories written by ArrowWriter, with the interface of HDF5Reader """
+
+    def parse_layout(self, directory: str) -> Dict:
+        layout = read_metadata(directory).get("layout", {})
+        return {
+            "version": layout.get("version", 0),
+            "format": layout.get("format", storage_format(directory)),
+            "row_group_rows": layout.get("row_group_rows"),
+            "sorted_by": layout.get("sorted_by", {}),
+            "rows": layout.get("rows", {}),
+            "statistics": layout.get("statistics", {}),
+            "max_duration": layout.get("max_duration", {}),
+        }
+
+    def parse_nrows(self, directory: str) -> Dict[str, int]:
+        """ Rows of each record table of the trace, 0 for the tables it doesn't have """
+        rows = self.parse_layout(directory)["rows"]
+        return {key: rows.get(key, 0) for key in RECORDS}
+
+    def parse_source(self, directory: str) -> Optional[Dict]:
+        """ Fingerprint of the .prv file the trace was converted from (see prv_reader.source_fingerprint) """
+        return read_metadata(directory).get("source")
+
+    def parse_metadata(self, directory: str) -> TraceMetaData:
+        metadata = read_metadata(directory)
+        if "name" not in metadata:
+            raise Exception(f"{directory} is not a converted trace.")
+        return TraceMetaData(
+            metadata["name"],
+            metadata["path"],
+            metadata["type"],
+            metadata["exec_time"],
+            datetime.fromtimestamp(metadata["date_time"]),
+            metadata["nodes"],
+            metadata["apps"],
+            int(metadata.get("layout_version", 0)),
+        )
+
+    def read_table(
+        self,
+        directory: str,
+        key: str,
+        columns: Optional[List[str]] = None,
+        predicate: Optional[Predicate] = None,
+        table: Optional[ArrowTable] = None,
+    ) -> pd.DataFrame:
+        """ Reads the rows of the table `key` that satisfy `predicate`, only the `columns` given. The row groups
+        whose statistics can't satisfy the predicate are skipped, the predicate is evaluated over the rest one row
+        group at a time
+        """
+        table = table if table is not None else ArrowTable(directory, key, columns)
+        layout = table.layout
+        if key not in layout["rows"]:
+            return pd.DataFrame([])
+        path = table_path(directory, key, layout["format"])
+        group_rows = layout["row_group_rows"]
+        with span("read_table") as read:
+            if predicate is None or len(predicate.conditions) == 0:
+                df = _read_rows((0, layout["rows"][key]), path, layout["format"], group_rows, columns)
+            else:
+                groups = table.row_groups(predicate)
+                logger.debug(f"Reading {len(groups)} row groups of {key} where {predicate.where()}")
+                read_columns = None if columns is None else list(dict.fromkeys(columns + predicate.columns))
+                chunks = []
+                for group in groups:
+                    rows = (group * group_rows, min((group + 1) * group_rows, layout["rows"][key]))
+                    chunk = _read_rows(rows, path, layout["format"], group_rows, read_columns)
+                    chunks.append(chunk.loc[predicate.mask(chunk)])
+                if len(chunks) > 0:
+                    df = pd.concat(chunks)
+                else:
+                    df = _read_rows((0, 0), path, layout["format"], group_rows, read_columns)
+                df = df if columns is None else df[columns]
+            read.add(bytes=df.memory_usage(index=True).sum(), records=df.shape[0])
+        return df
+
+    def parse_tables(self, directory: str) -> Tuple[ArrowTable, ArrowTable, ArrowTable]:
+        """ Lazy version of parse_records, nothing is read until the tables are queried """
+        layout = self.parse_layout(directory)
+        return tuple(ArrowTable(directory, key, layout=layout) for key in RECORDS)
+
+    def parse_table(
+        self,
+        directory: str,
+        key: str,
+        columns: Optional[List[str]] = None,
+        start: Optional[int] = None,
+        stop: Optional[int] = None,
+        use_dask=False,
+    ):
+        """ Reads the rows [start, stop) of the `columns` of the record table `key` (States, Events or Comm), only
+        the row groups that contain them. With use_dask, in partitions of about READ_ROWS rows
+        """
+        layout = self.parse_layout(directory)
+        if key not in layout["rows"]:
+            return dd.from_array(np.array([[]])) if use_dask else pd.DataFrame([])
+        nrows = layout["rows"][key]
+        start = 0 if start is None else min(start, nrows)
+        stop = nrows if stop is None else min(stop, nrows)
+        stop = max(start, stop)
+        path, group_rows = table_path(directory, key, layout["format"]), layout["row_group_rows"]
+        read = partial(_read_rows, path=path, file_format=layout["format"], group_rows=group_rows, columns=columns)
+        with span("parse_table") as parsed:
+            if use_dask:
+                partition_rows = max(1, READ_ROWS // group_rows) * group_rows
+                ranges = [(low, min(low + partition_rows, stop)) for low in range(start, stop, partition_rows)]
+                return dd.from_map(read, ranges or [(start, start)], meta=read((0, 0)))
+            df = read((start, stop))
+            parsed.add(bytes=df.memory_usage(index=True).sum(), records=df.shape[0])
+        # Lets Filter select time ranges with binary searches
+        sort_column = layout["sorted_by"].get(key)
+        if sort_column is not None and sort_column in df.columns:
+            tag_sorted(df, sort_column)
+        if key in layout["max_duration"]:
+            df.attrs[MAX_DURATION] = layout["max_duration"][key]
+        return df
+
+    def parse_records(self, directory: str, use_dask=False):
+        return tuple(self.parse_table(directory, key, use_dask=use_dask) for key in RECORDS)
+
+    def open_trace(self, directory: str, use_dask=True) -> LazyTrace:
+        """ Trace of the directory that only reads its metadata, see HDF5Reader.open_trace """
+        metadata = self.parse_metadata(directory)
+        trace = LazyTrace(metadata, partial(self._parse_trace_table, metadata.name, directory, use_dask=use_dask))
+        trace._max_state_duration = self.parse_layout(directory)["max_duration"].get("States")
+        return trace
+
+    def _parse_trace_table(self, trace_name: str, directory: str, key: str, use_dask=False, **kwargs):
+        with record(trace_name):
+            return self.parse_table(directory, key, use_dask=use_dask, **kwargs)
+
+    def parse_file(self, directory: str, use_dask=False):
+        df_state, df_event, df_comm = self.parse_records(directory, use_dask=use_dask)
+        return self.parse_metadata(directory), df_state, df_event, df_comm
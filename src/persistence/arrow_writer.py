@@ -0,0 +1,437 @@
+import json
+import logging
+import os
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import dask.dataframe as dd
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from src.core.intervals import INTERVALS, iter_intervals
+from src.persistence.instrumentation import span
+from src.persistence.schema import compact_dataframe, records_to_dataframe, widen_dtypes
+from src.persistence.writer import CHUNK_ROWS, RECORDS, SORT_COLUMNS, TABLES
+from src.Trace import TraceMetaData
+
+logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Columnar storage formats of a trace, and the extension of the directory of the trace and of its table files
+FORMATS = ("parquet", "arrow")
+# File of the trace directory with its metadata, storage layout and the fingerprint of its .prv file
+METADATA_FILE = "metadata.json"
+# Storage layout of the record tables. Version 1: tables sorted by time, in row groups (Parquet) or record batches
+# (Arrow IPC) of ROW_GROUP_ROWS rows with the min/max of every column, in the footer of the Parquet files and in the
+# metadata for Arrow IPC. Version 2: plus the Intervals table of the paired entry and exit events (see core.intervals)
+ARROW_LAYOUT_VERSION = 2
+ROW_GROUP_ROWS = int(os.environ.get("ROW_GROUP_ROWS", CHUNK_ROWS))
+# Rows sorted in memory at once when a table was not written in order. The sorted runs are merged out of core
+SORT_RUN_ROWS = int(os.environ.get("SORT_RUN_ROWS", 1000000))
+# Sorted runs merged at once, each one holding a row group in memory. More runs are merged in several passes
+MERGE_RUNS = int(os.environ.get("MERGE_RUNS", 64))
+# Codec of the Parquet files. Arrow IPC files are not compressed, so their columns are read from a memory map
+# without copying them
+PARQUET_COMPRESSION = os.environ.get("PARQUET_COMPRESSION", "zstd")
+
+
+def storage_format(path: str) -> str:
+    """ Format of a trace file or directory from its extension: prv, hdf, parquet or arrow """
+    return path.rstrip("/").rsplit(".", 1)[-1].lower()
+
+
+def table_path(directory: str, key: str, file_format: str) -> str:
+    return os.path.join(directory, f"{key}.{file_format}")
+
+
+def read_metadata(directory: str) -> Dict:
+    """ Contents of the METADATA_FILE of the trace directory, empty if there's none """
+    try:
+        with open(os.path.join(directory, METADATA_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def update_metadata(directory: str, values: Dict, remove: Iterable[str] = ()):
+    """ Sets the `values` and removes the keys `remove` of the METADATA_FILE of the trace directory. The file is
+    replaced at once, a reader sees either the old or the new version
+    """
+    metadata = read_metadata(directory)
+    metadata.update(values)
+    for key in remove:
+        metadata.pop(key, None)
+    tmp_file = os.path.join(directory, f"{METADATA_FILE}.tmp")
+    with open(tmp_file, "w") as f:
+        json.dump(metadata, f)
+    os.replace(tmp_file, os.path.join(directory, METADATA_FILE))
+
+
+def metadata_to_dict(trace_metadata: TraceMetaData) -> Dict:
+    return {
+        "name": trace_metadata.name,
+        "path": trace_metadata.path,
+        "type": trace_metadata.type,
+        "exec_time": trace_metadata.exec_time,
+        "date_time": trace_metadata.date_time.timestamp(),
+        "nodes": trace_metadata.nodes,
+        "apps": trace_metadata.apps,
+    }
+
+
+def _statistics(table: pa.Table) -> Dict[str, List]:
+    """ [min, max] of every column of the row group `table` """
+    statistics = dict()
+    for name in table.column_names:
+        min_max = pc.min_max(table[name])
+        statistics[name] = [min_max["min"].as_py(), min_max["max"].as_py()]
+    return statistics
+
+
+def _write_table(writer, table: pa.Table, file_format: str):
+    """ Writes `table`, of at most ROW_GROUP_ROWS rows, as a row group (Parquet) or a record batch (Arrow IPC) """
+    if file_format == "parquet":
+        writer.write_table(table, row_group_size=ROW_GROUP_ROWS)
+    else:
+        for batch in table.combine_chunks().to_batches():
+            writer.write_batch(batch)
+
+
+def _rechunk(tables: Iterable[pa.Table]) -> Iterator[pa.Table]:
+    """ The rows of `tables` in tables of ROW_GROUP_ROWS rows, except the last one """
+    pending, rows = [], 0
+    for table in tables:
+        pending.append(table)
+        rows += table.num_rows
+        if rows < ROW_GROUP_ROWS:
+            continue
+        merged = pa.concat_tables(pending)
+        full = rows - rows % ROW_GROUP_ROWS
+        for start in range(0, full, ROW_GROUP_ROWS):
+            yield merged.slice(start, ROW_GROUP_ROWS)
+        pending, rows = [merged.slice(full)], rows - full
+    if rows > 0:
+        yield pa.concat_tables(pending)
+
+
+def _merge_runs(paths: List[str], file_format: str, column: str) -> Iterator[pa.Table]:
+    """ Stable k-way merge of the files `paths`, each one sorted by `column`, holding a row group of each file in
+    memory. Each step emits the rows up to the smallest last value of the row groups in memory (the bound). The rows
+    equal to it are only emitted from the runs up to the first one that reaches it, whose next row group can also have
+    them, so the rows with equal values keep the order of their runs
+    """
+    groups = [iter(_iter_groups(path, file_format)) for path in paths]
+    buffers: List[Optional[pa.Table]] = [next(group, None) for group in groups]
+    while any(buffer is not None for buffer in buffers):
+        keys = [None if buffer is None else buffer[column].to_numpy() for buffer in buffers]
+        bound = min(key[-1] for key in keys if key is not None)
+        parts, part_keys = [], []
+        reached = False
+        for run, key in enumerate(keys):
+            if key is None:
+                continue
+            take = int(np.searchsorted(key, bound, side="left" if reached else "right"))
+            reached |= key[-1] == bound
+            if take == 0:
+                continue
+            parts.append(buffers[run].slice(0, take))
+            part_keys.append(key[:take])
+            buffers[run] = next(groups[run], None) if take == key.size else buffers[run].slice(take)
+        merged = pa.concat_tables(parts)
+        yield merged.take(np.argsort(np.concatenate(part_keys), kind="stable"))
+
+
+class _TableWriter:
+    """ Appends DataFrames to the Parquet or Arrow IPC file of the record table `key`, in row groups of exactly
+    ROW_GROUP_ROWS rows (except the last one). The rows are written to a temporary file, which finish() sorts by time
+    if they were not appended in order. If some values don't fit in the dtypes of the rows already written, the file
+    is rewritten with wider dtypes first
+    """
+
+    def __init__(self, directory: str, key: str, file_format: str):
+        self.path = table_path(directory, key, file_format)
+        self.tmp_path = f"{self.path}.tmp"
+        self.key = key
+        self.file_format = file_format
+        self.sort_column = SORT_COLUMNS[key]
+        self.rows = 0
+        self.is_sorted = True
+        self.statistics: List[Dict[str, List]] = []
+        # Duration of the longest interval (time_fi - time_ini) of the tables that have them
+        self.max_duration: Optional[int] = None
+        self._dtypes: Optional[Dict] = None
+        self._writer = None
+        self._pending: List[pd.DataFrame] = []
+        self._pending_rows = 0
+        self._last = None
+
+    def _open(self, path: str, schema: pa.Schema):
+        if self.file_format == "parquet":
+            return pq.ParquetWriter(path, schema, compression=PARQUET_COMPRESSION, write_statistics=True)
+        return pa.ipc.new_file(path, schema)
+
+    def _write_group(self, table: pa.Table):
+        if self._writer is None:
+            self._writer = self._open(self.tmp_path, table.schema)
+        _write_table(self._writer, table, self.file_format)
+        if self.file_format == "arrow":
+            # Parquet files store the statistics of their row groups in their footer
+            self.statistics.append(_statistics(table))
+
+    def _flush(self, final: bool = False):
+        if self._pending_rows == 0 or (self._pending_rows < ROW_GROUP_ROWS and not final):
+            return
+        df = pd.concat(self._pending, ignore_index=True) if len(self._pending) > 1 else self._pending[0]
+        full = self._pending_rows if final else self._pending_rows - self._pending_rows % ROW_GROUP_ROWS
+        for start in range(0, full, ROW_GROUP_ROWS):
+            group = df.iloc[start: min(start + ROW_GROUP_ROWS, full)]
+            self._write_group(pa.Table.from_pandas(group, preserve_index=False).replace_schema_metadata())
+        rest = df.iloc[full:]
+        self._pending = [rest] if rest.shape[0] > 0 else []
+        self._pending_rows = rest.shape[0]
+
+    def _rewrite(self, dtypes: Dict):
+        logger.warning(f"Rewriting table {self.key} with wider dtypes: {dtypes}")
+        self._pending = [df.astype(dtypes) for df in self._pending]
+        if self._writer is None:
+            return
+        self._writer.close()
+        self._writer = None
+        old_path = f"{self.tmp_path}.old"
+        os.replace(self.tmp_path, old_path)
+        schema = pa.schema([(name, pa.from_numpy_dtype(dtype)) for name, dtype in dtypes.items()])
+        self.statistics = []
+        for group in _iter_groups(old_path, self.file_format):
+            self._write_group(group.cast(schema))
+        os.remove(old_path)
+
+    def append(self, df: pd.DataFrame):
+        with span("append") as appended:
+            df = compact_dataframe(df, RECORDS[self.key]) if self.key in RECORDS else df
+            df = df.reset_index(drop=True)
+            if self._dtypes is not None:
+                dtypes = widen_dtypes(self._dtypes, df.dtypes.to_dict())
+                if dtypes != self._dtypes:
+                    self._rewrite(dtypes)
+                df = df.astype(dtypes)
+            self._dtypes = df.dtypes.to_dict()
+            values = df[self.sort_column].to_numpy()
+            if values.size > 0:
+                in_order = bool(np.all(values[1:] >= values[:-1]))
+                self.is_sorted &= in_order and (self._last is None or values[0] >= self._last)
+                self._last = values[-1]
+            if "time_fi" in df.columns and df.shape[0] > 0:
+                duration = int((df["time_fi"].to_numpy() - df["time_ini"].to_numpy()).max())
+                self.max_duration = duration if self.max_duration is None else max(self.max_duration, duration)
+            self._pending.append(df)
+            self._pending_rows += df.shape[0]
+            self.rows += df.shape[0]
+            self._flush()
+            appended.add(bytes=df.memory_usage(index=True).sum(), records=df.shape[0])
+
+    def finish(self) -> bool:
+        """ Writes the rows left and moves the table to its file, sorted. False if no row was appended """
+        self._flush(final=True)
+        if self._writer is None:
+            return False
+        self._writer.close()
+        self._writer = None
+        if not self.is_sorted:
+            with span("sort"):
+                logger.warning(f"Table {self.key} is not sorted by {self.sort_column}. Sorting it...")
+                self._sort()
+        os.replace(self.tmp_path, self.path)
+        return True
+
+    def _write_run(self, path: str, tables: Iterable[pa.Table]):
+        writer = None
+        try:
+            for table in _rechunk(tables):
+                writer = self._open(path, table.schema) if writer is None else writer
+                _write_table(writer, table, self.file_format)
+        finally:
+            if writer is not None:
+                writer.close()
+
+    def _sort(self):
+        """ External merge sort of the temporary file: runs of SORT_RUN_ROWS rows are sorted in memory and written
+        to files of their own, then merged MERGE_RUNS at a time (see _merge_runs) until they fit in a single merge
+        that rewrites the temporary file. Memory is bounded by SORT_RUN_ROWS and MERGE_RUNS row groups
+        """
+        runs, run, run_rows = [], [], 0
+        try:
+            for group in (*_iter_groups(self.tmp_path, self.file_format), None):
+                if group is not None:
+                    run.append(group)
+                    run_rows += group.num_rows
+                if len(run) > 0 and (group is None or run_rows >= SORT_RUN_ROWS):
+                    runs.append(f"{self.tmp_path}.run{len(runs)}")
+                    self._write_run(runs[-1], [pa.concat_tables(run).sort_by(self.sort_column)])
+                    run, run_rows = [], 0
+            merged = 0
+            while len(runs) > MERGE_RUNS:
+                # Consecutive runs are merged together, so rows with equal values keep their order
+                merges = []
+                for first in range(0, len(runs), MERGE_RUNS):
+                    merges.append(f"{self.tmp_path}.merge{merged}")
+                    merged += 1
+                    self._write_run(merges[-1], _merge_runs(runs[first: first + MERGE_RUNS], *self._merge_args))
+                for path in runs:
+                    os.remove(path)
+                runs = merges
+            self.statistics = []
+            for table in _rechunk(_merge_runs(runs, *self._merge_args)):
+                self._write_group(table)
+            self._writer.close()
+            self._writer = None
+            self.is_sorted = True
+        finally:
+            for path in runs:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    @property
+    def _merge_args(self) -> Tuple[str, str]:
+        return self.file_format, self.sort_column
+
+    def abort(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        for path in (self.tmp_path, f"{self.tmp_path}.old"):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def _iter_groups(path: str, file_format: str) -> Iterable[pa.Table]:
+    """ Row groups (Parquet) or record batches (Arrow IPC) of the file, as Tables """
+    if file_format == "parquet":
+        parquet_file = pq.ParquetFile(path, memory_map=True)
+        for group in range(parquet_file.num_row_groups):
+            yield parquet_file.read_row_group(group)
+    else:
+        with pa.memory_map(path) as source:
+            reader = pa.ipc.open_file(source)
+            for batch in range(reader.num_record_batches):
+                yield pa.Table.from_batches([reader.get_batch(batch)])
+
+
+class ArrowWriter:
+    """ Writes the record tables of a trace to a directory with one Parquet or Arrow IPC file per table (see
+    FORMATS), the columnar alternative to Writer. The storage layout of the tables is stored in its METADATA_FILE
+    """
+
+    def __init__(self, file_format: str = "parquet"):
+        if file_format not in FORMATS:
+            raise Exception(f"Unknown storage format {file_format}. Formats are: {', '.join(FORMATS)}")
+        self.file_format = file_format
+
+    def _prepare(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        for key in (*RECORDS, INTERVALS):
+            path = table_path(directory, key, self.file_format)
+            for leftover in (path, f"{path}.tmp"):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+
+    def _write_layout(self, directory: str, writers: List[_TableWriter]):
+        """ Leaves the tables in the layout ARROW_LAYOUT_VERSION and stores it """
+        layout = {
+            "version": ARROW_LAYOUT_VERSION,
+            "format": self.file_format,
+            "row_group_rows": ROW_GROUP_ROWS,
+            "sorted_by": {},
+            "rows": {},
+            "max_duration": {},
+        }
+        if self.file_format == "arrow":
+            # Parquet files store the statistics of their row groups in their footer
+            layout["statistics"] = {}
+        for writer in writers:
+            self._finish(writer, layout)
+        if "Events" in layout["rows"]:
+            with span("intervals"):
+                self._finish(self._write_intervals(directory), layout)
+        update_metadata(directory, {"layout_version": ARROW_LAYOUT_VERSION, "layout": layout})
+
+    def _finish(self, writer: _TableWriter, layout: Dict):
+        with span("finalize") as finalized:
+            finalized.add(records=writer.rows)
+            if writer.finish():
+                layout["sorted_by"][writer.key] = writer.sort_column
+                layout["rows"][writer.key] = writer.rows
+                if writer.max_duration is not None:
+                    layout["max_duration"][writer.key] = writer.max_duration
+                if "statistics" in layout:
+                    layout["statistics"][writer.key] = writer.statistics
+
+    def _write_intervals(self, directory: str) -> _TableWriter:
+        """ Writes the INTERVALS table of the entry and exit events of the Events table, one row group at a time """
+        path = table_path(directory, "Events", self.file_format)
+        writer = _TableWriter(directory, INTERVALS, self.file_format)
+
+        def read_chunks():
+            return (group.to_pandas() for group in _iter_groups(path, self.file_format))
+
+        try:
+            for intervals in iter_intervals(read_chunks):
+                if intervals.shape[0] > 0:
+                    writer.append(intervals)
+        except BaseException:
+            writer.abort()
+            raise
+        return writer
+
+    def dataframe_to_arrow(self, directory: str, df_state, df_event, df_comm):
+        """ Writes the DataFrames (pandas or Dask, written partition by partition) of the records """
+        with span("dataframe_to_arrow"):
+            self._prepare(directory)
+            writers = [_TableWriter(directory, key, self.file_format) for key, _ in TABLES]
+            try:
+                for writer, df in zip(writers, (df_state, df_event, df_comm)):
+                    partitions = df.partitions if isinstance(df, dd.DataFrame) else [df]
+                    for partition in partitions:
+                        partition = partition.compute() if isinstance(partition, dd.DataFrame) else partition
+                        if partition.shape[0] > 0:
+                            writer.append(partition)
+                self._write_layout(directory, writers)
+            except BaseException:
+                for writer in writers:
+                    writer.abort()
+                raise
+
+    def records_to_arrow(self, directory: str, records: Iterable[Tuple[np.ndarray, np.ndarray, np.ndarray]]) -> Dict:
+        """ Streaming version of dataframe_to_arrow, see Writer.records_to_hdf5. Returns the number of rows written
+        to each table
+        """
+        rows = {key: 0 for key, _ in TABLES}
+        with span("records_to_arrow"):
+            self._prepare(directory)
+            writers = [_TableWriter(directory, key, self.file_format) for key, _ in TABLES]
+            try:
+                for chunk in records:
+                    for writer, (key, record), arr in zip(writers, TABLES, chunk):
+                        if arr.shape[0] == 0:
+                            continue
+                        writer.append(records_to_dataframe(arr, record))
+                        rows[key] += arr.shape[0]
+                self._write_layout(directory, writers)
+            except BaseException:
+                for writer in writers:
+                    writer.abort()
+                raise
+        logger.debug(f"Rows written to {directory}: {rows}")
+        return rows
+
+    def write_metadata(self, directory: str, trace_metadata: TraceMetaData):
+        update_metadata(directory, metadata_to_dict(trace_metadata))
+
+    def write_source(self, directory: str, source: Dict):
+        update_metadata(directory, {"source": source})
+
+    def clear_source(self, directory: str):
+        """ Invalidates the trace directory while it's rewritten, see ParaverReader.clear_source_from_hdf5 """
+        if os.path.isdir(directory):
+            update_metadata(directory, {}, remove=("source",))
@@ -1,5 +1,8 @@
 import logging
 
+from src.persistence.arrow_reader import ArrowReader
+from src.persistence.arrow_writer import FORMATS, storage_format
+from src.persistence.format_converter import uncompressed_name
 from src.persistence.hdf5_reader import HDF5Reader
 from src.persistence.prv_reader import ParaverReader
 from src.Trace import Trace
@@ -8,16 +11,23 @@ logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def parse_trace(trace_file):
-    file_format = trace_file.rsplit(".", 1)[1].lower()
-    if file_format == "prv":
+def parse_trace(trace_file, progress=None, storage=None) -> Trace:
+    """ Opens the trace of `trace_file`, converting it first if it's a .prv file, compressed or not (.prv.gz,
+    .prv.bz2 or .prv.xz). The conversion reports its progress to `progress` and writes the records in `storage` (see
+    ParaverReader.convert). Only the metadata is read, the records of the trace are opened the first time they are
+    used (see LazyTrace).
+    Converted traces are .hdf files, or .parquet and .arrow directories of Parquet or Arrow IPC files
+    """
+    file_format = storage_format(trace_file)
+    if storage_format(uncompressed_name(trace_file)) == "prv":
         logger.info(f"Reading prv file {trace_file}")
-        trace_metadata, df_state, df_event, df_comm = ParaverReader().parse_file(trace_file)
-    elif file_format == "hdf":
-        logger.info(f"Reading hdf file {trace_file}")
-        trace_metadata, df_state, df_event, df_comm = HDF5Reader().parse_file(trace_file, use_dask=True)
+        trace_file = ParaverReader().convert(trace_file, progress=progress, storage=storage).path
+        file_format = storage_format(trace_file)
+    elif file_format in ("hdf",) + FORMATS:
+        logger.info(f"Reading {file_format} trace {trace_file}")
     else:
         raise Exception("Incorrect file format.")
-    trace = Trace(trace_metadata, df_state, df_event, df_comm)
+    reader = HDF5Reader() if file_format == "hdf" else ArrowReader()
+    trace = reader.open_trace(trace_file, use_dask=True)
     logger.info(f"Read file {trace.metadata.name}")
     return trace
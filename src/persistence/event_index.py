@@ -0,0 +1,103 @@
+import logging
+import weakref
+from typing import Iterable, Optional
+
+import numpy as np
+import pandas as pd
+import tables
+
+logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Group of the inverted index of the event types of the Events table
+EVENT_INDEX = "/RECORDS/Events_event_t"
+# pandas DataFrame.attrs key of the EventIndex of the Events read from a file (see core.filter)
+EVENT_INDEX_ATTR = "event_index"
+# pandas DataFrame.attrs key of a weak reference to the DataFrame the EventIndex was attached to
+EVENT_INDEX_FRAME_ATTR = "event_index_frame"
+# Rows of the event_t column read at once while building the index
+INDEX_ROWS = 1000000
+
+
+def _positions_dtype(nrows: int) -> np.dtype:
+    return np.dtype("uint32") if nrows <= np.iinfo("uint32").max else np.dtype("int64")
+
+
+def attach_event_index(df: pd.DataFrame, event_index: "EventIndex"):
+    """ Attaches `event_index` to the Events `df` it was read with. The frames derived from `df` (sort_values,
+    reset_index...) inherit its attrs, so the index is tied to this very DataFrame with a weak reference
+    """
+    df.attrs[EVENT_INDEX_ATTR] = event_index
+    df.attrs[EVENT_INDEX_FRAME_ATTR] = weakref.ref(df)
+
+
+def build_event_index(store: pd.HDFStore, key: str = "Events", filters: Optional[tables.Filters] = None):
+    """ Stores in EVENT_INDEX the inverted index of the event_t column of the table `key`: its sorted event `types`,
+    the `counts` of rows of each type and the row `positions` of each type in ascending order, the ones of types[i]
+    being positions[offsets[i]:offsets[i + 1]]. Built in two passes of INDEX_ROWS rows: the first counts the rows
+    of each type, the second writes the positions of each chunk to the slice of its type
+    """
+    handle = store._handle
+    if EVENT_INDEX in handle:
+        handle.remove_node(EVENT_INDEX, recursive=True)
+    nrows = store.get_storer(key).nrows
+    counts = pd.Series(dtype="int64")
+    for start in range(0, nrows, INDEX_ROWS):
+        chunk_counts = store.select_column(key, "event_t", start=start, stop=start + INDEX_ROWS).value_counts()
+        counts = counts.add(chunk_counts, fill_value=0)
+    counts = counts.sort_index()
+    types = counts.index.to_numpy(dtype="int64")
+    counts = counts.to_numpy(dtype="int64")
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    group = handle.create_group("/RECORDS", EVENT_INDEX.rsplit("/", 1)[1])
+    handle.create_array(group, "types", obj=types)
+    handle.create_array(group, "counts", obj=counts)
+    handle.create_array(group, "offsets", obj=offsets)
+    dtype = _positions_dtype(nrows)
+    positions = handle.create_carray(
+        group, "positions", atom=tables.Atom.from_dtype(dtype), shape=(nrows,), filters=filters
+    )
+    cursor = offsets[:-1].copy()
+    for start in range(0, nrows, INDEX_ROWS):
+        values = store.select_column(key, "event_t", start=start, stop=start + INDEX_ROWS).to_numpy()
+        order = np.argsort(values, kind="stable")
+        chunk_types, first = np.unique(values[order], return_index=True)
+        last = np.append(first[1:], values.size)
+        for i, type_i in enumerate(np.searchsorted(types, chunk_types)):
+            n = last[i] - first[i]
+            positions[cursor[type_i]: cursor[type_i] + n] = (order[first[i]: last[i]] + start).astype(dtype)
+            cursor[type_i] += n
+    logger.debug(f"Indexed {types.size} event types of {nrows} rows")
+
+
+class EventIndex:
+    """ Inverted index of the event types of an .hdf file (see build_event_index). The types, counts and offsets
+    are loaded, the positions are only read for the types asked
+    """
+
+    def __init__(self, file: str):
+        self.file = file
+        with tables.open_file(file, mode="r") as f:
+            group = f.get_node(EVENT_INDEX)
+            self.types = group.types.read()
+            self.counts = group.counts.read()
+            self.offsets = group.offsets.read()
+        self.nrows = int(self.offsets[-1])
+
+    def count(self, event_types: Iterable[int]) -> int:
+        types = np.unique(np.fromiter(event_types, dtype="int64"))
+        found = np.isin(types, self.types)
+        return int(self.counts[np.searchsorted(self.types, types[found])].sum())
+
+    def positions(self, event_types: Iterable[int]) -> np.ndarray:
+        """ Sorted row positions of the events of any of `event_types`, read in time proportional to their number """
+        types = np.unique(np.fromiter(event_types, dtype="int64"))
+        indices = np.searchsorted(self.types, types[np.isin(types, self.types)])
+        with tables.open_file(self.file, mode="r") as f:
+            positions = f.get_node(EVENT_INDEX, "positions")
+            parts = [positions.read(self.offsets[i], self.offsets[i + 1]) for i in indices]
+        if len(parts) == 0:
+            return np.empty(0, dtype="int64")
+        # The positions of each type are sorted, merging them is cheaper than a full sort
+        return np.sort(np.concatenate(parts).astype("int64"), kind="mergesort")
@@ -1,5 +1,23 @@
+import bz2
+import gzip
 import itertools
+import lzma
+import mmap
+import os
+import queue
+import threading
 from abc import ABC, abstractmethod
+from typing import List, Tuple
+
+from src.persistence.instrumentation import is_enabled, span
+
+# Compressions of the archived traces (e.g. trace.prv.gz), by extension
+COMPRESSIONS = {"gz": gzip, "bz2": bz2, "xz": lzma}
+# Bytes decompressed at once by the decompression thread, and blocks decompressed ahead of the parser
+DECOMPRESS_BYTES = int(os.environ.get("DECOMPRESS_BYTES", 4 * 1024 * 1024))
+DECOMPRESS_AHEAD = int(os.environ.get("DECOMPRESS_AHEAD", 8))
+# The windows of a decompressed stream are copies, unlike the ones of a memory map, so they are kept smaller
+STREAM_WINDOW_BYTES = int(os.environ.get("STREAM_WINDOW_BYTES", 64 * 1024 * 1024))
 
 # TODO delete class because this will be done in C
 
@@ -17,17 +35,213 @@ def isplit(iterable, part_size, group=list):
         yield tmp
 
 
+def _compression(filename: str):
+    return COMPRESSIONS.get(filename.rsplit(".", 1)[-1].lower())
+
+
+def is_compressed(filename: str) -> bool:
+    return _compression(filename) is not None
+
+
+def uncompressed_name(filename: str) -> str:
+    """ `filename` without its compression extension, e.g. trace.prv for trace.prv.gz """
+    return filename.rsplit(".", 1)[0] if is_compressed(filename) else filename
+
+
+def open_trace_file(filename: str, mode: str = "rb"):
+    """ Opens the trace file, decompressing it on the fly if it has a compression extension (see COMPRESSIONS) """
+    compression = _compression(filename)
+    return open(filename, mode) if compression is None else compression.open(filename, mode)
+
+
 def chunk_reader(filename: str, read_bytes: int):
-    with open(filename, "r") as file:
+    with open_trace_file(filename, "rt") as file:
         # Discard the header
         file.readline()
         while True:
-            chunk = file.readlines(read_bytes)
+            with span("chunk_reader") as read:
+                chunk = file.readlines(read_bytes)
+                if is_enabled():
+                    # Characters, the bytes of an ASCII trace. Counting them walks every line, only done when recorded
+                    read.add(bytes=sum(map(len, chunk)))
             if not chunk:
                 break
             yield chunk
 
 
+def newline_aligned_ranges(filename: str, parts: int) -> List[Tuple[int, int]]:
+    """ Splits the body of the trace (everything after the header line) in at most `parts` byte ranges
+    [start, end). Every range starts right after a newline, so no record is split between two ranges
+    """
+    with open(filename, "rb") as file:
+        # Discard the header
+        file.readline()
+        body_start = file.tell()
+        file_size = os.fstat(file.fileno()).st_size
+        limits = [body_start]
+        for part in range(1, parts):
+            target = body_start + (file_size - body_start) * part // parts
+            if target <= limits[-1]:
+                continue
+            # Move to the end of the line that contains the byte before target
+            file.seek(target - 1)
+            file.readline()
+            position = file.tell()
+            if limits[-1] < position < file_size:
+                limits.append(position)
+        limits.append(file_size)
+    return [(start, end) for start, end in zip(limits[:-1], limits[1:]) if start < end]
+
+
+def _release_pages(mapped: mmap.mmap, start: int, end: int):
+    """ Drops the pages of [start, end) from the resident memory of the process. They stay in the page cache """
+    start = -(-start // mmap.PAGESIZE) * mmap.PAGESIZE
+    end = end // mmap.PAGESIZE * mmap.PAGESIZE
+    if hasattr(mapped, "madvise") and hasattr(mmap, "MADV_DONTNEED") and start < end:
+        mapped.madvise(mmap.MADV_DONTNEED, start, end - start)
+
+
+def mmap_chunk_reader(filename: str, read_bytes: int, start: int = None, end: int = None):
+    """ Yields memoryviews over a memory map of the file with the bytes found in the range [start, end),
+    in windows of roughly `read_bytes` bytes that always end with a complete line. Nothing is copied nor
+    decoded. `start` and `end` must be aligned to the beginning of a line (see newline_aligned_ranges).
+    By default the whole body of the trace is read. A window is only valid until the next one is requested
+    """
+    with open(filename, "rb") as file:
+        file_size = os.fstat(file.fileno()).st_size
+        if file_size == 0:
+            return
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mapped, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+        mapped.madvise(mmap.MADV_SEQUENTIAL)
+    view = memoryview(mapped)
+    try:
+        if start is None:
+            # Discard the header
+            start = mapped.find(b"\n") + 1 or file_size
+        end = file_size if end is None else end
+        position = start
+        while position < end:
+            cut = min(position + read_bytes, end)
+            if cut < end:
+                newline = mapped.rfind(b"\n", position, cut)
+                if newline == -1:
+                    # A line longer than the window. Extend the window until the end of the line
+                    newline = mapped.find(b"\n", cut, end)
+                cut = end if newline == -1 else newline + 1
+            window = view[position:cut]
+            yield window
+            window.release()
+            _release_pages(mapped, position, cut)
+            position = cut
+    finally:
+        view.release()
+        try:
+            mapped.close()
+        except BufferError:
+            # Someone still holds a window, the map is closed when it is garbage collected
+            pass
+
+
+def _decompress(filename: str, blocks: queue.Queue, stop: threading.Event):
+    """ Decompresses the file in blocks of DECOMPRESS_BYTES and puts them in `blocks` with the compressed bytes read
+    so far, then an empty block. An exception is put in `blocks` instead. The compression libraries release the GIL,
+    so it runs in parallel with the parser
+    """
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    try:
+        with open(filename, "rb") as raw, _compression(filename).open(raw, "rb") as stream:
+            while not stop.is_set():
+                block = stream.read(DECOMPRESS_BYTES)
+                put((block, raw.tell()))
+                if not block:
+                    return
+    except BaseException as e:
+        put(e)
+
+
+def stream_chunk_reader(filename: str, read_bytes: int):
+    """ Yields the body of a compressed trace (see COMPRESSIONS) as (window, position) pairs: bytearrays of
+    roughly min(`read_bytes`, STREAM_WINDOW_BYTES) bytes that always end with a complete line, and the compressed
+    bytes read to decompress them. The header line is discarded. The file is decompressed by a thread that stays
+    DECOMPRESS_AHEAD blocks ahead of the consumer, so decompression and parsing overlap
+    """
+    window_bytes = min(read_bytes, STREAM_WINDOW_BYTES)
+    blocks = queue.Queue(DECOMPRESS_AHEAD)
+    stop = threading.Event()
+    thread = threading.Thread(target=_decompress, args=(filename, blocks, stop), name="decompress", daemon=True)
+    thread.start()
+    pending = bytearray()
+    in_header = True
+    try:
+        while True:
+            # Time waiting for the decompression thread
+            with span("decompress") as decompressed:
+                item = blocks.get()
+                if isinstance(item, BaseException):
+                    raise item
+                block, position = item
+                decompressed.add(bytes=len(block))
+            pending += block
+            if in_header:
+                newline = pending.find(b"\n")
+                if newline == -1 and block:
+                    continue
+                # Discard the header
+                del pending[: newline + 1 if newline != -1 else len(pending)]
+                in_header = False
+            if not block:
+                if len(pending) > 0:
+                    yield pending, position
+                return
+            while len(pending) >= window_bytes:
+                cut = pending.rfind(b"\n", 0, window_bytes) + 1 or pending.find(b"\n", window_bytes) + 1
+                if cut == 0:
+                    # A line longer than the window, wait for its end
+                    break
+                window = pending[:cut]
+                del pending[:cut]
+                yield window, position
+    finally:
+        stop.set()
+        thread.join()
+
+
+def newline_aligned_windows(buffer, window_bytes: int):
+    """ Yields memoryviews of `buffer` of at most `window_bytes` bytes (unless a single line is longer)
+    that end with a complete line. It doesn't copy the buffer
+    """
+    view = memoryview(buffer)
+    start = 0
+    while start < len(view):
+        limit = end = min(start + window_bytes, len(view))
+        if end < len(view):
+            # Look backwards for the last newline of the window, one small block at a time
+            cut, low = -1, end
+            while cut == -1 and low > start:
+                low = max(start, low - 4096)
+                cut = bytes(view[low:end]).rfind(b"\n")
+                cut, end = (cut if cut == -1 else low + cut), low
+            # A line longer than the window. Extend the window until the end of the line, looking forwards from the
+            # end of the window one small block at a time
+            high = limit
+            while cut == -1 and high < len(view):
+                low, high = high, min(len(view), high + 4096)
+                cut = bytes(view[low:high]).find(b"\n")
+                cut = cut if cut == -1 else low + cut
+            end = len(view) if cut == -1 else cut + 1
+        yield view[start:end]
+        start = end
+
+
 class FormatConverter(ABC):
     @abstractmethod
     def parse_records(self, chunk):
@@ -1,32 +1,304 @@
 import json
 import logging
 from datetime import datetime
+from functools import partial
+from typing import Dict, List, Optional, Tuple, Union
 
 import dask.dataframe as dd
 import h5py
 import numpy as np
 import pandas as pd
 
-from src.Trace import TraceMetaData
+from src.CONST import CommRecord, EventRecord, StateRecord
+from src.core.intervals import INTERVALS
+from src.core.time_window import MAX_DURATION, tag_sorted
+from src.persistence.event_index import EVENT_INDEX, EventIndex, attach_event_index
+from src.persistence.instrumentation import record, span
+from src.persistence.predicate import Column, Predicate
+from src.persistence.schema import compact_dataframe
+from src.persistence.timeline import Timeline, read_timeline
+from src.persistence.writer import THREAD_COLUMNS, partitions_node
+from src.Trace import LazyTrace, TraceMetaData
 
 logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+RECORDS = {"States": StateRecord, "Events": EventRecord, "Comm": CommRecord}
+# Rows read at once when a predicate can't be pushed down and has to be evaluated in memory, and rows of the
+# partitions of the Dask DataFrames of row ranges
+READ_ROWS = 1000000
+# pandas DataFrame.attrs key of the sorted threads (appl, task, thread) and the offsets of their rows in the table,
+# in the meta of the Dask DataFrames of the tables partitioned by thread (see thread_rows)
+THREAD_PARTITIONS = "thread_partitions"
 
-def _try_read_hdf(file, key, use_dask):
+
+def _row_index(df: pd.DataFrame, start: int) -> pd.DataFrame:
+    """ `df`, the rows read from `start`, with a RangeIndex if its index is their row numbers, as the tables written
+    by Writer are numbered. Filter keys the masks it caches by the bounds of a RangeIndex (see mask_cache.index_key)
+    """
+    values = df.index.to_numpy()
+    if isinstance(df.index, pd.RangeIndex) or values.dtype.kind not in "iu":
+        return df
+    if values.size == 0 or (values[0] == start and np.all(np.diff(values) == 1)):
+        df.index = pd.RangeIndex(start, start + values.size)
+    return df
+
+
+def _read_rows(rows: Tuple[int, int], file: str, key: str, columns: Optional[List[str]]) -> pd.DataFrame:
+    return _row_index(pd.read_hdf(file, key=key, columns=columns, start=rows[0], stop=rows[1]), rows[0])
+
+
+def _read_hdf_range(file, key, columns, start, stop) -> dd.DataFrame:
+    """ Dask DataFrame of the rows [start, stop) of the table `key`, in partitions of READ_ROWS rows. dd.read_hdf
+    reads past `stop` in its last partition
+    """
+    meta = pd.read_hdf(file, key=key, columns=columns, stop=0)
+    if start >= stop:
+        return dd.from_pandas(meta, npartitions=1)
+    ranges = [(low, min(low + READ_ROWS, stop)) for low in range(start, stop, READ_ROWS)]
+    return dd.from_map(_read_rows, ranges, file=file, key=key, columns=columns, meta=meta)
+
+
+def _thread_ranges(offsets: np.ndarray) -> List[Tuple[int, int]]:
+    """ Row ranges of at most READ_ROWS rows made of the consecutive thread slices [offsets[i], offsets[i + 1]).
+    The rows of a thread of more than READ_ROWS rows are split between consecutive ranges
+    """
+    bounds = offsets.tolist()
+    ranges, low = [], bounds[0]
+    for previous, high in zip(bounds[:-1], bounds[1:]):
+        if high - low > READ_ROWS and previous > low:
+            ranges.append((low, previous))
+            low = previous
+        while high - low > READ_ROWS:
+            ranges.append((low, low + READ_ROWS))
+            low += READ_ROWS
+    if bounds[-1] > low:
+        ranges.append((low, bounds[-1]))
+    return ranges
+
+
+def thread_rows(partitions: Tuple[np.ndarray, np.ndarray], appl: int, task: int, thread: int) -> Tuple[int, int]:
+    """ [start, stop) rows of the thread appl.task.thread in a table partitioned by thread, (0, 0) if it has no rows.
+    `partitions` are the sorted threads (appl, task, thread) of the table and the offsets of their rows
+    """
+    threads, offsets = partitions
+    found = np.flatnonzero((threads == (appl, task, thread)).all(axis=1)) if threads.size > 0 else []
+    if len(found) == 0:
+        return 0, 0
+    return int(offsets[found[0]]), int(offsets[found[0] + 1])
+
+
+def _read_hdf_threads(file, key, columns, partitions: Tuple[np.ndarray, np.ndarray]) -> dd.DataFrame:
+    """ Dask DataFrame of the table `key` partitioned by thread, its partitions made of consecutive threads (see
+    _thread_ranges), so a thread is only split when it has more than READ_ROWS rows. Its divisions are the row
+    numbers where the partitions start, so .loc over them only reads the partitions asked. Its meta has the
+    `partitions` of the table in its attrs (THREAD_PARTITIONS)
+    """
+    meta = pd.read_hdf(file, key=key, columns=columns, stop=0)
+    meta.attrs[THREAD_PARTITIONS] = partitions
+    ranges = _thread_ranges(partitions[1])
+    if len(ranges) == 0:
+        return dd.from_pandas(meta, npartitions=1)
+    divisions = tuple(low for low, _ in ranges) + (ranges[-1][1] - 1,)
+    return dd.from_map(_read_rows, ranges, file=file, key=key, columns=columns, meta=meta, divisions=divisions)
+
+
+def _try_read_hdf(file, key, use_dask, record=None, columns=None, start=None, stop=None, partitions=None):
     if use_dask:
         try:
-            return dd.read_hdf(file, key=key)
-        except ValueError:
+            if partitions is not None and start is None and stop is None:
+                return _read_hdf_threads(file, key, columns, partitions)
+            with pd.HDFStore(file, mode="r") as store:
+                nrows = store.get_storer(key).nrows
+            stop = nrows if stop is None else min(stop, nrows)
+            return _read_hdf_range(file, key, columns, start or 0, stop)
+        except (KeyError, ValueError):
             return dd.from_array(np.array([[]]))
     else:
         try:
-            return pd.read_hdf(file, key=key)
+            df = _row_index(pd.read_hdf(file, key=key, columns=columns, start=start, stop=stop), start or 0)
         except KeyError:
             return pd.DataFrame([])
+        # Files written before the compact dtypes were introduced store every column as int64
+        return df if record is None else compact_dataframe(df, record)
+
+
+def _json_attr(value):
+    if isinstance(value, (str, bytes)):
+        return json.loads(value)
+    # Files written before metadata was stored as JSON
+    return value.tolist() if isinstance(value, np.ndarray) else value
+
+
+def _str_attr(value) -> str:
+    # Attributes written with PyTables are read as bytes
+    return value.decode() if isinstance(value, (bytes, np.bytes_)) else str(value)
+
+
+class _Loc:
+    def __init__(self, table: "HDF5Table"):
+        self.table = table
+
+    def __getitem__(self, predicate: Predicate) -> pd.DataFrame:
+        return self.table.read(predicate)
+
+
+class HDF5Table:
+    """ Lazy handle of a record table of an .hdf file. Indexing it by column name gives a Column whose comparisons
+    build a Predicate, so a Filter chain over the table (e.g. Filter().add_operator(table, Record.event_t, "==", 1))
+    is only evaluated when it is executed, reading just the matching rows from disk
+    """
+
+    def __init__(self, file: str, key: str, columns: Optional[List[str]] = None, layout: Optional[Dict] = None):
+        self.file = file
+        self.key = key
+        self.columns = columns
+        self._layout = layout
+
+    @property
+    def layout(self) -> Dict:
+        if self._layout is None:
+            self._layout = HDF5Reader().parse_layout(self.file)
+        return self._layout
+
+    @property
+    def loc(self) -> _Loc:
+        return _Loc(self)
+
+    def __getitem__(self, item: Union[str, List[str]]):
+        if isinstance(item, str):
+            return Column(item)
+        return HDF5Table(self.file, self.key, list(item), self._layout)
+
+    def __len__(self):
+        with pd.HDFStore(self.file, mode="r") as store:
+            return store.get_storer(self.key).nrows if self.key in store else 0
+
+    def row_range(self, predicate: Predicate) -> Tuple[int, int]:
+        """ [start, stop) rows that can contain matches of `predicate`, from the bounds of the sort column of the
+        chunks of the table. The whole table if it isn't sorted or the predicate doesn't bound its sort column
+        """
+        if predicate.is_unsatisfiable():
+            return 0, 0
+        nrows = len(self)
+        sort_column = self.layout["sorted_by"].get(self.key)
+        if sort_column is None:
+            return 0, nrows
+        low, high = predicate.bounds(sort_column)
+        chunks = self.layout["chunks"][self.key]
+        chunk_rows = self.layout["chunk_rows"]
+        # Sorted table: the first chunk that can match is the first whose last value is >= low, and the last is the
+        # last one whose first value is <= high
+        first = 0 if low is None else int(np.searchsorted(chunks[:, 1], low, side="left"))
+        last = len(chunks) if high is None else int(np.searchsorted(chunks[:, 0], high, side="right"))
+        start, stop = first * chunk_rows, min(last * chunk_rows, nrows)
+        return (start, stop) if start < stop else (0, 0)
+
+    def thread_rows(self, appl: int, task: int, thread: int) -> Optional[Tuple[int, int]]:
+        """ [start, stop) rows of the thread appl.task.thread in a table partitioned by thread, (0, 0) if it has no
+        rows. None if the table isn't partitioned
+        """
+        partitions = self.layout["partitions"].get(self.key)
+        return None if partitions is None else thread_rows(partitions, appl, task, thread)
+
+    def read_thread(self, appl: int, task: int, thread: int) -> pd.DataFrame:
+        """ Rows of the thread appl.task.thread (see HDF5Reader.parse_thread) """
+        return HDF5Reader().parse_thread(self.file, self.key, appl, task, thread, self.columns)
+
+    def read(self, predicate: Optional[Predicate] = None) -> pd.DataFrame:
+        return HDF5Reader().read_table(self.file, self.key, self.columns, predicate, table=self)
 
 
 class HDF5Reader:
+    def read_table(
+        self,
+        file: str,
+        key: str,
+        columns: Optional[List[str]] = None,
+        predicate: Optional[Predicate] = None,
+        table: Optional[HDF5Table] = None,
+    ) -> pd.DataFrame:
+        """ Reads the rows of the table `key` that satisfy `predicate`, only the `columns` given. The predicate is
+        pushed down to PyTables as a `where` condition over the rows left by HDF5Table.row_range. If it selects
+        event types and the file has their inverted index, only the rows of those types are read. Files of layout
+        version 0 have no data columns, so it's evaluated in memory reading READ_ROWS rows at a time
+        """
+        table = table if table is not None else HDF5Table(file, key, columns)
+        with span("read_table") as read, pd.HDFStore(file, mode="r") as store:
+            if key not in store:
+                return pd.DataFrame([])
+            if predicate is None or len(predicate.conditions) == 0:
+                df = store.select(key, columns=columns)
+            elif table.layout["version"] >= 1:
+                start, stop = table.row_range(predicate)
+                event_types = predicate.values("event_t") if key == "Events" else None
+                event_index = self.parse_event_index(file) if event_types is not None else None
+                if event_index is not None and start < stop:
+                    # Read only the rows of the event types asked, then check the rest of the predicate on them
+                    positions = event_index.positions(event_types)
+                    positions = positions[np.searchsorted(positions, start): np.searchsorted(positions, stop)]
+                    logger.debug(f"Reading {positions.size} rows of {key} of the event types {event_types}")
+                    df = store.select(key, where=positions) if positions.size > 0 else store.select(key, stop=0)
+                    df = df.loc[predicate.mask(df)]
+                    df = df if columns is None else df[columns]
+                else:
+                    logger.debug(f"Reading rows [{start}, {stop}) of {key} where {predicate.where()}")
+                    where = predicate.where() if start < stop else None
+                    df = store.select(key, where=where, start=start, stop=stop, columns=columns)
+            else:
+                chunks = [chunk.loc[predicate.mask(chunk)] for chunk in store.select(key, chunksize=READ_ROWS)]
+                df = pd.concat(chunks) if len(chunks) > 0 else store.select(key, stop=0)
+                df = df if columns is None else df[columns]
+            read.add(bytes=df.memory_usage(index=True).sum(), records=df.shape[0])
+        return compact_dataframe(df, RECORDS[key]) if key in RECORDS else df
+
+    def parse_nrows(self, file: str) -> Dict[str, int]:
+        """ Rows of each record table of the file, 0 for the tables it doesn't have """
+        with pd.HDFStore(file, mode="r") as store:
+            return {key: store.get_storer(key).nrows if key in store else 0 for key in RECORDS}
+
+    def parse_event_index(self, file: str) -> Optional[EventIndex]:
+        """ Inverted index of the event types, None for files written before layout version 2 """
+        with h5py.File(file, "r") as f:
+            if EVENT_INDEX not in f:
+                return None
+        return EventIndex(file)
+
+    def parse_timeline(self, file: str, start: int = None, end: int = None, pixels: int = 1000) -> Optional[Timeline]:
+        """ Timelines of the threads in [start, end) to draw them `pixels` wide, read from the level of detail
+        pyramid (see timeline.read_timeline) in time proportional to the pixels. None for files without it
+        """
+        return read_timeline(file, start, end, pixels)
+
+    def parse_tables(self, file: str) -> Tuple[HDF5Table, HDF5Table, HDF5Table]:
+        """ Lazy version of parse_records, nothing is read until the tables are queried """
+        layout = self.parse_layout(file)
+        return tuple(HDF5Table(file, key, layout=layout) for key in RECORDS)
+
+    def parse_layout(self, file: str) -> Dict:
+        """ Storage layout of the record tables (see Writer). Files without a layout version are version 0:
+        unsorted, uncompressed and without indexes. The tables partitioned by thread have, in "partitions", their
+        sorted threads (appl, task, thread) and the offsets of their rows
+        """
+        with h5py.File(file, "r") as f:
+            records = f.get("RECORDS")
+            attrs = records.attrs if records is not None else {}
+            layout = {"version": int(attrs.get("layout_version", 0)), "sorted_by": {}, "chunks": {}, "partitions": {}}
+            layout["max_duration"] = {}
+            layout["partitioned"] = bool(attrs.get("partitioned", False))
+            if layout["version"] >= 1:
+                layout["chunk_rows"] = int(attrs["chunk_rows"])
+                for key in ("States", "Events", "Comm", INTERVALS):
+                    if f"{key}_sorted_by" in attrs:
+                        layout["sorted_by"][key] = _str_attr(attrs[f"{key}_sorted_by"])
+                        layout["chunks"][key] = records[f"{key}_chunks"][()]
+                    if f"{key}_max_duration" in attrs:
+                        layout["max_duration"][key] = int(attrs[f"{key}_max_duration"])
+                    if f"{key}_partitioned_by" in attrs:
+                        partitions = f[partitions_node(key)]
+                        layout["partitions"][key] = (partitions["threads"][()], partitions["offsets"][()])
+        return layout
+
     def parse_metadata(self, file: str):
         with h5py.File(file, "r") as f:
             records = f["RECORDS"]
@@ -37,14 +309,83 @@ class HDF5Reader:
                 records.attrs["type"],
                 records.attrs["exec_time"],
                 datetime.fromtimestamp(records.attrs["date_time"]),
-                records.attrs["nodes"],
-                json.loads(str(records.attrs["apps"])),
+                _json_attr(records.attrs["nodes"]),
+                _json_attr(records.attrs["apps"]),
+                int(records.attrs.get("layout_version", 0)),
+                bool(records.attrs.get("partitioned", False)),
             )
         return trace_metadata
 
+    def parse_table(
+        self,
+        file: str,
+        key: str,
+        columns: Optional[List[str]] = None,
+        start: Optional[int] = None,
+        stop: Optional[int] = None,
+        use_dask=False,
+    ):
+        """ Reads the rows [start, stop) of the `columns` of the record table `key` (States, Events or Comm) or of
+        the Intervals table. Only the columns asked are read from disk, each one is stored apart. The Dask
+        DataFrames of the tables partitioned by thread have their partitions aligned to the threads
+        """
+        partitions = None
+        if use_dask and start is None and stop is None:
+            partitions = self.parse_layout(file)["partitions"].get(key)
+        with span("parse_table") as read:
+            df = _try_read_hdf(file, key, use_dask, RECORDS.get(key), columns, start, stop, partitions)
+            if not use_dask:
+                read.add(bytes=df.memory_usage(index=True).sum(), records=df.shape[0])
+        if not use_dask:
+            layout = self.parse_layout(file)
+            # Lets Filter select time ranges with binary searches
+            sort_column = layout["sorted_by"].get(key)
+            if sort_column is not None and sort_column in df.columns:
+                tag_sorted(df, sort_column)
+            if key in layout["max_duration"]:
+                df.attrs[MAX_DURATION] = layout["max_duration"][key]
+            # Lets Filter select event types without comparing every row
+            event_index = self.parse_event_index(file) if key == "Events" else None
+            if event_index is not None:
+                attach_event_index(df, event_index)
+        return df
+
+    def parse_thread(
+        self, file: str, key: str, appl: int, task: int, thread: int, columns: Optional[List[str]] = None
+    ) -> pd.DataFrame:
+        """ Rows of the thread appl.task.thread of the table `key`, sorted by time. Tables partitioned by thread
+        read just its slice, the rest are queried by the columns of the thread
+        """
+        with span("parse_thread") as read:
+            rows = HDF5Table(file, key).thread_rows(appl, task, thread)
+            if rows is not None:
+                df = _try_read_hdf(file, key, False, RECORDS.get(key), columns, *rows)
+            else:
+                thread_values = zip(THREAD_COLUMNS[key], (appl, task, thread))
+                predicate = Predicate((column, "==", value) for column, value in thread_values)
+                df = self.read_table(file, key, columns, predicate)
+            read.add(bytes=df.memory_usage(index=True).sum(), records=df.shape[0])
+        return df
+
+    def parse_records(self, file: str, use_dask=False):
+        return tuple(self.parse_table(file, key, use_dask=use_dask) for key in RECORDS)
+
+    def open_trace(self, file: str, use_dask=True) -> LazyTrace:
+        """ Trace of the file that only reads its metadata. Its DataFrames are opened the first time they are used,
+        and LazyTrace.read reads just some columns or rows of a table
+        """
+        metadata = self.parse_metadata(file)
+        trace = LazyTrace(metadata, partial(self._parse_trace_table, metadata.name, file, use_dask=use_dask))
+        # Stored with the States, so the time windows of Dask DataFrames don't compute it
+        trace._max_state_duration = self.parse_layout(file)["max_duration"].get("States")
+        return trace
+
+    def _parse_trace_table(self, trace_name: str, file: str, key: str, use_dask=False, **kwargs):
+        """ parse_table recorded in the instrumentation report of the trace """
+        with record(trace_name):
+            return self.parse_table(file, key, use_dask=use_dask, **kwargs)
+
     def parse_file(self, file: str, use_dask=False):
-        df_state_tmp = _try_read_hdf(file, key="States", use_dask=use_dask)
-        df_event_tmp = _try_read_hdf(file, key="Events", use_dask=use_dask)
-        df_comm_tmp = _try_read_hdf(file, key="Comm", use_dask=use_dask)
+        df_state_tmp, df_event_tmp, df_comm_tmp = self.parse_records(file, use_dask=use_dask)
         trace_metadata = self.parse_metadata(file)
         return trace_metadata, df_state_tmp, df_event_tmp, df_comm_tmp
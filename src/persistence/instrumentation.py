@@ -0,0 +1,248 @@
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+# Spans are only recorded when enabled, otherwise span() returns a shared object that does nothing
+INSTRUMENT = os.environ.get("INSTRUMENT", "0").lower() not in ("", "0", "false", "no")
+# Interval between two samples of the resident memory of the process, in seconds
+RSS_INTERVAL = 0.01
+# Reports kept, one per trace (the last conversion or read of each one)
+REPORTS_KEPT = int(os.environ.get("REPORTS_KEPT", 32))
+
+
+def rss() -> int:
+    """ Resident memory of the process in bytes """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # Not Linux, the peak of the whole process is the best there is (KB in Linux, bytes in macOS)
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+class Span:
+    """ Timed stage of the pipeline, with the bytes and records it processed and the peak resident memory while it
+    ran. The spans opened inside it are its children, merged by name: a stage run once per chunk is a single child
+    with as many calls
+    """
+
+    __slots__ = ("name", "calls", "seconds", "bytes", "records", "rss_start", "peak_rss", "children", "_start")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        self.records = 0
+        self.rss_start = 0
+        self.peak_rss = 0
+        self.children: "OrderedDict[str, Span]" = OrderedDict()
+
+    def add(self, bytes: int = 0, records: int = 0):
+        self.bytes += int(bytes)
+        self.records += int(records)
+
+    def __enter__(self):
+        _open(self)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self._start
+        self.calls = 1
+        _close(self)
+
+    def merge(self, other: "Span"):
+        self.calls += other.calls
+        self.seconds += other.seconds
+        self.bytes += other.bytes
+        self.records += other.records
+        if self.peak_rss - self.rss_start < other.peak_rss - other.rss_start:
+            self.rss_start, self.peak_rss = other.rss_start, other.peak_rss
+        for name, child in other.children.items():
+            self.children.setdefault(name, Span(name)).merge(child)
+
+    def to_dict(self) -> Dict:
+        return {
+            "name": self.name,
+            "calls": self.calls,
+            "seconds": self.seconds,
+            "bytes": self.bytes,
+            "records": self.records,
+            "mb_per_s": self.bytes / MB / self.seconds if self.seconds > 0 else None,
+            "records_per_s": self.records / self.seconds if self.seconds > 0 else None,
+            "peak_rss_mb": self.peak_rss / MB,
+            "rss_growth_mb": (self.peak_rss - self.rss_start) / MB,
+            "children": [child.to_dict() for child in self.children.values()],
+        }
+
+
+class _NullSpan:
+    """ span() when the instrumentation is disabled """
+
+    def add(self, bytes: int = 0, records: int = 0):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Recorder:
+    """ Spans of a trace, merged by name """
+
+    def __init__(self, name: str = ""):
+        self.name = name
+        self.spans: "OrderedDict[str, Span]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, span: Span):
+        with self._lock:
+            self.spans.setdefault(span.name, Span(span.name)).merge(span)
+
+    def report(self) -> Dict:
+        with self._lock:
+            return {"name": self.name, "spans": [span.to_dict() for span in self.spans.values()]}
+
+    def to_json(self) -> str:
+        return json.dumps(self.report(), indent=2)
+
+
+_enabled = INSTRUMENT
+_local = threading.local()
+# Spans not recorded by any trace
+_default = Recorder()
+_recorders: "OrderedDict[str, Recorder]" = OrderedDict()
+_reports_lock = threading.Lock()
+
+# Spans open in any thread, their peak memory is updated by the sampler thread
+_open_spans = set()
+_open_lock = threading.Lock()
+_sampler: Optional[threading.Thread] = None
+
+
+def _sample():
+    while _enabled:
+        current = rss()
+        with _open_lock:
+            for span in _open_spans:
+                span.peak_rss = max(span.peak_rss, current)
+        time.sleep(RSS_INTERVAL)
+
+
+def _start_sampler():
+    global _sampler
+    if _sampler is None or not _sampler.is_alive():
+        _sampler = threading.Thread(target=_sample, name="instrumentation", daemon=True)
+        _sampler.start()
+
+
+def _stack() -> List[Span]:
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def _open(span: Span):
+    span.rss_start = span.peak_rss = rss()
+    with _open_lock:
+        _open_spans.add(span)
+    _stack().append(span)
+
+
+def _close(span: Span):
+    span.peak_rss = max(span.peak_rss, rss())
+    with _open_lock:
+        _open_spans.discard(span)
+    stack = _stack()
+    stack.pop()
+    if len(stack) > 0:
+        stack[-1].children.setdefault(span.name, Span(span.name)).merge(span)
+    else:
+        (getattr(_local, "recorder", None) or _default).add(span)
+
+
+def enable():
+    global _enabled
+    _enabled = True
+    _start_sampler()
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def span(name: str):
+    """ Context manager that times the stage `name`, nested in the span open in the same thread if any. Its
+    add(bytes=, records=) counts what the stage processed. Does nothing unless the instrumentation is enabled.
+    Spans of the parser's worker processes are not recorded
+    """
+    if not _enabled:
+        return _NULL_SPAN
+    return Span(name)
+
+
+@contextmanager
+def record(name: str, reset: bool = False):
+    """ Records the spans of the block run in this thread in the report of the trace `name` (see reports), after
+    the ones recorded before unless `reset`. The report is logged at the end of the block
+    """
+    if not _enabled:
+        yield None
+        return
+    with _reports_lock:
+        if reset or name not in _recorders:
+            _recorders[name] = Recorder(name)
+        recorder = _recorders[name]
+        _recorders.move_to_end(name)
+        while len(_recorders) > REPORTS_KEPT:
+            _recorders.popitem(last=False)
+    previous = getattr(_local, "recorder", None)
+    _local.recorder = recorder
+    try:
+        yield recorder
+    finally:
+        _local.recorder = previous
+        if len(recorder.spans) > 0:
+            logger.info(f"Instrumentation of {name}: {json.dumps(recorder.report())}")
+
+
+def reports() -> List[Dict]:
+    """ Report of each trace recorded, the spans recorded out of any trace last """
+    with _reports_lock:
+        recorded = [recorder.report() for recorder in _recorders.values()]
+    default = _default.report()
+    return recorded + ([default] if len(default["spans"]) > 0 else [])
+
+
+def clear():
+    global _default
+    with _reports_lock:
+        _recorders.clear()
+    _default = Recorder()
+
+
+if _enabled:
+    _start_sampler()
@@ -0,0 +1,138 @@
+import logging
+import operator
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+_OPERATORS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "in": lambda column, values: column.isin(values),
+}
+
+
+def _scalar(value):
+    # numpy scalars are written as np.int64(1) by repr, PyTables conditions need plain literals
+    return value.item() if isinstance(value, np.generic) else value
+
+
+class Predicate:
+    """ Conjunction of (column, operator, value) conditions that can be pushed down to the HDF5 reader as a
+    PyTables `where` expression, or evaluated over a DataFrame already in memory
+    """
+
+    def __init__(self, conditions: Iterable[Tuple[str, str, object]]):
+        self.conditions = list(conditions)
+
+    def __and__(self, other: "Predicate") -> "Predicate":
+        return Predicate(self.conditions + other.conditions)
+
+    def __repr__(self):
+        return f"Predicate({' & '.join(self.where()) or 'True'})"
+
+    @property
+    def columns(self) -> List[str]:
+        return list(dict.fromkeys(column for column, _, _ in self.conditions))
+
+    def where(self) -> List[str]:
+        """ Terms of the `where` argument of pd.read_hdf, AND-ed together """
+        terms = []
+        for column, op, value in self.conditions:
+            if op == "in":
+                terms.append(f"{column} in {[_scalar(v) for v in value]!r}")
+            else:
+                terms.append(f"{column} {op} {_scalar(value)!r}")
+        return terms
+
+    def bounds(self, column: str) -> Tuple[Optional[object], Optional[object]]:
+        """ Inclusive (low, high) bounds of the values of `column` that can satisfy the predicate. None if
+        unbounded. Strict comparisons give the same bounds as the non strict ones, they are only used to skip
+        chunks of rows that can't match
+        """
+        low, high = None, None
+        for name, op, value in self.conditions:
+            if name != column:
+                continue
+            if op == "in":
+                values = list(value)
+                if len(values) == 0:
+                    return 1, 0
+                op_low, op_high = min(values), max(values)
+            elif op == "==":
+                op_low, op_high = value, value
+            elif op in (">", ">="):
+                op_low, op_high = value, None
+            elif op in ("<", "<="):
+                op_low, op_high = None, value
+            else:
+                continue
+            if op_low is not None:
+                low = op_low if low is None else max(low, op_low)
+            if op_high is not None:
+                high = op_high if high is None else min(high, op_high)
+        return low, high
+
+    def values(self, column: str) -> Optional[List]:
+        """ Values of `column` allowed by its `==` and `in` conditions, None if it has none """
+        allowed = None
+        for name, op, value in self.conditions:
+            if name != column or op not in ("==", "in"):
+                continue
+            values = {_scalar(v) for v in value} if op == "in" else {_scalar(value)}
+            allowed = values if allowed is None else allowed & values
+        return None if allowed is None else sorted(allowed)
+
+    def is_unsatisfiable(self) -> bool:
+        """ True if no row can satisfy the predicate, e.g. `in` an empty list or disjoint ranges of a column """
+        for column in self.columns:
+            low, high = self.bounds(column)
+            if low is not None and high is not None and low > high:
+                return True
+        return False
+
+    def mask(self, df: pd.DataFrame) -> pd.Series:
+        mask = pd.Series(True, index=df.index)
+        for column, op, value in self.conditions:
+            mask &= _OPERATORS[op](df[column], value)
+        return mask
+
+
+class Column:
+    """ Column of a table stored on disk. Comparing it builds a Predicate instead of a boolean mask, so the
+    functions of core.filter work unchanged on a persistence.hdf5_reader.HDF5Table
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def _predicate(self, op: str, value) -> Predicate:
+        return Predicate([(self.name, op, value)])
+
+    def __eq__(self, value) -> Predicate:
+        return self._predicate("==", value)
+
+    def __ne__(self, value) -> Predicate:
+        return self._predicate("!=", value)
+
+    def __lt__(self, value) -> Predicate:
+        return self._predicate("<", value)
+
+    def __le__(self, value) -> Predicate:
+        return self._predicate("<=", value)
+
+    def __gt__(self, value) -> Predicate:
+        return self._predicate(">", value)
+
+    def __ge__(self, value) -> Predicate:
+        return self._predicate(">=", value)
+
+    def isin(self, values: Iterable) -> Predicate:
+        return self._predicate("in", list(values))
@@ -1,13 +1,20 @@
+import hashlib
+import json
 import logging
 import os
 from datetime import datetime
-from typing import Tuple
+from typing import Callable, Dict, Tuple
 
 import dask.dataframe as dd
 import h5py
 
+from src.persistence.arrow_reader import ArrowReader
+from src.persistence.arrow_writer import ARROW_LAYOUT_VERSION, FORMATS, ArrowWriter, storage_format
+from src.persistence.format_converter import open_trace_file, uncompressed_name
+from src.persistence.hdf5_reader import HDF5Reader
+from src.persistence.instrumentation import record, span
 from src.persistence.prv_to_hdf5 import ParaverToHDF5
-from src.persistence.writer import Writer
+from src.persistence.writer import LAYOUT_VERSION, PARTITION_THREADS, Writer
 from src.Trace import TraceMetaData
 
 logger = logging.getLogger(__name__)
@@ -15,6 +22,31 @@ logger.setLevel(logging.DEBUG)
 
 PARAVER_FILE = "Paraver (.prv)"
 PARAVER_MAGIC_HEADER = "#Paraver"
+# Bytes of the beginning and of the end of a .prv file hashed to tell whether it changed since it was converted
+FINGERPRINT_BYTES = 1024 * 1024
+SOURCE_ATTRS = ("source_path", "source_size", "source_mtime", "source_fingerprint")
+# Storage of the converted traces: an .hdf file (see Writer) or a directory of Parquet or Arrow IPC files (see
+# ArrowWriter)
+STORAGE = os.environ.get("STORAGE", "hdf")
+
+
+def source_fingerprint(file: str) -> Dict:
+    """ Identifies the contents of `file` without reading it all: its path, size, modification time and a hash of
+    its first and last FINGERPRINT_BYTES
+    """
+    stat = os.stat(file)
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file, "rb") as f:
+        digest.update(f.read(FINGERPRINT_BYTES))
+        if stat.st_size > FINGERPRINT_BYTES:
+            f.seek(max(FINGERPRINT_BYTES, stat.st_size - FINGERPRINT_BYTES))
+            digest.update(f.read())
+    return {
+        "source_path": os.path.abspath(file),
+        "source_size": stat.st_size,
+        "source_mtime": stat.st_mtime_ns,
+        "source_fingerprint": digest.hexdigest(),
+    }
 
 
 class ParaverReader:
@@ -80,39 +112,154 @@ class ParaverReader:
             records.attrs["type"] = trace_metadata.type
             records.attrs["exec_time"] = trace_metadata.exec_time
             records.attrs["date_time"] = trace_metadata.date_time.timestamp()
-            records.attrs["nodes"] = trace_metadata.nodes
-            apps_str = []
-            for app in apps_str:
-                apps_str.append([])
-                for task in app:
-                    apps_str[-1].append(str(task))
-            records.attrs["apps"] = apps_str
-
-    def parse_file(self, file: str) -> Tuple[TraceMetaData, dd.DataFrame, dd.DataFrame, dd.DataFrame]:
+            # JSON strings, HDF5 attributes can store neither None nor nested lists of dicts
+            records.attrs["nodes"] = json.dumps(trace_metadata.nodes)
+            records.attrs["apps"] = json.dumps(trace_metadata.apps)
+
+    def write_source_to_hdf5(self, file_hdf5, source: Dict):
+        with h5py.File(file_hdf5, "a") as f:
+            records = f.require_group("RECORDS")
+            for attr in SOURCE_ATTRS:
+                records.attrs[attr] = source[attr]
+
+    def clear_source_from_hdf5(self, file_hdf5):
+        """ Invalidates the .hdf file while it's rewritten, so a conversion that doesn't finish isn't reused """
+        if not os.path.isfile(file_hdf5):
+            return
+        with h5py.File(file_hdf5, "a") as f:
+            if "RECORDS" in f:
+                for attr in SOURCE_ATTRS:
+                    if attr in f["RECORDS"].attrs:
+                        del f["RECORDS"].attrs[attr]
+
+    def is_converted(self, file_hdf5, source: Dict, partition_threads: bool = False) -> bool:
+        """ True if `file_hdf5` was converted, with the current layout (partitioned by thread or not), from the file
+        identified by `source`
+        """
+        if os.path.isdir(file_hdf5):
+            # Directory of Parquet or Arrow IPC files
+            reader = ArrowReader()
+            stored = reader.parse_source(file_hdf5)
+            if reader.parse_layout(file_hdf5)["version"] != ARROW_LAYOUT_VERSION or stored is None:
+                return False
+            return all(stored.get(attr) == source[attr] for attr in SOURCE_ATTRS)
+        if not os.path.isfile(file_hdf5):
+            return False
         try:
-            with open(file, "r") as f:
+            with h5py.File(file_hdf5, "r") as f:
+                attrs = f["RECORDS"].attrs
+                if int(attrs.get("layout_version", 0)) != LAYOUT_VERSION:
+                    return False
+                if bool(attrs.get("partitioned", False)) != partition_threads:
+                    return False
+                stored = {attr: attrs.get(attr) for attr in SOURCE_ATTRS}
+        except (OSError, KeyError):
+            return False
+        stored = {attr: value.decode() if isinstance(value, bytes) else value for attr, value in stored.items()}
+        return all(stored[attr] == source[attr] for attr in SOURCE_ATTRS)
+
+    def _writer(self, storage: str, partition_threads: bool = False) -> Tuple[Callable, Callable, int]:
+        """ Streaming and DataFrame writers of the records in `storage`, and the layout version they write """
+        if storage == "hdf":
+            writer = Writer(partition_threads)
+            return writer.records_to_hdf5, writer.dataframe_to_hdf5, LAYOUT_VERSION
+        writer = ArrowWriter(storage)
+        return writer.records_to_arrow, writer.dataframe_to_arrow, ARROW_LAYOUT_VERSION
+
+    def convert(
+        self,
+        file: str,
+        streaming: bool = True,
+        force: bool = False,
+        progress: Callable = None,
+        storage: str = None,
+        partition_threads: bool = None,
+    ) -> TraceMetaData:
+        """ Converts the .prv file (or .prv.gz, .prv.bz2 or .prv.xz, decompressed on the fly) to a .hdf file next to
+        it and returns its metadata. With streaming=True every parsed chunk is appended to the HDF5 tables and
+        dropped, so memory doesn't grow with the trace size.
+        The conversion is skipped if the .hdf file was already converted from the same .prv file (see
+        source_fingerprint), unless `force`.
+        While streaming, progress(bytes_parsed, records_parsed) is called after each chunk (see
+        ParaverToHDF5.iter_records).
+        `storage` (STORAGE by default) is "hdf", or "parquet" or "arrow" to write a directory of Parquet or Arrow IPC
+        files instead (see ArrowWriter).
+        With `partition_threads` (PARTITION_THREADS by default) the records of the .hdf file are partitioned by
+        thread instead of sorted by time (see Writer._partition_table)
+        """
+        storage = storage or STORAGE
+        if storage != "hdf" and storage not in FORMATS:
+            raise Exception(f"Unknown storage format {storage}. Formats are: hdf, {', '.join(FORMATS)}")
+        partition_threads = PARTITION_THREADS if partition_threads is None else partition_threads
+        if partition_threads and storage != "hdf":
+            raise Exception(f"Cannot partition the records by thread in {storage} storage, only in hdf.")
+        try:
+            # Only the first block of a compressed trace is decompressed to read its header
+            with open_trace_file(file, "rt") as f:
                 header = f.readline()
                 if PARAVER_MAGIC_HEADER not in header:
-                    logger.error(f"The file {f.name} is not a valid Paraver file!")
+                    logger.error(f"The file {file} is not a valid Paraver file!")
 
-                logger.info(f"Parsing {f}")
-                trace_name = os.path.basename(f.name)
-                trace_path = os.path.abspath(f.name)
+                logger.info(f"Parsing {file}")
+                trace_name = os.path.basename(uncompressed_name(file))
+                trace_path = os.path.abspath(uncompressed_name(file))
                 trace_type = PARAVER_FILE
 
                 trace_exec_time, trace_date, trace_nodes, trace_apps = self.header_parser(header)
-                new_trace_name = trace_name.replace(".prv", ".hdf")
-                new_trace_path = trace_path.replace(".prv", ".hdf")
+                new_trace_name = trace_name.replace(".prv", f".{storage}")
+                new_trace_path = trace_path.replace(".prv", f".{storage}")
 
-                df_state, df_event, df_comm = ParaverToHDF5().parse_as_dataframe(file, use_dask=True)
-                Writer().dataframe_to_hdf5(new_trace_name, df_state, df_event, df_comm)
+                source = source_fingerprint(file)
+                if not force and self.is_converted(new_trace_path, source, partition_threads):
+                    logger.info(f"{new_trace_path} is up to date, skipping the conversion")
+                    if storage == "hdf":
+                        return HDF5Reader().parse_metadata(new_trace_path)
+                    return ArrowReader().parse_metadata(new_trace_path)
+                if storage == "hdf":
+                    self.clear_source_from_hdf5(new_trace_path)
+                else:
+                    ArrowWriter(storage).clear_source(new_trace_path)
+                records_writer, dataframe_writer, layout_version = self._writer(storage, partition_threads)
+                with record(new_trace_name, reset=True), span("convert") as converted:
+                    converted.add(bytes=os.path.getsize(file))
+                    if streaming:
+                        rows = records_writer(new_trace_path, ParaverToHDF5().iter_records(file, progress=progress))
+                        converted.add(records=sum(rows.values()))
+                    else:
+                        df_state, df_event, df_comm = ParaverToHDF5().parse_as_dataframe(file, use_dask=True)
+                        dataframe_writer(new_trace_path, df_state, df_event, df_comm)
 
                 trace_metadata = TraceMetaData(
-                    new_trace_name, new_trace_path, trace_type, trace_exec_time, trace_date, trace_nodes, trace_apps
+                    new_trace_name,
+                    new_trace_path,
+                    trace_type,
+                    trace_exec_time,
+                    trace_date,
+                    trace_nodes,
+                    trace_apps,
+                    layout_version,
+                    partition_threads,
                 )
-                self.write_metadata_to_hdf5(new_trace_name, trace_metadata)
+                if storage == "hdf":
+                    self.write_metadata_to_hdf5(new_trace_path, trace_metadata)
+                    # Last, once the conversion is complete
+                    self.write_source_to_hdf5(new_trace_path, source)
+                else:
+                    ArrowWriter(storage).write_metadata(new_trace_path, trace_metadata)
+                    ArrowWriter(storage).write_source(new_trace_path, source)
         except FileNotFoundError:
             logger.error(f"Not able to access the file {file}")
             raise
 
+        return trace_metadata
+
+    def parse_file(
+        self, file: str, streaming: bool = True, force: bool = False, progress: Callable = None
+    ) -> Tuple[TraceMetaData, dd.DataFrame, dd.DataFrame, dd.DataFrame]:
+        """ Converts the .prv file (see convert) and returns its metadata and DataFrames that read the records
+        lazily from the converted trace, sorted by time
+        """
+        trace_metadata = self.convert(file, streaming, force, progress)
+        reader = ArrowReader() if storage_format(trace_metadata.path) in FORMATS else HDF5Reader()
+        df_state, df_event, df_comm = reader.parse_records(trace_metadata.path, use_dask=True)
         return trace_metadata, df_state, df_event, df_comm
@@ -1,15 +1,28 @@
+import codecs
 import itertools
 import logging
 import os
 import time
-from typing import List, Tuple
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, List, Tuple
 
 import dask.dataframe as dd
 import numpy as np
-import pandas as pd
 
 from src.CONST import CommRecord, EventRecord, StateRecord
-from src.persistence.format_converter import FormatConverter, chunk_reader, isplit
+from src.persistence.format_converter import (
+    FormatConverter,
+    chunk_reader,
+    is_compressed,
+    isplit,
+    mmap_chunk_reader,
+    newline_aligned_ranges,
+    newline_aligned_windows,
+    stream_chunk_reader,
+)
+from src.persistence.instrumentation import span
+from src.persistence.schema import records_to_dataframe
 
 logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -24,13 +37,171 @@ COMM_RECORD = "3"
 
 MB = 1024 * 1024
 GB = 1024 * 1024 * 1024
-MAX_READ_BYTES = int(os.environ.get("STEPS", GB * 2))
+MAX_READ_BYTES = int(os.environ.get("MAX_READ_BYTES", GB * 2))
 
-# For pre-allocating memory
-MIN_ELEM = int(os.environ.get("STEPS", 40000000))
+# Initial size of the arrays when the number of records of a chunk cannot be counted beforehand
+MIN_ELEM = int(os.environ.get("MIN_ELEM", 1000000))
 
 STEPS = int(os.environ.get("STEPS", 200000))
-RESIZE = 1
+# Growth factor of the arrays when they are full. Geometric growth keeps the cost of resizing amortized O(1)
+RESIZE = 2
+
+# Number of processes used to parse the trace body. 1 means sequential parsing
+WORKERS = int(os.environ.get("WORKERS", 1))
+
+# Rows of each partition of the dask DataFrames
+DASK_CHUNK_ROWS = 50000
+
+# Maximum bytes decoded at once by the vectorized decoder. It needs ~15 bytes of temporary memory per input byte
+DECODE_BYTES = int(os.environ.get("DECODE_BYTES", MB * 16))
+
+NEWLINE, COLON, ZERO, MINUS, CARRIAGE_RETURN = ord("\n"), ord(":"), ord("0"), ord("-"), ord("\r")
+
+INT64 = np.iinfo("int64")
+# Digits of the fields converted as a matrix, any number of up to 18 digits fits in an int64
+MATRIX_DIGITS = 18
+
+
+def _count_records(stcount: int, evcount: int, commcount: int) -> int:
+    """ Records of flat arrays of `stcount`, `evcount` and `commcount` elements """
+    return stcount // len(StateRecord) + evcount // len(EventRecord) + commcount // len(CommRecord)
+
+
+def _empty_records():
+    return (
+        np.empty((0, len(StateRecord)), dtype="int64"),
+        np.empty((0, len(EventRecord)), dtype="int64"),
+        np.empty((0, len(CommRecord)), dtype="int64"),
+    )
+
+
+def _token_values(data: np.ndarray, tok_start: np.ndarray, tok_len: np.ndarray, tokens: np.ndarray) -> np.ndarray:
+    """ Converts the decimal tokens `tokens`, optionally with a leading '-', to int64. Tokens are grouped by length
+    (a radix sort, the lengths are tiny integers) and each group is converted at once as a (tokens x digits) matrix.
+    Tokens of more than MATRIX_DIGITS digits could overflow it, they are converted one by one and checked
+    """
+    values = np.zeros(tok_start.size, dtype="int64")
+    starts, lengths = tok_start[tokens], tok_len[tokens]
+    negative = (lengths > 0) & (data[starts] == MINUS)
+    starts, lengths = starts + negative, lengths - negative
+    if np.any(lengths == 0):
+        raise ValueError("Found an empty field in a record.")
+    order = np.argsort(lengths.astype(np.uint8), kind="stable")
+    tokens, starts, lengths, negative = tokens[order], starts[order], lengths[order], negative[order]
+    bounds = np.searchsorted(lengths, np.arange(1, MATRIX_DIGITS + 2))
+    for length in range(1, MATRIX_DIGITS + 1):
+        group = slice(bounds[length - 1], bounds[length])
+        if bounds[length - 1] == bounds[length]:
+            continue
+        digits = data[starts[group][:, np.newaxis] + np.arange(length)] - ZERO
+        if np.any(digits > 9):
+            raise ValueError("Found a non numeric field in a record.")
+        values[tokens[group]] = digits @ (10 ** np.arange(length - 1, -1, -1, dtype="int64"))
+    values[tokens[: bounds[-1]][negative[: bounds[-1]]]] *= -1
+    for token, start, length, is_negative in zip(*(a[bounds[-1]:] for a in (tokens, starts, lengths, negative))):
+        digits = data[start: start + length].tobytes()
+        if not digits.isdigit():
+            raise ValueError("Found a non numeric field in a record.")
+        value = -int(digits) if is_negative else int(digits)
+        if not INT64.min <= value <= INT64.max:
+            raise ValueError("Found a field too long to fit in an int64.")
+        values[token] = value
+    return values
+
+
+def count_records(buffer) -> Tuple[int, int, int]:
+    """ Counting pre-pass over a buffer of complete .prv lines. Returns the exact number of elements that
+    parsing it produces for the State, Event and Comm arrays (Event lines count once per type:value pair)
+    """
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    if data.size == 0:
+        return 0, 0, 0
+    line_start = np.flatnonzero(data == NEWLINE) + 1
+    line_start = np.concatenate(([0], line_start[line_start < data.size]))
+    line_type = data[line_start]
+    is_event = line_type == ord(EVENT_RECORD)
+    # Event lines have 6 fields plus a type:value pair per event, all separated by ':'
+    colons = np.add.reduceat((data == COLON).view(np.uint8), line_start, dtype=np.int64)
+    event_pairs = int(np.sum((colons[is_event] - 5) // 2))
+    return (
+        int(np.count_nonzero(line_type == ord(STATE_RECORD))) * len(StateRecord),
+        event_pairs * len(EventRecord),
+        int(np.count_nonzero(line_type == ord(COMM_RECORD))) * len(CommRecord),
+    )
+
+
+def _reserve(arr: np.ndarray, size: int) -> np.ndarray:
+    """ Returns `arr` or, if it has less than `size` elements, a copy at least RESIZE times bigger """
+    if size <= arr.size:
+        return arr
+    logger.debug(f"Growing array from {arr.size} to {max(size, arr.size * RESIZE)} elements")
+    new_arr = np.empty(max(size, arr.size * RESIZE), dtype=arr.dtype)
+    new_arr[: arr.size] = arr
+    return new_arr
+
+
+def decode_records(buffer) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """ Vectorized decoder of a buffer of complete .prv lines (bytes, bytearray or memoryview).
+    Returns the State, Event and Comm records as 2D int64 arrays, one row per record (one row per
+    type/value pair for Events) in file order. Lines that are not records (header, communicators...) are ignored
+    """
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    if data.size == 0:
+        return _empty_records()
+    if data[-1] != NEWLINE:
+        data = np.concatenate((data, np.array([NEWLINE], dtype=np.uint8)))
+
+    # Every token ends in a separator (':' or '\n')
+    sep = np.flatnonzero((data == COLON) | (data == NEWLINE))
+    tok_start = np.empty_like(sep)
+    tok_start[0] = 0
+    tok_start[1:] = sep[:-1] + 1
+    tok_len = sep - tok_start
+    # Lines ended in '\r\n': the '\r' is not part of the last token
+    crlf = (data[sep] == NEWLINE) & (tok_len > 0) & (data[np.maximum(sep - 1, 0)] == CARRIAGE_RETURN)
+    tok_len -= crlf
+
+    # The last token of each line is the one ended by '\n'
+    line_last_tok = np.flatnonzero(data[sep] == NEWLINE)
+    line_first_tok = np.empty_like(line_last_tok)
+    line_first_tok[0] = 0
+    line_first_tok[1:] = line_last_tok[:-1] + 1
+    line_ntok = line_last_tok - line_first_tok + 1
+    line_type = data[tok_start[line_first_tok]]
+
+    is_state = line_type == ord(STATE_RECORD)
+    is_event = line_type == ord(EVENT_RECORD)
+    is_comm = line_type == ord(COMM_RECORD)
+    if np.any(line_ntok[is_state] != len(StateRecord) + 1):
+        raise ValueError("Found a State record with a wrong number of fields.")
+    if np.any(line_ntok[is_comm] != len(CommRecord) + 1):
+        raise ValueError("Found a Comm record with a wrong number of fields.")
+    # Record type, 5 common fields and at least 1 type:value pair
+    if np.any((line_ntok[is_event] < len(EventRecord) + 1) | ((line_ntok[is_event] - 6) % 2 != 0)):
+        raise ValueError("Found an Event record with a wrong number of fields.")
+
+    # Only the tokens of record lines are converted
+    is_record = is_state | is_event | is_comm
+    tokens = np.flatnonzero(np.repeat(is_record, line_ntok))
+    values = _token_values(data, tok_start, tok_len, tokens)
+
+    # The record type field is discarded
+    state_first = line_first_tok[is_state]
+    arr_state = values[state_first[:, np.newaxis] + np.arange(1, len(StateRecord) + 1)]
+    comm_first = line_first_tok[is_comm]
+    arr_comm = values[comm_first[:, np.newaxis] + np.arange(1, len(CommRecord) + 1)]
+
+    # The same Event record line can contain more than 1 Event: one row per type:value pair
+    event_first = line_first_tok[is_event]
+    event_pairs = (line_ntok[is_event] - 6) // 2
+    row_first = np.repeat(event_first, event_pairs)
+    row_pair = np.arange(row_first.size) - np.repeat(np.cumsum(event_pairs) - event_pairs, event_pairs)
+    arr_event = np.empty((row_first.size, len(EventRecord)), dtype="int64")
+    arr_event[:, :5] = values[row_first[:, np.newaxis] + np.arange(1, 6)]
+    arr_event[:, 5] = values[row_first + 6 + 2 * row_pair]
+    arr_event[:, 6] = values[row_first + 7 + 2 * row_pair]
+
+    return arr_state, arr_event, arr_comm
 
 
 class ParaverToHDF5(FormatConverter):
@@ -53,123 +224,279 @@ class ParaverToHDF5(FormatConverter):
         return list(itertools.chain.from_iterable([record[:5] + [event, next(event_iter)] for event in event_iter]))
 
     def parse_records(self, chunk, *args):
-        """
-        TODO: add documentation of this function
+        """ Parses the lines of `chunk` one by one and writes the fields of each record in the flat arrays
+        passed in `args` (State, Event and Comm). Arrays that become full grow geometrically, so they can
+        be allocated either with their exact size (see count_records) or with any initial size.
+        Returns the arrays trimmed to the used elements and the number of elements of each one
         """
         arr_state, arr_event, arr_comm = args
         stcount, evcount, commcount = 0, 0, 0
         # This is the padding between different records respectively
-        stpadding, commpadding, evpadding = len(StateRecord), len(CommRecord), len(EventRecord) * 10
+        stpadding, commpadding = len(StateRecord), len(CommRecord)
         # The loop is divided in chunks of STEPS size
         for records in isplit(chunk, STEPS):
             for record in records:
                 record_type = record[0]
                 if record_type == STATE_RECORD:
                     state = ParaverToHDF5._get_state_row(record)
-                    try:
-                        arr_state[stcount : stcount + stpadding] = state
-                    except ValueError:
-                        logger.warning("Catched exception: 'arr_state' need more space. Handling it...")
-                        arr_state = np.concatenate((arr_state, np.zeros(STEPS * stpadding * RESIZE)))
-                        arr_state[stcount : stcount + stpadding] = state
+                    arr_state = _reserve(arr_state, stcount + stpadding)
+                    arr_state[stcount : stcount + stpadding] = state
                     stcount += stpadding
                 elif record_type == EVENT_RECORD:
                     # EVENT is a special type because we don't know how
                     # long will be the returned list
                     events = ParaverToHDF5._get_event_row(record)
-                    try:
-                        arr_event[evcount : evcount + len(events)] = events
-                    except ValueError:
-                        logger.warning("Catched exception: 'arr_event' need more space. Handling it...")
-                        arr_event = np.concatenate((arr_event, np.zeros(STEPS * evpadding * RESIZE)))
-                        arr_event[evcount : evcount + len(events)] = events
+                    arr_event = _reserve(arr_event, evcount + len(events))
+                    arr_event[evcount : evcount + len(events)] = events
                     evcount += len(events)
                 elif record_type == COMM_RECORD:
                     comm = ParaverToHDF5._get_comm_row(record)
-                    try:
-                        arr_comm[commcount : commcount + commpadding] = comm
-                    except ValueError:
-                        logger.warning("Catched exception: 'arr_comm' need more space. Handling it...")
-                        arr_comm = np.concatenate((arr_comm, np.zeros(STEPS * commpadding * RESIZE)))
-                        arr_comm[commcount : commcount + commpadding] = comm
+                    arr_comm = _reserve(arr_comm, commcount + commpadding)
+                    arr_comm[commcount : commcount + commpadding] = comm
                     commcount += commpadding
 
-            # Check if the arrays have enough free space for the next chunk iteration
-            # If not, resize the arrays heuristically
-            if (arr_state.size - stcount) < STEPS * stpadding:
-                arr_state = np.concatenate((arr_state, np.zeros(STEPS * stpadding * RESIZE)))
-            if (arr_event.size - evcount) < STEPS * evpadding:
-                arr_event = np.concatenate((arr_event, np.zeros(STEPS * evpadding * RESIZE)))
-            if (arr_comm.size - commcount) < STEPS * commpadding:
-                arr_comm = np.concatenate((arr_comm, np.zeros(STEPS * commpadding * RESIZE)))
-
         # Remove the positions that have not been used when returning
         return arr_state[0:stcount], stcount, arr_event[0:evcount], evcount, arr_comm[0:commcount], commcount
 
-    def seq_parser(self, chunk: List[str]):
-        # Pre-allocation of arrays
-        arr_state = np.zeros(MIN_ELEM, dtype="int64")
-        arr_event = np.zeros(MIN_ELEM, dtype="int64")
-        arr_comm = np.zeros(MIN_ELEM, dtype="int64")
+    def vec_parser(self, chunk):
+        """ Same output as seq_parser, but for a raw buffer of complete lines decoded with decode_records.
+        Big buffers are decoded in windows of DECODE_BYTES to bound the temporary memory
+        """
+        with span("decode") as decoded:
+            results = [decode_records(window) for window in newline_aligned_windows(chunk, DECODE_BYTES)]
+            decoded.add(bytes=len(chunk), records=sum(arr.shape[0] for result in results for arr in result))
+        arrays_state, arrays_event, arrays_comm = zip(*results) if results else ([], [], [])
+        with span("concatenate"):
+            arr_state, arr_event, arr_comm = (
+                np.concatenate(arrays_state or [_empty_records()[0]]).ravel(),
+                np.concatenate(arrays_event or [_empty_records()[1]]).ravel(),
+                np.concatenate(arrays_comm or [_empty_records()[2]]).ravel(),
+            )
+        return arr_state, arr_state.size, arr_event, arr_event.size, arr_comm, arr_comm.size
 
-        arr_state, stcount, arr_event, evcount, arr_comm, commcount = self.parse_records(
-            chunk, arr_state, arr_event, arr_comm
-        )
+    def seq_parser(self, chunk):
+        """ Parses a chunk line by line. `chunk` is either a raw buffer of complete lines, whose records
+        are counted first to allocate the arrays with their exact size, or a list of lines, whose arrays
+        start with MIN_ELEM elements and grow on demand
+        """
+        if isinstance(chunk, (bytes, bytearray, memoryview)):
+            stsize, evsize, commsize = count_records(chunk)
+            chunk = codecs.decode(chunk).splitlines(keepends=True)
+        else:
+            stsize, evsize, commsize = MIN_ELEM, MIN_ELEM, MIN_ELEM
+        arr_state = np.empty(stsize, dtype="int64")
+        arr_event = np.empty(evsize, dtype="int64")
+        arr_comm = np.empty(commsize, dtype="int64")
+
+        with span("parse_records") as parsed:
+            arr_state, stcount, arr_event, evcount, arr_comm, commcount = self.parse_records(
+                chunk, arr_state, arr_event, arr_comm
+            )
+            parsed.add(records=_count_records(stcount, evcount, commcount))
 
         return arr_state, stcount, arr_event, evcount, arr_comm, commcount
 
-    def _create_dask_dataframe(self, df: dd.DataFrame, columns):
-        if df.shape[0] > 0:
-            return dd.from_array(df, columns=columns)
+    def _create_dask_dataframe(self, arr: np.ndarray, record):
+        if arr.shape[0] > 0:
+            return dd.from_pandas(records_to_dataframe(arr, record), chunksize=DASK_CHUNK_ROWS)
         else:
             return dd.from_array(np.array([[]]))
 
-    def parse_as_dataframe(self, file: str, use_dask=True) -> Tuple[dd.DataFrame, dd.DataFrame, dd.DataFrame]:
+    def parse_chunk(self, chunk, vectorized: bool = True):
+        """ Parses a raw buffer of complete lines with vec_parser, or seq_parser if not `vectorized` """
+        return self.vec_parser(chunk) if vectorized else self.seq_parser(chunk)
+
+    def parse_range(self, file: str, start: int, end: int, vectorized: bool = True):
+        """ Parses the records found in the byte range [start, end) of the file (the whole body if they
+        are None). Used as the task of every worker process, it returns the flat arrays of the range and
+        their element counts. Compressed traces (see format_converter.COMPRESSIONS) can only be parsed whole
+        """
+        if is_compressed(file):
+            if start is not None or end is not None:
+                raise Exception(f"The compressed trace {file} can only be read from the beginning.")
+            chunks = (window for window, _ in stream_chunk_reader(file, MAX_READ_BYTES))
+        else:
+            chunks = mmap_chunk_reader(file, MAX_READ_BYTES, start, end)
+        with span("parse_range") as parsed:
+            arrays_state, arrays_event, arrays_comm = [], [], []
+            for chunk in chunks:
+                parsed.add(bytes=len(chunk))
+                tmp_arr_state, _, tmp_arr_event, _, tmp_arr_comm, _ = self.parse_chunk(chunk, vectorized)
+                arrays_state.append(tmp_arr_state)
+                arrays_event.append(tmp_arr_event)
+                arrays_comm.append(tmp_arr_comm)
+            with span("concatenate"):
+                arr_state, arr_event, arr_comm = (
+                    np.concatenate(arrays_state or [np.array([], dtype="int64")]),
+                    np.concatenate(arrays_event or [np.array([], dtype="int64")]),
+                    np.concatenate(arrays_comm or [np.array([], dtype="int64")]),
+                )
+            parsed.add(records=_count_records(arr_state.size, arr_event.size, arr_comm.size))
+        return arr_state, arr_state.size, arr_event, arr_event.size, arr_comm, arr_comm.size
+
+    def par_parser(self, file: str, workers: int, vectorized: bool = True):
+        """ Splits the body of the trace in newline-aligned byte ranges and parses them in a pool of
+        `workers` processes. The partial arrays are merged in file order, so the result is the same
+        as the one of the sequential parser
+        """
+        if is_compressed(file):
+            # A compressed stream can't be split, its records are parsed while it's decompressed
+            logger.debug(f"Parsing the compressed trace {file} sequentially")
+            return self.parse_range(file, None, None, vectorized)
+        body_size = os.path.getsize(file)
+        # No range is bigger than MAX_READ_BYTES, so the memory used by a worker stays bounded
+        parts = max(workers, -(-body_size // MAX_READ_BYTES))
+        ranges = newline_aligned_ranges(file, parts)
+        logger.debug(f"Parsing {len(ranges)} byte ranges with {workers} workers")
+        # The spans of the workers are not recorded, only the time waiting for them
+        with span("par_parser") as parsed, ProcessPoolExecutor(max_workers=workers) as executor:
+            parsed.add(bytes=body_size)
+            results = list(
+                executor.map(
+                    self.parse_range,
+                    [file] * len(ranges),
+                    [start for start, _ in ranges],
+                    [end for _, end in ranges],
+                    [vectorized] * len(ranges),
+                )
+            )
+        if not results:
+            results = [self.parse_range(file, 0, 0, vectorized)]
+        arr_state, stcount, arr_event, evcount, arr_comm, commcount = zip(*results)
+        return (
+            np.concatenate(arr_state),
+            sum(stcount),
+            np.concatenate(arr_event),
+            sum(evcount),
+            np.concatenate(arr_comm),
+            sum(commcount),
+        )
+
+    @staticmethod
+    def _reshape_records(arr_state, stcount, arr_event, evcount, arr_comm, commcount):
+        with span("reshape"):
+            return (
+                arr_state[:stcount].reshape((stcount // len(StateRecord), len(StateRecord))),
+                arr_event[:evcount].reshape((evcount // len(EventRecord), len(EventRecord))),
+                arr_comm[:commcount].reshape((commcount // len(CommRecord), len(CommRecord))),
+            )
+
+    def iter_records(self, file: str, workers: int = None, vectorized: bool = True, progress: Callable = None):
+        """ Yields the records of the trace as (State, Event, Comm) 2D arrays, one tuple per newline-aligned
+        chunk of MAX_READ_BYTES, in file order. Only a few chunks are alive at the same time, so the memory
+        used is bounded by the chunk size and not by the trace size.
+        Once each chunk is consumed, progress(bytes_parsed, records_parsed) is called with the totals so far. An
+        exception raised by it stops the parsing.
+        Compressed traces are decompressed by a thread while their chunks are parsed (see stream_chunk_reader), and
+        their bytes_parsed are compressed bytes
+        """
+        workers = WORKERS if workers is None else workers
+        records_parsed = 0
+
+        def report(records, end):
+            # The chunks are consumed in file order, everything before their end was parsed
+            nonlocal records_parsed
+            records_parsed += sum(arr.shape[0] for arr in records)
+            if progress is not None:
+                progress(end, records_parsed)
+
+        if is_compressed(file):
+            # The compressed bytes read so far are the progress, the size of the decompressed trace is unknown
+            tasks = (
+                (position, self.parse_chunk, (window, vectorized))
+                for window, position in stream_chunk_reader(file, MAX_READ_BYTES)
+            )
+        else:
+            ranges = newline_aligned_ranges(file, -(-os.path.getsize(file) // MAX_READ_BYTES))
+            tasks = ((end, self.parse_range, (file, start, end, vectorized)) for start, end in ranges)
+
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                # Keep every worker busy, but don't let finished chunks pile up waiting for the consumer
+                pending = deque()
+                try:
+                    for end, task, args in tasks:
+                        pending.append((end, executor.submit(task, *args)))
+                        if len(pending) >= 2 * workers:
+                            chunk_end, future = pending.popleft()
+                            records = self._reshape_records(*future.result())
+                            yield records
+                            report(records, chunk_end)
+                    while pending:
+                        chunk_end, future = pending.popleft()
+                        records = self._reshape_records(*future.result())
+                        yield records
+                        report(records, chunk_end)
+                finally:
+                    # Stopped early, the chunks not started yet are not needed
+                    for _, future in pending:
+                        future.cancel()
+        else:
+            for end, task, args in tasks:
+                records = self._reshape_records(*task(*args))
+                yield records
+                report(records, end)
+
+    def parse_as_dataframe(
+        self, file: str, use_dask=True, workers: int = None, vectorized: bool = True
+    ) -> Tuple[dd.DataFrame, dd.DataFrame, dd.DataFrame]:
         """ Memory complexity: O_max(N+(3N*)), O_nominal(N). O_max could be 4*N/CHUNK if the algorithm wrote to disk
             after each CHUNK
             Computational complexity: O(N+c)
+            With workers > 1 the body of the trace is parsed in parallel by a pool of processes.
+            With vectorized=False the records are parsed line by line (reference implementation)
         """
-        logger.debug(f"Using parameters: STEPS {STEPS}, MAX_READ_BYTES {MAX_READ_BYTES}, MIN_ELEM {MIN_ELEM}")
-        start_time = time.time()
-        # *count variables count how many elements we actually have
-        arr_state, stcount, arr_event, evcount, arr_comm, commcount = (
-            np.array([], dtype="int64"),
-            0,
-            np.array([], dtype="int64"),
-            0,
-            np.array([], dtype="int64"),
-            0,
+        workers = WORKERS if workers is None else workers
+        logger.debug(
+            f"Using parameters: STEPS {STEPS}, MAX_READ_BYTES {MAX_READ_BYTES}, MIN_ELEM {MIN_ELEM}, WORKERS {workers}"
         )
-        # This algorithm is a loop divided in chunks of MAX_READ_BYTES
-        for chunk in chunk_reader(file, MAX_READ_BYTES):
-            tmp_arr_state, tmp_stcount, tmp_arr_event, tmp_evcount, tmp_arr_comm, tmp_commcount = self.seq_parser(chunk)
-            stcount, evcount, commcount = stcount + tmp_stcount, evcount + tmp_evcount, commcount + tmp_commcount
-            # Join the temporal arrays with the main
-            arr_state, arr_event, arr_comm = (
-                np.concatenate((arr_state, tmp_arr_state)),
-                np.concatenate((arr_event, tmp_arr_event)),
-                np.concatenate((arr_comm, tmp_arr_comm)),
-            )
+        with span("parse_as_dataframe") as parsed:
+            parsed.add(bytes=os.path.getsize(file))
+            start_time = time.time()
+            if workers > 1:
+                arr_state, stcount, arr_event, evcount, arr_comm, commcount = self.par_parser(file, workers, vectorized)
+            elif vectorized:
+                arr_state, stcount, arr_event, evcount, arr_comm, commcount = self.parse_range(file, None, None)
+            else:
+                arr_state, stcount, arr_event, evcount, arr_comm, commcount = self._seq_parse_file(file)
+            parsed.add(records=_count_records(stcount, evcount, commcount))
 
-        logger.info(f"TIMING (s) el_time_parser:".ljust(30, " ") + "{:.3f}".format(time.time() - start_time))
-        logger.info(
-            f"ARRAY MAX SIZES (MB): {arr_state.nbytes//(1024*1024)} | { arr_event.nbytes//(1024*1024)} | {arr_comm.nbytes//(1024*1024)}"
-        )
+            logger.info("TIMING (s) el_time_parser:".ljust(30, " ") + "{:.3f}".format(time.time() - start_time))
+            logger.info(
+                f"ARRAY MAX SIZES (MB): {arr_state.nbytes//(1024*1024)} | { arr_event.nbytes//(1024*1024)} | {arr_comm.nbytes//(1024*1024)}"
+            )
 
-        # Reshape the arrays
-        arr_state, arr_event, arr_comm = (
-            arr_state.reshape((stcount // len(StateRecord), len(StateRecord))),
-            arr_event.reshape((evcount // len(EventRecord), len(EventRecord))),
-            arr_comm.reshape((commcount // len(CommRecord), len(CommRecord))),
-        )
+            # Reshape the arrays
+            arr_state, arr_event, arr_comm = self._reshape_records(
+                arr_state, stcount, arr_event, evcount, arr_comm, commcount
+            )
 
-        if use_dask:
-            df_state = self._create_dask_dataframe(arr_state, columns=StateRecord.all_attributes())
-            df_event = self._create_dask_dataframe(arr_event, columns=EventRecord.all_attributes())
-            df_comm = self._create_dask_dataframe(arr_comm, columns=CommRecord.all_attributes())
-        else:
-            df_state = pd.DataFrame(data=arr_state, columns=StateRecord.all_attributes())
-            df_event = pd.DataFrame(data=arr_event, columns=EventRecord.all_attributes())
-            df_comm = pd.DataFrame(data=arr_comm, columns=CommRecord.all_attributes())
+            # Every column is stored with the compact dtype of its record (see CONST.py)
+            with span("build_dataframes"):
+                if use_dask:
+                    df_state = self._create_dask_dataframe(arr_state, StateRecord)
+                    df_event = self._create_dask_dataframe(arr_event, EventRecord)
+                    df_comm = self._create_dask_dataframe(arr_comm, CommRecord)
+                else:
+                    df_state = records_to_dataframe(arr_state, StateRecord)
+                    df_event = records_to_dataframe(arr_event, EventRecord)
+                    df_comm = records_to_dataframe(arr_comm, CommRecord)
 
         return df_state, df_event, df_comm
+
+    def _seq_parse_file(self, file: str):
+        arrays_state, arrays_event, arrays_comm = [], [], []
+        # This algorithm is a loop divided in chunks of MAX_READ_BYTES
+        for chunk in chunk_reader(file, MAX_READ_BYTES):
+            tmp_arr_state, _, tmp_arr_event, _, tmp_arr_comm, _ = self.seq_parser(chunk)
+            arrays_state.append(tmp_arr_state)
+            arrays_event.append(tmp_arr_event)
+            arrays_comm.append(tmp_arr_comm)
+        # Join the temporal arrays at once, concatenating them one by one is quadratic
+        with span("concatenate"):
+            arr_state, arr_event, arr_comm = (
+                np.concatenate(arrays_state or [np.array([], dtype="int64")]),
+                np.concatenate(arrays_event or [np.array([], dtype="int64")]),
+                np.concatenate(arrays_comm or [np.array([], dtype="int64")]),
+            )
+        return arr_state, arr_state.size, arr_event, arr_event.size, arr_comm, arr_comm.size
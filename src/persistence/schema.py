@@ -0,0 +1,49 @@
+import logging
+from typing import Dict
+
+import numpy as np
+import pandas as pd
+
+logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def fit_dtype(values: np.ndarray, dtype) -> np.dtype:
+    """ Returns `dtype` if it can store all the `values`, otherwise the smallest wider integer dtype that can """
+    dtype = np.dtype(dtype)
+    if values.size == 0:
+        return dtype
+    low, high = values.min(), values.max()
+    info = np.iinfo(dtype)
+    if info.min <= low and high <= info.max:
+        return dtype
+    widened = np.result_type(dtype, np.min_scalar_type(low), np.min_scalar_type(high))
+    if widened.kind not in "iu":
+        # Mixing uint64 and negative values, int64 is the widest signed dtype
+        widened = np.dtype("int64")
+    logger.warning(f"Values in [{low}, {high}] don't fit in {dtype}. Widening to {widened}")
+    return widened
+
+
+def widen_dtypes(dtypes: Dict[str, np.dtype], other: Dict[str, np.dtype]) -> Dict[str, np.dtype]:
+    """ Column by column, the smallest dtype that can store the values of both `dtypes` and `other` """
+    return {name: np.promote_types(dtype, other.get(name, dtype)) for name, dtype in dtypes.items()}
+
+
+def records_to_dataframe(arr: np.ndarray, record, index=None) -> pd.DataFrame:
+    """ Builds the DataFrame of a 2D array of records (one column per attribute of `record`, e.g. StateRecord)
+    with the storage dtype of each column
+    """
+    columns = record.all_attributes()
+    return pd.DataFrame(
+        {name: arr[:, i].astype(fit_dtype(arr[:, i], record[name].dtype), copy=False) for i, name in enumerate(columns)},
+        index=index,
+    )
+
+
+def compact_dataframe(df: pd.DataFrame, record) -> pd.DataFrame:
+    """ Casts the columns of `df` to the storage dtypes of `record`, widening the ones whose values don't fit """
+    dtypes = {
+        name: fit_dtype(df[name].to_numpy(), dtype) for name, dtype in record.dtypes().items() if name in df.columns
+    }
+    return df.astype(dtypes)
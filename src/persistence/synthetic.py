@@ -0,0 +1,143 @@
+import logging
+import os
+from typing import Dict, Tuple
+
+import numpy as np
+
+logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Lines generated at once
+BATCH_LINES = int(os.environ.get("BATCH_LINES", 100000))
+# Event types of the synthetic traces, as MPI calls and user functions of a real one
+EVENT_TYPES = np.array([42000050, 50000001, 50000002, 50000003, 60000019])
+# Most states are running (1), the rest waiting, blocked, in a group communication...
+STATES = np.array([1, 3, 5, 7, 9, 12])
+STATE_WEIGHTS = np.array([0.6, 0.1, 0.1, 0.05, 0.05, 0.1])
+
+# Width of the exec time of the header, it's only known once the records are written
+_EXEC_TIME_DIGITS = 20
+
+
+def _header(exec_time: int, tasks: int, threads: int) -> str:
+    apps = ",".join(f"{threads}:1" for _ in range(tasks))
+    return f"#Paraver (01/01/2020 at 00:00):{exec_time:0{_EXEC_TIME_DIGITS}d}_ns:1({tasks * threads}):1:{tasks}({apps})\n"
+
+
+def _format(rows: np.ndarray) -> np.ndarray:
+    """ Lines of the records of `rows`, one record per row of integers """
+    template = ":".join(["%d"] * rows.shape[1])
+    return np.array([template % tuple(row) for row in rows.tolist()], dtype=object)
+
+
+class _Threads:
+    """ Thread of each record (task and thread ids from 1) and the time each thread's last state ended """
+
+    def __init__(self, tasks: int, threads: int):
+        self.tasks = tasks
+        self.threads = threads
+        self.state_end = np.zeros(tasks * threads, dtype="int64")
+
+    def ids(self, thread: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """ cpu, task and thread ids of the global thread numbers `thread` """
+        return thread + 1, thread // self.threads + 1, thread % self.threads + 1
+
+
+def _states(rng: np.random.RandomState, threads: _Threads, thread: np.ndarray, time: np.ndarray) -> np.ndarray:
+    """ States that start at `time` and last until the next state of their thread, so the states of each thread
+    cover its whole timeline. The first one of the batch starts where the last one of the previous batch ended, and
+    the last one ends right after it starts, before any record of the next batch
+    """
+    order = np.lexsort((time, thread))
+    thread, begin = thread[order], time[order].copy()
+    first = np.r_[True, thread[1:] != thread[:-1]]
+    last = np.r_[thread[1:] != thread[:-1], True]
+    begin[first] = threads.state_end[thread[first]]
+    end = np.r_[begin[1:], 0]
+    end[last] = time[order][last] + 1
+    threads.state_end[thread[last]] = end[last]
+    state = rng.choice(STATES, size=thread.size, p=STATE_WEIGHTS)
+    cpu, task, thread_id = threads.ids(thread)
+    lines = np.empty(thread.size, dtype=object)
+    lines[order] = _format(
+        np.column_stack((np.full(thread.size, 1), cpu, np.ones_like(thread), task, thread_id, begin, end, state))
+    )
+    return lines
+
+
+def _events(rng: np.random.RandomState, threads: _Threads, thread: np.ndarray, time: np.ndarray, per_line: int):
+    cpu, task, thread_id = threads.ids(thread)
+    types = rng.choice(EVENT_TYPES, size=(thread.size, per_line))
+    # Value 0 ends the burst the previous value of the type started
+    values = rng.randint(0, 20, size=(thread.size, per_line))
+    pairs = np.stack((types, values), axis=2).reshape(thread.size, 2 * per_line)
+    return _format(np.column_stack((np.full(thread.size, 2), cpu, np.ones_like(thread), task, thread_id, time, pairs)))
+
+
+def _comms(rng: np.random.RandomState, threads: _Threads, thread: np.ndarray, time: np.ndarray):
+    cpu, task, thread_id = threads.ids(thread)
+    receiver = rng.randint(0, threads.tasks * threads.threads, size=thread.size)
+    cpu_recv, task_recv, thread_recv = threads.ids(receiver)
+    psend = time + rng.randint(0, 100, size=thread.size)
+    lrecv = psend + rng.randint(1, 1000, size=thread.size)
+    precv = lrecv + rng.randint(0, 100, size=thread.size)
+    size = rng.randint(1, 1 << 20, size=thread.size)
+    tag = rng.randint(0, 1000, size=thread.size)
+    ones = np.ones_like(thread)
+    return _format(
+        np.column_stack((np.full(thread.size, 3), cpu, ones, task, thread_id, time, psend, cpu_recv, ones, task_recv,
+                         thread_recv, lrecv, precv, size, tag))
+    )
+
+
+def generate_trace(
+    file: str,
+    size: int,
+    tasks: int = 4,
+    threads: int = 2,
+    mix: Tuple[float, float, float] = (0.6, 0.3, 0.1),
+    events_per_line: int = 1,
+    seed: int = 0,
+) -> Dict[str, int]:
+    """ Writes a synthetic .prv trace of at least `size` bytes with `tasks` tasks of `threads` threads. `mix` is the
+    fraction of State, Event and Comm lines and every Event line has `events_per_line` events. The trace only
+    depends on the arguments: the same `seed` writes the same file.
+    Returns the bytes, lines and records (States, Events, Comm) written
+    """
+    rng = np.random.RandomState(seed)
+    mix = np.asarray(mix, dtype="float64") / np.sum(mix)
+    pool = _Threads(tasks, threads)
+    counts = {"bytes": 0, "lines": 0, "States": 0, "Events": 0, "Comm": 0}
+    clock = 0
+    with open(file, "w") as f:
+        f.write(_header(0, tasks, threads))
+        while counts["bytes"] < size:
+            kind = rng.choice(3, size=BATCH_LINES, p=mix)
+            time = clock + np.cumsum(rng.randint(1, 100, size=BATCH_LINES))
+            thread = rng.randint(0, tasks * threads, size=BATCH_LINES)
+            lines = np.empty(BATCH_LINES, dtype=object)
+            for code, build in enumerate((_states, _events, _comms)):
+                selected = kind == code
+                args = (events_per_line,) if build is _events else ()
+                if selected.any():
+                    lines[selected] = build(rng, pool, thread[selected], time[selected], *args)
+            clock = int(time[-1])
+            text = "\n".join(lines) + "\n"
+            # Stop at the first line past `size`
+            ends = np.cumsum([len(line) + 1 for line in lines])
+            last = min(BATCH_LINES, int(np.searchsorted(ends, size - counts["bytes"])) + 1)
+            if last < BATCH_LINES:
+                text, kind = text[: ends[last - 1]], kind[:last]
+            f.write(text)
+            counts["bytes"] += len(text)
+            counts["lines"] += last
+            counts["States"] += int(np.count_nonzero(kind == 0))
+            counts["Events"] += int(np.count_nonzero(kind == 1)) * events_per_line
+            counts["Comm"] += int(np.count_nonzero(kind == 2))
+        # The states of the last batch may end after the last record
+        exec_time = max(clock, int(pool.state_end.max()))
+        f.seek(0)
+        f.write(_header(exec_time, tasks, threads))
+    counts["bytes"] += len(_header(exec_time, tasks, threads))
+    logger.info(f"Generated {file}: {counts}")
+    return counts
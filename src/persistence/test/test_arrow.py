@@ -0,0 +1,152 @@
+import logging
+import os
+import shutil
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.CONST import StateRecord
+from src.core.time_window import MAX_DURATION
+from src.persistence.arrow_reader import ArrowReader, ArrowTable
+from src.persistence.arrow_writer import ARROW_LAYOUT_VERSION, METADATA_FILE, ArrowWriter, read_metadata
+from src.persistence.controller import parse_trace
+from src.persistence.hdf5_reader import HDF5Reader
+from src.persistence.predicate import Predicate
+from src.persistence.prv_reader import ParaverReader
+from src.persistence.prv_to_hdf5 import ParaverToHDF5
+from src.persistence.writer import Writer
+
+logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+tiny_trace = "src/persistence/test/test_files/traces/tiny.test.prv"
+
+
+@pytest.fixture(scope="module")
+def hdf_trace(tmp_path_factory):
+    hdf_file = str(tmp_path_factory.mktemp("arrow") / "tiny.hdf")
+    Writer().records_to_hdf5(hdf_file, ParaverToHDF5().iter_records(tiny_trace))
+    return hdf_file
+
+
+def write_trace(directory, file_format, streaming=True):
+    with patch("src.persistence.arrow_writer.ROW_GROUP_ROWS", 8):
+        if streaming:
+            ArrowWriter(file_format).records_to_arrow(directory, ParaverToHDF5().iter_records(tiny_trace))
+        else:
+            dfs = ParaverToHDF5().parse_as_dataframe(tiny_trace, use_dask=True)
+            ArrowWriter(file_format).dataframe_to_arrow(directory, *dfs)
+    return directory
+
+
+@pytest.mark.parametrize("streaming", (True, False))
+@pytest.mark.parametrize("file_format", ("parquet", "arrow"))
+def test_same_records_as_hdf5(tmp_path, hdf_trace, file_format, streaming):
+    directory = write_trace(str(tmp_path / f"tiny.{file_format}"), file_format, streaming)
+    layout = ArrowReader().parse_layout(directory)
+    assert layout["version"] == ARROW_LAYOUT_VERSION and layout["format"] == file_format
+    assert layout["rows"] == {"States": 52, "Events": 60, "Comm": 6, "Intervals": 14}
+    # Parquet files have the statistics of their row groups in their footer
+    assert (len(read_metadata(directory)["layout"].get("statistics", {})) > 0) == (file_format == "arrow")
+    for key, expected in zip(("States", "Events", "Comm"), HDF5Reader().parse_records(hdf_trace)):
+        df = ArrowReader().parse_table(directory, key)
+        # Sorted by time, in row groups of 8 rows
+        statistics = ArrowTable(directory, key).statistics
+        assert len(statistics) == -(-len(expected) // 8)
+        sort_column = layout["sorted_by"][key]
+        last_group = expected[sort_column].iloc[(len(statistics) - 1) * 8:]
+        assert statistics[-1][sort_column] == [last_group.iloc[0], last_group.iloc[-1]]
+        pd.testing.assert_frame_equal(df, expected, check_index_type=False)
+        assert df.attrs["sorted_by"] == layout["sorted_by"][key]
+        assert df.attrs.get(MAX_DURATION) == expected.attrs.get(MAX_DURATION)
+        columns = list(expected.columns[-2:])
+        rows = ArrowReader().parse_table(directory, key, columns=columns, start=5, stop=19, use_dask=True)
+        pd.testing.assert_frame_equal(rows.compute(), expected[columns].iloc[5:19], check_index_type=False)
+
+
+def test_unsorted_and_widened(tmp_path):
+    records = ParaverToHDF5().parse_as_dataframe(tiny_trace, use_dask=False)[0].to_numpy()
+    wide = records[::-1].copy()
+    wide[0, StateRecord.all_attributes().index("cpu_id")] = 1 << 40
+    chunks = [(records[:20], records[:0], records[:0]), (wide, records[:0], records[:0])]
+    directory = str(tmp_path / "unsorted.arrow")
+    with patch("src.persistence.arrow_writer.ROW_GROUP_ROWS", 16):
+        ArrowWriter("arrow").records_to_arrow(directory, chunks)
+    df = ArrowReader().parse_table(directory, "States")
+    assert df["cpu_id"].dtype == np.dtype("int64") and df["cpu_id"].max() == 1 << 40
+    assert df.shape[0] == 72 and df["time_ini"].is_monotonic_increasing
+    assert ArrowReader().parse_nrows(directory) == {"States": 72, "Events": 0, "Comm": 0}
+    assert ArrowReader().parse_table(directory, "Events").equals(pd.DataFrame([]))
+
+
+@pytest.mark.parametrize("file_format", ("parquet", "arrow"))
+def test_external_sort(tmp_path, file_format):
+    records = ParaverToHDF5().parse_as_dataframe(tiny_trace, use_dask=False)[0].to_numpy()
+    time_ini = StateRecord.all_attributes().index("time_ini")
+    shuffled = records[np.random.default_rng(0).permutation(records.shape[0])]
+    # Equal times keep the order they were appended in
+    shuffled[:, time_ini] //= 100000
+    chunks = [(shuffled[start: start + 10], records[:0], records[:0]) for start in range(0, shuffled.shape[0], 10)]
+    directory = str(tmp_path / f"unsorted.{file_format}")
+    # Runs of 8 rows merged 2 at a time, in several passes
+    with patch.multiple("src.persistence.arrow_writer", ROW_GROUP_ROWS=4, SORT_RUN_ROWS=8, MERGE_RUNS=2):
+        ArrowWriter(file_format).records_to_arrow(directory, chunks)
+    df = ArrowReader().parse_table(directory, "States")
+    expected = shuffled[np.argsort(shuffled[:, time_ini], kind="stable")]
+    assert np.array_equal(df.to_numpy(), expected)
+    assert sorted(os.listdir(directory)) == sorted([METADATA_FILE, f"States.{file_format}"])
+    assert [group["time_ini"] for group in ArrowTable(directory, "States").statistics] == [
+        [expected[start, time_ini], expected[min(start + 3, expected.shape[0] - 1), time_ini]]
+        for start in range(0, expected.shape[0], 4)
+    ]
+
+
+@pytest.mark.parametrize("file_format", ("parquet", "arrow"))
+def test_read_table_skips_row_groups(tmp_path, hdf_trace, file_format):
+    directory = write_trace(str(tmp_path / f"tiny.{file_format}"), file_format)
+    events = ArrowReader().parse_tables(directory)[1]
+    expected = HDF5Reader().parse_records(hdf_trace)[1]
+    time = expected["time"].to_numpy()
+    predicate = Predicate([("time", ">=", time[20]), ("time", "<", time[30]), ("event_t", "!=", 0)])
+    assert events.row_groups(predicate) == [2, 3]
+    assert events.row_groups(Predicate([("time", ">", time[-1] + 1)])) == []
+    df = events[["time", "event_v"]].loc[(events["time"] >= time[20]) & (events["time"] < time[30])]
+    mask = (time >= time[20]) & (time < time[30])
+    assert list(df.columns) == ["time", "event_v"]
+    assert np.array_equal(df.index, np.flatnonzero(mask))
+    assert np.array_equal(df.values, expected.loc[mask, ["time", "event_v"]].values)
+
+
+def test_arrow_reads_are_memory_mapped(tmp_path):
+    directory = write_trace(str(tmp_path / "tiny.arrow"), "arrow")
+    df = ArrowReader().parse_table(directory, "Events", start=0, stop=8)
+    # The column points to the mapped file instead of a copy
+    assert not df["time"].to_numpy().flags.writeable
+
+
+@pytest.mark.parametrize("file_format", ("parquet", "arrow"))
+def test_convert_metadata_round_trip(tmp_path, file_format):
+    shutil.copy(tiny_trace, tmp_path / "tiny.prv")
+    file = str(tmp_path / "tiny.prv")
+    hdf_metadata = ParaverReader().convert(file)
+    metadata = ParaverReader().convert(file, storage=file_format)
+    assert metadata.path == str(tmp_path / f"tiny.{file_format}") and metadata.name == f"tiny.{file_format}"
+    assert metadata.layout_version == ARROW_LAYOUT_VERSION
+    assert ArrowReader().parse_metadata(metadata.path) == metadata
+    for attr in ("type", "exec_time", "date_time", "nodes", "apps"):
+        assert getattr(metadata, attr) == getattr(hdf_metadata, attr)
+    # Already converted
+    with patch.object(ArrowWriter, "records_to_arrow") as records_to_arrow:
+        assert ParaverReader().convert(file, storage=file_format) == metadata
+    records_to_arrow.assert_not_called()
+
+    trace = parse_trace(metadata.path)
+    assert trace.metadata == metadata and trace.is_sorted
+    assert len(trace.df_event.compute()) == 60
+
+
+def test_unknown_storage():
+    with pytest.raises(Exception, match="Unknown storage format"):
+        ParaverReader().convert(tiny_trace, storage="csv")
@@ -0,0 +1,212 @@
+import logging
+import shutil
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.CONST import EventRecord
+from src.core.intervals import INTERVALS
+from src.persistence.event_index import EventIndex
+from src.persistence.hdf5_reader import RECORDS, HDF5Reader, HDF5Table
+from src.persistence.predicate import Predicate
+from src.persistence.prv_reader import ParaverReader
+from src.persistence.prv_to_hdf5 import ParaverToHDF5
+from src.persistence.writer import SORT_COLUMNS, THREAD_COLUMNS, Writer
+
+logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+tiny_trace = "src/persistence/test/test_files/traces/tiny.test.prv"
+
+
+@pytest.fixture(scope="module")
+def hdf_trace(tmp_path_factory):
+    hdf_file = str(tmp_path_factory.mktemp("reader") / "tiny.hdf")
+    with patch("src.persistence.writer.CHUNK_ROWS", 8):
+        Writer().records_to_hdf5(hdf_file, ParaverToHDF5().iter_records(tiny_trace))
+    return hdf_file
+
+
+def test_predicate_where():
+    predicate = Predicate([("time", ">=", np.int64(10)), ("event_t", "in", [np.int32(1), 2])])
+    assert predicate.where() == ["time >= 10", "event_t in [1, 2]"]
+    assert predicate.bounds("time") == (10, None)
+    assert predicate.bounds("event_t") == (1, 2)
+    assert not predicate.is_unsatisfiable()
+    assert (predicate & Predicate([("time", "<", 5)])).is_unsatisfiable()
+
+
+def test_row_range_skips_chunks(hdf_trace):
+    events = HDF5Reader().parse_tables(hdf_trace)[1]
+    time = HDF5Reader().parse_records(hdf_trace)[1]["time"].to_numpy()
+    low, high = time[20], time[30]
+    start, stop = events.row_range(Predicate([("time", ">=", low), ("time", "<", high)]))
+    matches = np.flatnonzero((time >= low) & (time < high))
+    assert start % 8 == 0 and start <= matches[0] and matches[-1] < stop
+    assert stop - start < len(events)
+    assert events.row_range(Predicate([("time", ">", time[-1] + 1)])) == (0, 0)
+    assert events.row_range(Predicate([("event_t", "==", 1)])) == (0, len(events))
+
+
+def test_read_table_columns(hdf_trace):
+    events = HDF5Reader().parse_tables(hdf_trace)[1]
+    df = events[["time", "event_v"]].loc[events["event_t"] == 50000001]
+    expected = HDF5Reader().parse_records(hdf_trace)[1]
+    expected = expected.loc[expected["event_t"] == 50000001, ["time", "event_v"]]
+    assert list(df.columns) == ["time", "event_v"]
+    assert df.shape[0] > 0
+    assert np.array_equal(df.values, expected.values)
+
+
+def test_read_table_old_layout(tmp_path):
+    hdf_file = str(tmp_path / "old.hdf")
+    events = ParaverToHDF5().parse_as_dataframe(tiny_trace, use_dask=False)[1]
+    events.astype("int64").to_hdf(hdf_file, key="Events", format="table")
+    table = HDF5Table(hdf_file, "Events")
+    with patch("src.persistence.hdf5_reader.READ_ROWS", 7):
+        df = table.loc[(table["time"] >= 400000) & (table["event_t"] != 0)]
+    expected = events.loc[(events["time"] >= 400000) & (events["event_t"] != 0)]
+    assert df.dtypes.to_dict() == EventRecord.dtypes()
+    assert np.array_equal(df.values, expected.values)
+    assert HDF5Reader().read_table(hdf_file, "States").equals(pd.DataFrame([]))
+
+
+@pytest.mark.parametrize("index_rows", (7, 1000000))
+def test_event_index(tmp_path, index_rows):
+    hdf_file = str(tmp_path / "index.hdf")
+    with patch("src.persistence.event_index.INDEX_ROWS", index_rows):
+        Writer().records_to_hdf5(hdf_file, ParaverToHDF5().iter_records(tiny_trace))
+    event_t = HDF5Reader().parse_records(hdf_file)[1]["event_t"].to_numpy()
+    event_index = HDF5Reader().parse_event_index(hdf_file)
+    types, counts = np.unique(event_t, return_counts=True)
+    assert np.array_equal(event_index.types, types)
+    assert np.array_equal(event_index.counts, counts)
+    assert event_index.nrows == event_t.size
+    for selected in ([types[0]], [types[-1], types[1]], [types[0], -1], [-1]):
+        assert np.array_equal(event_index.positions(selected), np.flatnonzero(np.isin(event_t, selected)))
+        assert event_index.count(selected) == np.isin(event_t, selected).sum()
+
+
+def test_read_table_with_event_index(hdf_trace):
+    events = HDF5Reader().parse_tables(hdf_trace)[1]
+    expected = HDF5Reader().parse_records(hdf_trace)[1]
+    predicate = (events["event_t"].isin([50000001, 60000019])) & (events["time"] >= 400000)
+    with patch("src.persistence.hdf5_reader.EventIndex.positions", autospec=True, side_effect=EventIndex.positions) as positions:
+        df = events.loc[predicate & (events["event_v"] != 0)]
+    positions.assert_called_once()
+    expected = expected.loc[
+        expected["event_t"].isin([50000001, 60000019]) & (expected["time"] >= 400000) & (expected["event_v"] != 0)
+    ]
+    assert df.shape[0] > 0
+    assert df.equals(expected)
+    assert events.loc[events["event_t"] == -1].shape[0] == 0
+
+
+def test_old_layout_without_event_index(tmp_path):
+    hdf_file = str(tmp_path / "old.hdf")
+    ParaverToHDF5().parse_as_dataframe(tiny_trace, use_dask=False)[1].to_hdf(hdf_file, key="Events", format="table")
+    assert HDF5Reader().parse_event_index(hdf_file) is None
+
+
+@pytest.mark.parametrize("use_dask", (False, True))
+def test_parse_table_projection(hdf_trace, use_dask):
+    states = HDF5Reader().parse_records(hdf_trace)[0]
+    df = HDF5Reader().parse_table(hdf_trace, "States", ["time_ini", "state"], 10, 30, use_dask=use_dask)
+    df = df.compute() if use_dask else df
+    assert list(df.columns) == ["time_ini", "state"]
+    assert df.equals(states[["time_ini", "state"]].iloc[10:30])
+    # Past the end of the table
+    df = HDF5Reader().parse_table(hdf_trace, "States", ["state"], 40, 1000, use_dask=use_dask)
+    assert len(df) == len(states) - 40
+
+
+def test_tables_read_with_range_index(hdf_trace):
+    # Filter keys the masks of a RangeIndex by its bounds instead of hashing it
+    assert HDF5Reader().parse_table(hdf_trace, "States").index.equals(pd.RangeIndex(52))
+    assert isinstance(HDF5Reader().parse_table(hdf_trace, "Events", start=10, stop=30).index, pd.RangeIndex)
+    partitions = HDF5Reader().parse_table(hdf_trace, "Events", use_dask=True).partitions
+    assert all(isinstance(partition.compute().index, pd.RangeIndex) for partition in partitions)
+
+
+def test_open_trace_is_lazy(tmp_path):
+    prv_file = str(tmp_path / "tiny.prv")
+    shutil.copy(tiny_trace, prv_file)
+    hdf_file = ParaverReader().convert(prv_file).path
+    states = HDF5Reader().parse_table(hdf_file, "States")
+    longest = (states["time_fi"] - states["time_ini"]).max()
+    with patch.object(HDF5Reader, "parse_table", wraps=HDF5Reader().parse_table) as parse_table:
+        trace = HDF5Reader().open_trace(hdf_file, use_dask=False)
+        assert trace.metadata.name == "tiny.hdf" and trace.is_sorted
+        assert "tiny.hdf" in repr(trace)
+        parse_table.assert_not_called()
+        # The duration of the longest state is stored with the States, not computed from them
+        assert trace._max_state_duration == longest
+        assert len(trace.df_state) == 52 and trace.df_state is trace.df_state
+        parse_table.assert_called_once_with(hdf_file, "States", use_dask=False)
+        assert trace.opened("df_state") is not None and trace.opened("df_event") is None
+        events = trace.read("Events", columns=["time"], start=50)
+        assert list(events.columns) == ["time"] and len(events) == 10
+        assert trace.opened("df_event") is None
+        assert trace.time_window(0, 500000).df_comm.shape[0] < 6
+
+
+@pytest.fixture(scope="module")
+def partitioned_trace(tmp_path_factory):
+    hdf_file = str(tmp_path_factory.mktemp("partitioned") / "tiny.hdf")
+    Writer(partition_threads=True).records_to_hdf5(hdf_file, ParaverToHDF5().iter_records(tiny_trace))
+    return hdf_file
+
+
+def sorted_rows(df):
+    return df.sort_values(list(df.columns)).to_numpy()
+
+
+def test_partitioned_layout(hdf_trace, partitioned_trace):
+    layout = HDF5Reader().parse_layout(partitioned_trace)
+    assert layout["partitioned"] and layout["sorted_by"] == {} and layout["chunks"] == {}
+    assert set(layout["partitions"]) == {*RECORDS, INTERVALS}
+    for key, (threads, offsets) in layout["partitions"].items():
+        df, expected = HDF5Reader().parse_table(partitioned_trace, key), HDF5Reader().parse_table(hdf_trace, key)
+        assert offsets[-1] == len(expected) and np.array_equal(df.index, np.arange(len(expected)))
+        assert np.array_equal(sorted_rows(df), sorted_rows(expected))
+        assert np.array_equal(threads, np.unique(threads, axis=0))
+        for thread, start, stop in zip(threads, offsets[:-1], offsets[1:]):
+            rows = df.iloc[start:stop]
+            assert np.all(rows[list(THREAD_COLUMNS[key])].to_numpy() == thread)
+            assert rows[SORT_COLUMNS[key]].is_monotonic_increasing
+    assert not HDF5Reader().parse_layout(hdf_trace)["partitioned"]
+
+
+@pytest.mark.parametrize("key", (*RECORDS, INTERVALS))
+def test_parse_thread(hdf_trace, partitioned_trace, key):
+    threads, _ = HDF5Reader().parse_layout(partitioned_trace)["partitions"][key]
+    for appl, task, thread in [*threads.tolist(), (9, 9, 9)]:
+        df = HDF5Table(partitioned_trace, key).read_thread(appl, task, thread)
+        expected = HDF5Reader().parse_thread(hdf_trace, key, appl, task, thread)
+        assert np.array_equal(sorted_rows(df), sorted_rows(expected))
+        assert df[SORT_COLUMNS[key]].is_monotonic_increasing
+    assert HDF5Table(hdf_trace, key).thread_rows(1, 1, 1) is None
+    assert HDF5Table(partitioned_trace, key).thread_rows(9, 9, 9) == (0, 0)
+
+
+def test_partitioned_dask_frames(partitioned_trace):
+    threads, offsets = HDF5Reader().parse_layout(partitioned_trace)["partitions"]["States"]
+    states = HDF5Reader().parse_table(partitioned_trace, "States")
+    with patch("src.persistence.hdf5_reader.READ_ROWS", 20):
+        df = HDF5Reader().parse_table(partitioned_trace, "States", use_dask=True)
+    # Whole threads of 15, 13, 13 and 11 rows, none of them split
+    assert df.divisions == (0, 15, 28, 41, 51)
+    assert df.compute().equals(states)
+    assert df.loc[offsets[1]: offsets[2] - 1].npartitions == 1
+    with patch("src.persistence.hdf5_reader.READ_ROWS", 40):
+        assert HDF5Reader().parse_table(partitioned_trace, "States", use_dask=True).npartitions == 2
+
+
+def test_read_partitioned_table(hdf_trace, partitioned_trace):
+    predicate = Predicate([("event_t", "==", 42000050), ("time", ">=", 300000)])
+    df = HDF5Table(partitioned_trace, "Events").read(predicate)
+    expected = HDF5Table(hdf_trace, "Events").read(predicate)
+    assert df.shape[0] > 0 and np.array_equal(sorted_rows(df), sorted_rows(expected))
+    assert HDF5Table(partitioned_trace, "Events").row_range(predicate) == (0, 60)
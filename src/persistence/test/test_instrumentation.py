@@ -0,0 +1,78 @@
+import json
+import shutil
+
+import pytest
+
+from src.persistence import instrumentation
+from src.persistence.hdf5_reader import HDF5Reader
+from src.persistence.instrumentation import record, span
+from src.persistence.prv_reader import ParaverReader
+
+TINY_TRACE = "src/persistence/test/test_files/traces/tiny.test.prv"
+
+
+@pytest.fixture
+def instrumented():
+    instrumentation.clear()
+    instrumentation.enable()
+    yield
+    instrumentation.disable()
+    instrumentation.clear()
+
+
+def find(spans, name):
+    return next(span for span in spans if span["name"] == name)
+
+
+def test_disabled_is_noop():
+    instrumentation.clear()
+    assert not instrumentation.is_enabled()
+    with record("trace") as recorder, span("stage") as stage:
+        stage.add(bytes=10, records=1)
+    assert recorder is None and instrumentation.reports() == []
+
+
+def test_nested_spans(instrumented):
+    with record("trace"):
+        with span("parent") as parent:
+            parent.add(bytes=100)
+            for _ in range(3):
+                with span("child") as child:
+                    child.add(records=5)
+    with span("outside"):
+        pass
+    trace, other = instrumentation.reports()
+    assert trace["name"] == "trace" and other["name"] == ""
+    parent = find(trace["spans"], "parent")
+    assert parent["calls"] == 1 and parent["bytes"] == 100 and parent["mb_per_s"] > 0
+    # The spans of the loop are merged
+    child = find(parent["children"], "child")
+    assert child["calls"] == 3 and child["records"] == 15 and child["seconds"] <= parent["seconds"]
+    assert [span["name"] for span in other["spans"]] == ["outside"]
+
+
+def test_record_appends_unless_reset(instrumented):
+    for reset in (False, False, True):
+        with record("trace", reset=reset), span("stage"):
+            pass
+    assert find(instrumentation.reports()[0]["spans"], "stage")["calls"] == 1
+
+
+def test_convert_report(instrumented, tmp_path):
+    file = tmp_path / "tiny.prv"
+    shutil.copy(TINY_TRACE, file)
+    ParaverReader().convert(str(file), force=True)
+    HDF5Reader().open_trace(str(tmp_path / "tiny.hdf"), use_dask=False).df_state
+
+    report = instrumentation.reports()[0]
+    assert report["name"] == "tiny.hdf"
+    convert = find(report["spans"], "convert")
+    assert convert["bytes"] == file.stat().st_size and convert["records"] == 52 + 60 + 6
+    # The parser runs as the writer consumes its chunks
+    written = find(convert["children"], "records_to_hdf5")
+    names = [child["name"] for child in written["children"]]
+    assert names == ["parse_range", "reshape", "append", "finalize"]
+    assert find(written["children"], "parse_range")["bytes"] > 0
+    # Opening a table of the trace is recorded in its report
+    assert find(report["spans"], "parse_table")["records"] == 52
+    assert json.loads(json.dumps(instrumentation.reports())) == instrumentation.reports()
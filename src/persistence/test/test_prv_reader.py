@@ -1,10 +1,20 @@
 import json
 import os
+import shutil
 from datetime import datetime
+from unittest.mock import patch
 
-from src.persistence.prv_reader import ParaverReader
+import h5py
+import numpy as np
+import pytest
+
+from src.persistence.format_converter import COMPRESSIONS
+from src.persistence.hdf5_reader import HDF5Reader
+from src.persistence.prv_reader import ParaverReader, source_fingerprint
+from src.persistence.writer import Writer
 
 TRACES_DIR = "src/persistence/test/test_files/headers"
+TINY_TRACE = "src/persistence/test/test_files/traces/tiny.test.prv"
 
 
 def compare_trace_metadata(trace_a, trace_b):
@@ -49,3 +59,107 @@ def test_prv_header_parser():
     header_parser = ParaverReader()
     for header, expected_header in header_test_data:
         assert expected_header == header_parser.header_parser(header)
+
+
+@pytest.mark.parametrize("streaming", (True, False))
+def test_parse_file(tmp_path, streaming):
+    trace_file = shutil.copy(TINY_TRACE, tmp_path)
+    trace_metadata, df_state, df_event, df_comm = ParaverReader().parse_file(trace_file, streaming=streaming)
+    assert trace_metadata.path == str(tmp_path / "tiny.test.hdf")
+    assert os.path.isfile(trace_metadata.path)
+    assert trace_metadata.exec_time == 1000
+    assert trace_metadata.apps == [[{"nThreads": 2, "node": 0}, {"nThreads": 2, "node": 0}]]
+    assert (df_state.shape[0].compute(), df_event.shape[0].compute(), df_comm.shape[0].compute()) == (52, 60, 6)
+    assert np.array_equal(df_state.compute().values[0], [1, 1, 1, 1, 0, 62445, 1])
+
+
+def test_parse_file_skips_converted(tmp_path):
+    trace_file = shutil.copy(TINY_TRACE, tmp_path)
+    reader = ParaverReader()
+    expected = reader.parse_file(trace_file)
+    with patch("src.persistence.prv_reader.Writer") as writer:
+        trace_metadata, df_state, df_event, df_comm = reader.parse_file(trace_file)
+        writer.assert_not_called()
+    assert trace_metadata == expected[0]
+    assert df_state.compute().equals(expected[1].compute())
+    assert df_event.compute().equals(expected[2].compute())
+    assert df_comm.compute().equals(expected[3].compute())
+
+    with patch("src.persistence.prv_reader.Writer", wraps=Writer) as writer:
+        reader.parse_file(trace_file, force=True)
+        writer.assert_called()
+
+
+@pytest.mark.parametrize("change", ("append", "touch", "interrupt", "old_layout"))
+def test_parse_file_reconverts(tmp_path, change):
+    trace_file = shutil.copy(TINY_TRACE, tmp_path)
+    reader = ParaverReader()
+    trace_metadata = reader.parse_file(trace_file)[0]
+    if change == "append":
+        with open(trace_file, "a") as f:
+            f.write("2:1:1:1:1:999999:50000001:1\n")
+    elif change == "touch":
+        stat = os.stat(trace_file)
+        os.utime(trace_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    elif change == "interrupt":
+        reader.clear_source_from_hdf5(trace_metadata.path)
+    else:
+        with h5py.File(trace_metadata.path, "a") as f:
+            f["RECORDS"].attrs["layout_version"] = 1
+    assert not reader.is_converted(trace_metadata.path, source_fingerprint(trace_file))
+    with patch("src.persistence.prv_reader.Writer", wraps=Writer) as writer:
+        _, _, df_event, _ = reader.parse_file(trace_file)
+        writer.assert_called()
+    assert df_event.shape[0].compute() == (61 if change == "append" else 60)
+    assert reader.is_converted(trace_metadata.path, source_fingerprint(trace_file))
+
+
+def test_source_fingerprint(tmp_path):
+    trace_file = shutil.copy(TINY_TRACE, tmp_path)
+    with patch("src.persistence.prv_reader.FINGERPRINT_BYTES", 64):
+        source = source_fingerprint(trace_file)
+        assert source["source_path"] == os.path.abspath(trace_file)
+        assert source["source_size"] == os.path.getsize(trace_file)
+        with open(trace_file, "r+b") as f:
+            f.seek(100)
+            f.write(b"9")
+        # The middle of the file is not hashed
+        assert source_fingerprint(trace_file)["source_fingerprint"] == source["source_fingerprint"]
+        with open(trace_file, "r+b") as f:
+            f.seek(-2, os.SEEK_END)
+            f.write(b"9")
+        assert source_fingerprint(trace_file)["source_fingerprint"] != source["source_fingerprint"]
+
+
+@pytest.mark.parametrize("extension", ("gz", "bz2", "xz"))
+def test_convert_compressed(tmp_path, extension):
+    trace_file = str(tmp_path / f"tiny.prv.{extension}")
+    with open(TINY_TRACE, "rb") as f, COMPRESSIONS[extension].open(trace_file, "wb") as compressed:
+        compressed.write(f.read())
+    trace_metadata = ParaverReader().convert(trace_file)
+    # The header is read from the decompressed stream
+    assert trace_metadata.name == "tiny.hdf" and trace_metadata.path == str(tmp_path / "tiny.hdf")
+    assert trace_metadata.exec_time == 1000
+    assert trace_metadata.apps == [[{"nThreads": 2, "node": 0}, {"nThreads": 2, "node": 0}]]
+    assert ParaverReader().is_converted(trace_metadata.path, source_fingerprint(trace_file))
+    assert HDF5Reader().parse_nrows(trace_metadata.path) == {"States": 52, "Events": 60, "Comm": 6}
+
+
+def test_convert_partitioned(tmp_path):
+    trace_file = shutil.copy(TINY_TRACE, tmp_path)
+    reader = ParaverReader()
+    trace_metadata = reader.convert(trace_file, partition_threads=True)
+    assert trace_metadata.partitioned
+    trace = HDF5Reader().open_trace(trace_metadata.path)
+    assert trace.metadata == trace_metadata and not trace.is_sorted
+    assert trace.df_state.npartitions == 1 and trace.df_state.known_divisions
+    source = source_fingerprint(trace_file)
+    assert reader.is_converted(trace_metadata.path, source, partition_threads=True)
+    # Converting it again without partitions rewrites the file
+    assert not reader.is_converted(trace_metadata.path, source)
+    with patch("src.persistence.prv_reader.Writer", wraps=Writer) as writer:
+        assert not reader.convert(trace_file, partition_threads=False).partitioned
+        writer.assert_called_once_with(False)
+    assert HDF5Reader().open_trace(trace_metadata.path).is_sorted
+    with pytest.raises(Exception):
+        reader.convert(trace_file, partition_threads=True, storage="parquet")
@@ -1,13 +1,23 @@
 import logging
+import os
+import tracemalloc
 from unittest.mock import patch
 
 import numpy as np
 import pandas as pd
 import pytest
 
+from src.persistence.format_converter import (
+    COMPRESSIONS,
+    mmap_chunk_reader,
+    newline_aligned_ranges,
+    newline_aligned_windows,
+    stream_chunk_reader,
+)
+from src.CONST import CommRecord, EventRecord, StateRecord
 from src.persistence.hdf5_reader import HDF5Reader
-from src.persistence.prv_to_hdf5 import ParaverToHDF5
-from src.persistence.writer import Writer
+from src.persistence.prv_to_hdf5 import ParaverToHDF5, count_records, decode_records
+from src.persistence.writer import LAYOUT_VERSION, Writer
 
 logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -16,6 +26,7 @@ TRACES_DIR = "src/persistence/test/test_files/traces"
 
 files_dir = "src/persistence/test/test_files/traces"
 files = ["10MB.test.prv"]
+tiny_trace = f"{files_dir}/tiny.test.prv"
 
 format_converter = ParaverToHDF5()
 
@@ -59,6 +70,9 @@ all_parser_params = (
     {"STEPS": 200000, "MAX_READ_BYTES": 1024 * 1024, "MIN_ELEM": 40000000},
 )
 
+# Tiny chunks and arrays force every resize path of the parser
+resize_parser_params = all_parser_params + ({"STEPS": 3, "MAX_READ_BYTES": 300, "MIN_ELEM": 1},)
+
 
 def assert_equals_if_rows(df1, df2):
     if df1.shape[0] != 0 and df2.shape[0] != 0:
@@ -114,3 +128,354 @@ def test_e2e_parse_and_read(use_dask):
         assert_equals_if_rows(df_state.values, df_state_test.values)
         assert_equals_if_rows(df_event.values, df_event_test.values)
         assert_equals_if_rows(df_comm.values, df_comm_test.values)
+
+
+@pytest.mark.parametrize("parts", (1, 2, 3, 7, 1000))
+def test_newline_aligned_ranges(parts):
+    with open(tiny_trace, "rb") as f:
+        content = f.read()
+    ranges = newline_aligned_ranges(tiny_trace, parts)
+    assert len(ranges) <= parts
+    assert ranges[0][0] == content.index(b"\n") + 1
+    assert ranges[-1][1] == len(content)
+    for (_, end), (start, _) in zip(ranges[:-1], ranges[1:]):
+        assert end == start
+        assert content[start - 1 : start] == b"\n"
+
+
+@pytest.mark.parametrize("parser_params", resize_parser_params)
+@pytest.mark.parametrize("workers", (2, 4))
+def test_par_prv_trace_parser(parser_params, workers):
+    with patch("src.persistence.prv_to_hdf5.STEPS", parser_params["STEPS"]), patch(
+        "src.persistence.prv_to_hdf5.MAX_READ_BYTES", parser_params["MAX_READ_BYTES"]
+    ), patch("src.persistence.prv_to_hdf5.MIN_ELEM", parser_params["MIN_ELEM"]):
+        seq_dfs = format_converter.parse_as_dataframe(tiny_trace, use_dask=False, workers=1)
+        par_dfs = format_converter.parse_as_dataframe(tiny_trace, use_dask=False, workers=workers)
+        for df_seq, df_par in zip(seq_dfs, par_dfs):
+            assert df_seq.shape[0] > 0
+            assert np.array_equal(df_seq.values, df_par.values)
+
+
+def reference_records(file):
+    with open(file, "r") as f:
+        lines = f.readlines()[1:]
+    arr_state, stcount, arr_event, evcount, arr_comm, commcount = format_converter.seq_parser(lines)
+    return (
+        arr_state.reshape((-1, 7)).astype("int64"),
+        arr_event.reshape((-1, 7)).astype("int64"),
+        arr_comm.reshape((-1, 14)).astype("int64"),
+    )
+
+
+def test_decode_records():
+    with open(tiny_trace, "rb") as f:
+        content = f.read()
+    for decoded, expected in zip(decode_records(content), reference_records(tiny_trace)):
+        assert decoded.dtype == np.int64
+        assert np.array_equal(decoded, expected)
+
+
+def test_decode_records_event_pairs():
+    arr_state, arr_event, arr_comm = decode_records(b"2:1:1:1:1:500:10:1:20:2:30:0\n2:2:1:1:2:600:40:4")
+    assert arr_state.shape == (0, 7) and arr_comm.shape == (0, 14)
+    assert arr_event.tolist() == [
+        [1, 1, 1, 1, 500, 10, 1],
+        [1, 1, 1, 1, 500, 20, 2],
+        [1, 1, 1, 1, 500, 30, 0],
+        [2, 1, 1, 2, 600, 40, 4],
+    ]
+
+
+@pytest.mark.parametrize(
+    "buffer",
+    (
+        b"1:1:1:1:1:0:100:1\r\n2:1:1:1:1:-5:10:-1\r\n",
+        b"1:1:1:1:1:0:100:1\r\n2:1:1:1:1:-5:10:-1",
+        b"c:1:1\r\n\r\n1:1:1:1:1:0:100:1\n2:1:1:1:1:-5:10:-1\n",
+    ),
+)
+def test_decode_records_like_int(buffer):
+    # Same records as the line by line parser, which converts the fields with int()
+    arr_state, arr_event, _ = decode_records(buffer)
+    lines = buffer.decode().splitlines()
+    assert arr_state.tolist() == [ParaverToHDF5._get_state_row(line) for line in lines if line.startswith("1:")]
+    assert arr_event.tolist() == [[1, 1, 1, 1, -5, 10, -1]]
+
+
+@pytest.mark.parametrize(
+    "buffer",
+    (
+        b"1:1:1:1:1:0:100\n",
+        b"2:1:1:1:1:0:10\n",
+        b"3:1:1:1:1:0:0:2:1:1:1:5:5:8\n",
+        b"1:1:1:1:1:0:1a0:1\n",
+        b"1:1:1:1::0:100:1\n",
+        b"1:1:1:1:-:0:100:1\n",
+        b"1:1:1:1:1:0:100:1-\n",
+    ),
+)
+def test_decode_records_malformed(buffer):
+    with pytest.raises(ValueError):
+        decode_records(buffer)
+
+
+def test_decode_records_long_fields():
+    # Fields of more than 18 digits are converted one by one, those that do not fit in an int64 are rejected
+    arr_state, arr_event, _ = decode_records(
+        b"1:1:1:1:1:0:9223372036854775807:1\n2:1:1:1:1:-9223372036854775808:10:000000000000000000001\n"
+    )
+    assert arr_state.tolist() == [[1, 1, 1, 1, 0, 9223372036854775807, 1]]
+    assert arr_event.tolist() == [[1, 1, 1, 1, -9223372036854775808, 10, 1]]
+    for field in (b"9223372036854775808", b"-9223372036854775809", b"9999999999999999999", b"1" * 25):
+        with pytest.raises(ValueError):
+            decode_records(b"1:1:1:1:1:0:" + field + b":1\n")
+
+
+@pytest.mark.parametrize("window_bytes", (1, 16, 100, 10 ** 6))
+def test_newline_aligned_windows(window_bytes):
+    with open(tiny_trace, "rb") as f:
+        content = f.read()
+    windows = [bytes(window) for window in newline_aligned_windows(content, window_bytes)]
+    assert b"".join(windows) == content
+    assert all(window.endswith(b"\n") for window in windows)
+
+
+@pytest.mark.parametrize(
+    "buffer", (b"a" * 10000 + b"\nb\nc\n", b"a\n" + b"b" * 10000, b"a\n" * 10 + b"b" * 10000 + b"\n")
+)
+def test_newline_aligned_windows_long_line(buffer):
+    windows = [bytes(window) for window in newline_aligned_windows(buffer, 16)]
+    assert b"".join(windows) == buffer
+    assert all(len(window) <= 16 or window.count(b"\n") <= 1 for window in windows)
+
+
+def test_newline_aligned_windows_long_line_copies():
+    # A line longer than the window is extended up to its newline, not by copying the rest of the buffer
+    buffer = b"a" * 100 + b"\n" + b"b\n" * 16 * 1024 * 1024
+    tracemalloc.start()
+    try:
+        first = next(newline_aligned_windows(buffer, 16))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert bytes(first) == b"a" * 100 + b"\n"
+    assert peak < 1024 * 1024
+
+
+@pytest.mark.parametrize("decode_bytes", (64, 1024 * 1024))
+@pytest.mark.parametrize("read_bytes", (256, 1024 * 1024))
+def test_vec_prv_trace_parser(decode_bytes, read_bytes):
+    with patch("src.persistence.prv_to_hdf5.DECODE_BYTES", decode_bytes), patch(
+        "src.persistence.prv_to_hdf5.MAX_READ_BYTES", read_bytes
+    ):
+        dfs = format_converter.parse_as_dataframe(tiny_trace, use_dask=False)
+    for df, expected in zip(dfs, reference_records(tiny_trace)):
+        assert np.array_equal(df.values, expected)
+
+
+@pytest.mark.parametrize("read_bytes", (1, 100, 10 ** 6))
+def test_mmap_chunk_reader(read_bytes):
+    with open(tiny_trace, "rb") as f:
+        content = f.read()
+    body_start = content.index(b"\n") + 1
+    windows = [bytes(window) for window in mmap_chunk_reader(tiny_trace, read_bytes)]
+    assert b"".join(windows) == content[body_start:]
+    assert all(window.endswith(b"\n") for window in windows)
+    start, end = newline_aligned_ranges(tiny_trace, 2)[1]
+    windows = [bytes(window) for window in mmap_chunk_reader(tiny_trace, read_bytes, start, end)]
+    assert b"".join(windows) == content[start:end]
+
+
+def test_mmap_chunk_reader_empty_file(tmp_path):
+    empty_file = tmp_path / "empty.prv"
+    empty_file.write_bytes(b"")
+    assert list(mmap_chunk_reader(str(empty_file), 100)) == []
+
+
+@pytest.mark.parametrize("vectorized", (False, True))
+def test_prv_trace_parser_small_windows(vectorized):
+    with patch("src.persistence.prv_to_hdf5.MAX_READ_BYTES", 128):
+        dfs = format_converter.parse_as_dataframe(tiny_trace, use_dask=False, vectorized=vectorized)
+    for df, expected in zip(dfs, reference_records(tiny_trace)):
+        assert np.array_equal(df.values, expected)
+
+
+@pytest.mark.parametrize("workers", (1, 3))
+@pytest.mark.parametrize("read_bytes", (200, 1024 * 1024))
+def test_streaming_records_to_hdf5(tmp_path, workers, read_bytes):
+    hdf_file = str(tmp_path / "tiny.hdf")
+    with patch("src.persistence.prv_to_hdf5.MAX_READ_BYTES", read_bytes):
+        rows = Writer().records_to_hdf5(hdf_file, format_converter.iter_records(tiny_trace, workers=workers))
+    expected = reference_records(tiny_trace)
+    assert rows == {"States": expected[0].shape[0], "Events": expected[1].shape[0], "Comm": expected[2].shape[0]}
+    for df, arr in zip(HDF5Reader().parse_records(hdf_file), expected):
+        assert np.array_equal(df.values, arr)
+        assert np.array_equal(df.index, np.arange(arr.shape[0]))
+
+
+@pytest.mark.parametrize("workers", (1, 3))
+def test_iter_records_progress(workers):
+    calls = []
+    with patch("src.persistence.prv_to_hdf5.MAX_READ_BYTES", 200):
+        chunks = list(format_converter.iter_records(tiny_trace, workers=workers, progress=lambda *c: calls.append(c)))
+    assert len(calls) == len(chunks) > 1
+    assert [c[0] for c in calls] == sorted(c[0] for c in calls) and calls[-1][0] == os.path.getsize(tiny_trace)
+    assert calls[-1][1] == sum(arr.shape[0] for records in chunks for arr in records)
+
+
+@pytest.mark.parametrize("workers", (1, 3))
+def test_iter_records_progress_stops(workers):
+    def progress(bytes_parsed, records_parsed):
+        raise Exception("Cancelled.")
+
+    with patch("src.persistence.prv_to_hdf5.MAX_READ_BYTES", 200):
+        records = format_converter.iter_records(tiny_trace, workers=workers, progress=progress)
+        next(records)
+        with pytest.raises(Exception, match="Cancelled"):
+            next(records)
+
+
+@pytest.fixture(params=sorted(COMPRESSIONS))
+def compressed_trace(tmp_path, request):
+    compressed_file = str(tmp_path / f"tiny.prv.{request.param}")
+    with open(tiny_trace, "rb") as f, COMPRESSIONS[request.param].open(compressed_file, "wb") as compressed:
+        compressed.write(f.read())
+    return compressed_file
+
+
+@pytest.mark.parametrize("read_bytes", (1, 100, 10 ** 6))
+def test_stream_chunk_reader(compressed_trace, read_bytes):
+    with open(tiny_trace, "rb") as f:
+        content = f.read()
+    with patch("src.persistence.format_converter.DECOMPRESS_BYTES", 64):
+        chunks = [(bytes(window), position) for window, position in stream_chunk_reader(compressed_trace, read_bytes)]
+    windows, positions = zip(*chunks)
+    assert b"".join(windows) == content[content.index(b"\n") + 1:]
+    assert all(window.endswith(b"\n") for window in windows)
+    assert list(positions) == sorted(positions) and positions[-1] == os.path.getsize(compressed_trace)
+
+
+def test_stream_chunk_reader_corrupt_file(tmp_path):
+    corrupt_file = tmp_path / "corrupt.prv.gz"
+    corrupt_file.write_bytes(b"not compressed")
+    with pytest.raises(OSError):
+        list(stream_chunk_reader(str(corrupt_file), 100))
+
+
+@pytest.mark.parametrize("workers", (1, 3))
+def test_compressed_iter_records(compressed_trace, workers):
+    calls = []
+    with patch("src.persistence.prv_to_hdf5.MAX_READ_BYTES", 200):
+        chunks = list(
+            format_converter.iter_records(compressed_trace, workers=workers, progress=lambda *c: calls.append(c))
+        )
+    for arrays, expected in zip(zip(*chunks), reference_records(tiny_trace)):
+        assert np.array_equal(np.concatenate(arrays), expected)
+    assert len(chunks) > 1 and calls[-1][0] == os.path.getsize(compressed_trace)
+
+
+@pytest.mark.parametrize("workers", (1, 3))
+@pytest.mark.parametrize("vectorized", (False, True))
+def test_compressed_parse_as_dataframe(compressed_trace, workers, vectorized):
+    with patch("src.persistence.prv_to_hdf5.MAX_READ_BYTES", 128):
+        dfs = format_converter.parse_as_dataframe(compressed_trace, False, workers=workers, vectorized=vectorized)
+    for df, expected in zip(dfs, reference_records(tiny_trace)):
+        assert np.array_equal(df.values, expected)
+
+
+def test_count_records():
+    with open(tiny_trace, "rb") as f:
+        content = f.read()
+    assert count_records(content) == tuple(arr.size for arr in reference_records(tiny_trace))
+    assert count_records(b"2:1:1:1:1:5:10:1:20:2\n1:1:1:1:1:0:5:1\n3:1:1:1:1:0:0:2:1:1:1:5:5:8:1") == (7, 14, 14)
+    assert count_records(b"") == (0, 0, 0)
+
+
+@pytest.mark.parametrize("parser_params", resize_parser_params)
+@pytest.mark.parametrize("raw_chunk", (False, True))
+def test_seq_parser_resize(parser_params, raw_chunk):
+    with open(tiny_trace, "rb") as f:
+        content = f.read()
+    chunk = content if raw_chunk else content.decode().splitlines(keepends=True)
+    with patch("src.persistence.prv_to_hdf5.STEPS", parser_params["STEPS"]), patch(
+        "src.persistence.prv_to_hdf5.MIN_ELEM", parser_params["MIN_ELEM"]
+    ):
+        arr_state, stcount, arr_event, evcount, arr_comm, commcount = format_converter.seq_parser(chunk)
+    for arr, count, expected in zip(
+        (arr_state, arr_event, arr_comm), (stcount, evcount, commcount), decode_records(content)
+    ):
+        assert arr.dtype == np.int64
+        assert count == expected.size
+        assert np.array_equal(arr.reshape(expected.shape), expected)
+
+
+def test_seq_parser_exact_preallocation():
+    def no_growth(arr, size):
+        assert size <= arr.size, "pre-sized arrays should never grow"
+        return arr
+
+    with open(tiny_trace, "rb") as f:
+        content = f.read()
+    with patch("src.persistence.prv_to_hdf5._reserve", side_effect=no_growth):
+        arr_state, stcount, arr_event, evcount, arr_comm, commcount = format_converter.seq_parser(content)
+    assert (arr_state.size, arr_event.size, arr_comm.size) == count_records(content)
+
+
+@pytest.mark.parametrize("use_dask", (False, True))
+def test_parse_as_dataframe_dtypes(use_dask):
+    dfs = format_converter.parse_as_dataframe(tiny_trace, use_dask=use_dask)
+    for df, record in zip(dfs, (StateRecord, EventRecord, CommRecord)):
+        assert df.dtypes.to_dict() == {name: np.dtype(dtype) for name, dtype in record.dtypes().items()}
+
+
+def test_streaming_widens_table_dtypes(tmp_path):
+    hdf_file = str(tmp_path / "widen.hdf")
+    first = np.array([[1, 1, 1, 1, 0, 10, 1]])
+    second = np.array([[1, 1, 1, 1, 10, 20, 300], [40000, 1, 1, 1, 20, 30, 2]])
+    empty_event, empty_comm = np.empty((0, 7), dtype="int64"), np.empty((0, 14), dtype="int64")
+    Writer().records_to_hdf5(hdf_file, [(first, empty_event, empty_comm), (second, empty_event, empty_comm)])
+    df_state, _, _ = HDF5Reader().parse_records(hdf_file)
+    assert np.array_equal(df_state.values, np.concatenate((first, second)))
+    assert df_state["state"].dtype == np.dtype("uint16")
+    assert df_state["cpu_id"].dtype == np.dtype("int32")
+    assert df_state["time_ini"].dtype == np.dtype("int64")
+
+
+def test_sorted_indexed_layout(tmp_path):
+    hdf_file = str(tmp_path / "layout.hdf")
+    with patch("src.persistence.writer.CHUNK_ROWS", 16):
+        Writer().records_to_hdf5(hdf_file, format_converter.iter_records(tiny_trace))
+    layout = HDF5Reader().parse_layout(hdf_file)
+    assert layout["version"] == LAYOUT_VERSION
+    assert layout["chunk_rows"] == 16
+    assert layout["sorted_by"] == {"States": "time_ini", "Events": "time", "Comm": "lsend", "Intervals": "time_ini"}
+    with pd.HDFStore(hdf_file, mode="r") as store:
+        for key, column in layout["sorted_by"].items():
+            table = store.get_storer(key).table
+            assert table.filters.complevel > 0
+            assert table.colindexed[column]
+            values = store.select_column(key, column).to_numpy()
+            expected_bounds = [[chunk[0], chunk[-1]] for chunk in np.array_split(values, range(16, values.size, 16))]
+            assert np.array_equal(layout["chunks"][key], expected_bounds)
+        assert store.get_storer("Events").table.colindexed["event_t"]
+
+
+def test_layout_sorts_unsorted_tables(tmp_path):
+    hdf_file = str(tmp_path / "unsorted.hdf")
+    expected = reference_records(tiny_trace)
+    # Reverse the States, so the Writer has to sort them
+    unsorted = (expected[0][::-1], expected[1], expected[2])
+    Writer().records_to_hdf5(hdf_file, [unsorted])
+    df_state, df_event, _ = HDF5Reader().parse_records(hdf_file)
+    assert np.array_equal(df_state["time_ini"].to_numpy(), np.sort(expected[0][:, 4]))
+    assert np.array_equal(np.sort(df_state.values, axis=0), np.sort(expected[0], axis=0))
+    assert np.array_equal(df_state.index, np.arange(expected[0].shape[0]))
+    assert np.array_equal(df_event.values, expected[1])
+
+
+def test_layout_version_of_old_files(tmp_path):
+    hdf_file = str(tmp_path / "old.hdf")
+    pd.DataFrame(reference_records(tiny_trace)[0], columns=StateRecord.all_attributes()).to_hdf(
+        hdf_file, key="States", format="table"
+    )
+    assert HDF5Reader().parse_layout(hdf_file)["version"] == 0
@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.CONST import EventRecord, StateRecord
+from src.persistence.schema import compact_dataframe, fit_dtype, records_to_dataframe, widen_dtypes
+
+
+@pytest.mark.parametrize(
+    "values,dtype,expected_dtype",
+    (
+        (np.array([0, 255]), "uint8", "uint8"),
+        (np.array([0, 256]), "uint8", "uint16"),
+        (np.array([-1, 3]), "uint8", "int16"),
+        (np.array([0, 40000]), "int16", "int32"),
+        (np.array([0, 2 ** 40]), "int32", "int64"),
+        (np.array([-(2 ** 62), 2 ** 62]), "uint8", "int64"),
+        (np.array([], dtype="int64"), "int16", "int16"),
+    ),
+)
+def test_fit_dtype(values, dtype, expected_dtype):
+    assert fit_dtype(values, dtype) == np.dtype(expected_dtype)
+
+
+def test_widen_dtypes():
+    dtypes = {"a": np.dtype("uint8"), "b": np.dtype("int32")}
+    assert widen_dtypes(dtypes, {"a": np.dtype("int16"), "b": np.dtype("int16")}) == {
+        "a": np.dtype("int16"),
+        "b": np.dtype("int32"),
+    }
+
+
+def test_records_to_dataframe():
+    arr = np.array([[1, 1, 1, 1, 0, 100, 1], [70000, 2, 3, 4, 100, 2 ** 40, 300]])
+    df = records_to_dataframe(arr, StateRecord)
+    assert list(df.columns) == StateRecord.all_attributes()
+    expected = dict(StateRecord.dtypes(), cpu_id="int32", state="uint16")
+    assert df.dtypes.to_dict() == {name: np.dtype(dtype) for name, dtype in expected.items()}
+    assert np.array_equal(df.values, arr)
+
+
+def test_compact_dataframe():
+    df = pd.DataFrame(np.array([[1, 1, 1, 1, 10, 50000001, 3]]), columns=EventRecord.all_attributes())
+    compact = compact_dataframe(df, EventRecord)
+    assert compact.dtypes.to_dict() == {name: np.dtype(dtype) for name, dtype in EventRecord.dtypes().items()}
+    assert compact.memory_usage(index=False).sum() < df.memory_usage(index=False).sum()
+    assert np.array_equal(compact.values, df.values)
@@ -0,0 +1,47 @@
+import logging
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+
+from src.persistence.prv_reader import ParaverReader
+from src.persistence.prv_to_hdf5 import ParaverToHDF5
+from src.persistence.synthetic import generate_trace
+
+logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+@pytest.mark.parametrize("events_per_line", (1, 3))
+@pytest.mark.parametrize("mix", ((0.6, 0.3, 0.1), (1, 0, 0), (0, 1, 1)))
+def test_generate_trace(tmp_path, events_per_line, mix):
+    file = str(tmp_path / "synthetic.prv")
+    with patch("src.persistence.synthetic.BATCH_LINES", 1000):
+        counts = generate_trace(file, 100000, tasks=3, threads=2, mix=mix, events_per_line=events_per_line)
+    with open(file) as f:
+        header = f.readline()
+        assert len(f.read()) + len(header) == counts["bytes"] >= 100000
+    exec_time, _, nodes, apps = ParaverReader().header_parser(header)
+    assert nodes == [6] and apps == [[{"nThreads": 2, "node": 1}] * 3]
+
+    df_state, df_event, df_comm = ParaverToHDF5().parse_as_dataframe(file, use_dask=False)
+    assert (len(df_state), len(df_event), len(df_comm)) == (counts["States"], counts["Events"], counts["Comm"])
+    assert len(df_state) + len(df_event) // events_per_line + len(df_comm) == counts["lines"]
+    for fraction, df in zip(mix, (df_state, df_event, df_comm)):
+        assert (len(df) > 0) == (fraction > 0)
+    assert len(df_state) == 0 or df_state["time_fi"].max() // 1000 <= exec_time
+    assert set(df_state["task_id"]) <= {1, 2, 3} and set(df_state["thread_id"]) <= {1, 2}
+    # The states of each thread cover its timeline, one after another
+    for _, states in df_state.sort_values("time_ini").groupby(["task_id", "thread_id"]):
+        assert states["time_ini"].iloc[0] == 0
+        assert np.array_equal(states["time_ini"].to_numpy()[1:], states["time_fi"].to_numpy()[:-1])
+        assert (states["time_fi"] > states["time_ini"]).all()
+
+
+def test_generate_trace_is_deterministic(tmp_path):
+    files = [str(tmp_path / name) for name in ("a.prv", "b.prv", "c.prv")]
+    generate_trace(files[0], 50000, seed=1)
+    generate_trace(files[1], 50000, seed=1)
+    generate_trace(files[2], 50000, seed=2)
+    contents = [open(file).read() for file in files]
+    assert contents[0] == contents[1] != contents[2]
@@ -0,0 +1,103 @@
+import logging
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+
+from src.persistence import timeline as timeline_module
+from src.persistence.hdf5_reader import HDF5Reader
+from src.persistence.prv_to_hdf5 import ParaverToHDF5
+from src.persistence.timeline import NO_STATE
+from src.persistence.writer import Writer
+
+logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+tiny_trace = "src/persistence/test/test_files/traces/tiny.test.prv"
+
+
+# (TIMELINE_ROWS, TIMELINE_BYTES, partitioned): every bucket at once or a bucket at a time of the States sorted by
+# time, every thread at once or a thread at a time of the States partitioned by thread
+@pytest.fixture(scope="module", params=((1, 10 ** 6, False), (5, 1, False), (3, 1, True), (2, 10 ** 6, True)))
+def hdf_trace(request, tmp_path_factory):
+    hdf_file = str(tmp_path_factory.mktemp("timeline") / "tiny.hdf")
+    rows, nbytes, partitioned = request.param
+    with patch("src.persistence.timeline.TIMELINE_BUCKETS", 16), patch(
+        "src.persistence.timeline.TIMELINE_ROWS", rows
+    ), patch("src.persistence.timeline.TIMELINE_BYTES", nbytes):
+        Writer(partition_threads=partitioned).records_to_hdf5(hdf_file, ParaverToHDF5().iter_records(tiny_trace))
+    return hdf_file
+
+
+def bucket_times(df_state, threads, states, start, width, buckets):
+    """ Time of each thread in each state in each bucket, state by state """
+    times = np.zeros((threads.shape[0], buckets, states.size))
+    for row in df_state.itertuples():
+        i = threads.tolist().index([row.appl_id, row.task_id, row.thread_id])
+        k = states.tolist().index(row.state)
+        for j in range(buckets):
+            low, high = start + j * width, start + (j + 1) * width
+            times[i, j, k] += max(0, min(row.time_fi, high) - max(row.time_ini, low))
+    return times
+
+
+def test_timeline_levels(hdf_trace):
+    df_state = HDF5Reader().parse_records(hdf_trace)[0]
+    end = df_state["time_fi"].max()
+    finest = HDF5Reader().parse_timeline(hdf_trace, pixels=end)
+    assert finest.level == 0 and finest.start == 0
+    assert finest.bucket_width == 2 ** int(np.ceil(np.log2(end / 16)))
+    assert finest.dominant.shape[1] <= 16
+    assert np.array_equal(np.unique(finest.states), np.unique(df_state["state"]))
+    levels = []
+    for pixels in (16, 8, 4, 2, 1):
+        timeline = HDF5Reader().parse_timeline(hdf_trace, pixels=pixels)
+        buckets = timeline.dominant.shape[1]
+        assert buckets >= pixels
+        times = bucket_times(df_state, timeline.threads, timeline.states, 0, timeline.bucket_width, buckets)
+        assert np.allclose(timeline.fractions, times / timeline.bucket_width, atol=1e-6)
+        dominant = np.where(times.sum(axis=2) > 0, timeline.states[times.argmax(axis=2)], NO_STATE)
+        assert np.array_equal(timeline.dominant, dominant)
+        levels.append(timeline.level)
+    assert levels == sorted(levels) and levels[-1] > 0
+
+
+def test_timeline_window(hdf_trace):
+    whole = HDF5Reader().parse_timeline(hdf_trace, pixels=16)
+    window = HDF5Reader().parse_timeline(hdf_trace, 300000, 600000, pixels=3)
+    assert window.start <= 300000 < window.start + window.bucket_width
+    assert window.start + window.dominant.shape[1] * window.bucket_width >= 600000
+    # Narrower windows are read from finer levels, only the buckets that overlap the window
+    assert window.level <= whole.level
+    assert window.dominant.shape[1] < 16 * 2 ** (whole.level - window.level)
+    level = HDF5Reader().parse_timeline(hdf_trace, 0, 16 * window.bucket_width, pixels=16)
+    first = window.start // window.bucket_width
+    assert np.array_equal(window.fractions, level.fractions[:, first: first + window.dominant.shape[1]])
+
+
+@pytest.mark.parametrize("partitioned", (False, True))
+def test_timeline_reads_states_twice(tmp_path, partitioned):
+    read, read_columns = [], timeline_module._state_columns
+
+    def state_columns(*args):
+        columns = read_columns(*args)
+        read.append(columns[0].size)
+        return columns
+
+    # A bucket or a thread at a time
+    with patch("src.persistence.timeline.TIMELINE_BUCKETS", 16), patch(
+        "src.persistence.timeline.TIMELINE_ROWS", 7
+    ), patch("src.persistence.timeline.TIMELINE_BYTES", 1), patch(
+        "src.persistence.timeline._state_columns", side_effect=state_columns
+    ):
+        Writer(partition_threads=partitioned).records_to_hdf5(
+            str(tmp_path / "tiny.hdf"), ParaverToHDF5().iter_records(tiny_trace)
+        )
+    # A pass to find the threads and states, another one to build the pyramid
+    assert sum(read) == 2 * 52
+
+
+def test_timeline_old_files(tmp_path):
+    hdf_file = str(tmp_path / "old.hdf")
+    ParaverToHDF5().parse_as_dataframe(tiny_trace, use_dask=False)[0].to_hdf(hdf_file, key="States", format="table")
+    assert HDF5Reader().parse_timeline(hdf_file) is None
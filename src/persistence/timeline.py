@@ -0,0 +1,295 @@
+import logging
+import math
+import os
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import tables
+
+from src.core.profile import split_thread_keys, thread_keys
+
+logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Group of the level of detail pyramid of the timelines of the threads, next to the States table
+TIMELINE = "/RECORDS/States_timeline"
+# Maximum buckets of the finest level, narrower windows have to be drawn from the State records
+TIMELINE_BUCKETS = int(os.environ.get("TIMELINE_BUCKETS", 4096))
+# Rows of the States table read at once while building the pyramid
+TIMELINE_ROWS = 1000000
+# Memory of the bucket times accumulated at once while building the pyramid: the buckets of all the threads are
+# built in blocks that fit in it, or the threads in groups that fit in it when the States are partitioned by thread
+TIMELINE_BYTES = int(os.environ.get("TIMELINE_BYTES", 256 * 1024 * 1024))
+# Dominant state of the buckets in which the thread has no state
+NO_STATE = -1
+
+_COLUMNS = ["appl_id", "task_id", "thread_id", "time_ini", "time_fi", "state"]
+
+
+@dataclass
+class Timeline:
+    """ One level of the pyramid over a time window: bucket j of threads[i] covers
+    [start + j * bucket_width, start + (j + 1) * bucket_width), dominant[i, j] is the state in which the thread
+    spent most of it and fractions[i, j, k] the fraction of it spent in states[k]
+    """
+
+    threads: np.ndarray
+    states: np.ndarray
+    level: int
+    start: int
+    bucket_width: int
+    dominant: np.ndarray
+    fractions: np.ndarray
+
+
+def _state_columns(store: pd.HDFStore, key: str, start: int, stop: int):
+    df = store.select(key, start=start, stop=stop, columns=_COLUMNS)
+    keys = thread_keys(df["appl_id"].to_numpy(), df["task_id"].to_numpy(), df["thread_id"].to_numpy())
+    return keys, df["state"].to_numpy(), df["time_ini"].to_numpy("int64"), df["time_fi"].to_numpy("int64")
+
+
+def _level_times(times: np.ndarray) -> np.ndarray:
+    """ Times of the buckets of the next level, each one is the sum of two buckets of the previous one """
+    if times.shape[1] % 2 == 1:
+        times = np.concatenate((times, np.zeros_like(times[:, :1])), axis=1)
+    return times[:, 0::2] + times[:, 1::2]
+
+
+def _level_buckets(buckets: int) -> List[int]:
+    """ Buckets of each level of the pyramid, from the finest one up to a single bucket """
+    sizes = [buckets]
+    while sizes[-1] > 1:
+        sizes.append(math.ceil(sizes[-1] / 2))
+    return sizes
+
+
+def _contributions(keys, states, chunk_keys, chunk_states, time_ini, time_fi, width: int) -> Tuple[np.ndarray, ...]:
+    """ (thread, state, bucket, time, full) of the times added by the states of a chunk to the buckets of level 0:
+    the time of the partial buckets at the ends of each state, and the +width/-width (full) of the difference array
+    of the full buckets in between, O(1) per state whatever its length
+    """
+    nonempty = time_fi > time_ini
+    thread_idx = np.searchsorted(keys, chunk_keys[nonempty])
+    state_idx = np.searchsorted(states, chunk_states[nonempty])
+    time_ini, time_fi = time_ini[nonempty], time_fi[nonempty]
+    first, last = time_ini // width, (time_fi - 1) // width
+    single, many = first == last, first != last
+    thread_many, state_many = thread_idx[many], state_idx[many]
+    return (
+        np.concatenate((thread_idx[single], thread_many, thread_many, thread_many, thread_many)),
+        np.concatenate((state_idx[single], state_many, state_many, state_many, state_many)),
+        np.concatenate((first[single], first[many], last[many], first[many] + 1, last[many])),
+        np.concatenate(
+            (
+                time_fi[single] - time_ini[single],
+                (first[many] + 1) * width - time_ini[many],
+                time_fi[many] - last[many] * width,
+                np.full(thread_many.size, width, dtype="int64"),
+                np.full(thread_many.size, -width, dtype="int64"),
+            )
+        ),
+        np.repeat(np.array([False, False, False, True, True]), (single.sum(), *[thread_many.size] * 4)),
+    )
+
+
+def _add(times: np.ndarray, full: np.ndarray, contributions: Tuple[np.ndarray, ...], first_thread=0, first_bucket=0):
+    """ Adds the `contributions` to the times[thread, state, bucket] and to the difference array `full` """
+    thread_idx, state_idx, bucket, time, is_full = contributions
+    thread_idx, bucket = thread_idx - first_thread, bucket - first_bucket
+    np.add.at(times, (thread_idx[~is_full], state_idx[~is_full], bucket[~is_full]), time[~is_full])
+    np.add.at(full, (thread_idx[is_full], state_idx[is_full], bucket[is_full]), time[is_full])
+
+
+def _thread_times(store, key, rows: Tuple[int, int], keys, states, threads: slice, width: int, buckets: int):
+    """ times[thread, bucket, state] spent by the `threads` of `keys` in each bucket of level 0, reading the `rows` of
+    the table `key` that hold them (a table partitioned by thread) TIMELINE_ROWS at a time
+    """
+    times = np.zeros((threads.stop - threads.start, states.size, buckets + 1))
+    full = np.zeros_like(times)
+    for start in range(rows[0], rows[1], TIMELINE_ROWS):
+        columns = _state_columns(store, key, start, min(start + TIMELINE_ROWS, rows[1]))
+        _add(times, full, _contributions(keys, states, *columns, width), first_thread=threads.start)
+    times += np.cumsum(full, axis=2)
+    del full
+    return times[:, :, :buckets].transpose(0, 2, 1)
+
+
+def _time_blocks(store, key, nrows: int, keys, states, width: int, buckets: int, block: int):
+    """ (first bucket, times[thread, bucket, state]) of the buckets of level 0 of every thread, `block` buckets at a
+    time, in a single pass of TIMELINE_ROWS rows over the table `key` sorted by time_ini. The buckets before the one
+    where the last state read starts are complete, the contributions to the next ones are kept until they are
+    """
+    # Sorted by bucket
+    pending = tuple(np.empty(0, dtype=dtype) for dtype in ("int64", "int64", "int64", "int64", bool))
+    # Difference array of the full buckets accumulated up to the next block
+    carry = np.zeros((keys.size, states.size))
+    first_bucket = 0
+    for start in range(0, nrows + TIMELINE_ROWS, TIMELINE_ROWS):
+        if start < nrows:
+            columns = _state_columns(store, key, start, start + TIMELINE_ROWS)
+            contributions = _contributions(keys, states, *columns, width)
+            pending = tuple(np.concatenate(arrays) for arrays in zip(pending, contributions))
+            order = np.argsort(pending[2], kind="stable")
+            pending = tuple(array[order] for array in pending)
+            complete = min(buckets, int(columns[2][-1] // width))
+        else:
+            complete = buckets
+        while first_bucket < complete:
+            last_bucket = min(first_bucket + block, complete, buckets)
+            split = int(np.searchsorted(pending[2], last_bucket))
+            contributions, pending = tuple(a[:split] for a in pending), tuple(a[split:] for a in pending)
+            times = np.zeros((keys.size, states.size, last_bucket - first_bucket))
+            full = np.zeros_like(times)
+            _add(times, full, contributions, first_bucket=first_bucket)
+            full = np.cumsum(full, axis=2) + carry[:, :, None]
+            carry = full[:, :, -1].copy()
+            times += full
+            del full
+            yield first_bucket, times.transpose(0, 2, 1)
+            first_bucket = last_bucket
+
+
+class _Pyramid:
+    """ Arrays of the levels of the pyramid in the group TIMELINE, see build_timeline """
+
+    def __init__(self, handle, group, threads: int, states: np.ndarray, level_buckets: List[int], filters):
+        self.states = states
+        self.level_buckets = level_buckets
+        self.dominants, self.fractions = [], []
+        for level, size in enumerate(level_buckets):
+            self.dominants.append(
+                handle.create_carray(
+                    group, f"dominant_{level}", atom=tables.Int16Atom(), shape=(threads, size), filters=filters
+                )
+            )
+            self.fractions.append(
+                handle.create_carray(
+                    group,
+                    f"fractions_{level}",
+                    atom=tables.Float32Atom(),
+                    shape=(threads, size, states.size),
+                    filters=filters,
+                )
+            )
+        # Buckets written of each level, and the last bucket of each level not paired yet with the next one
+        self._written = [0] * len(level_buckets)
+        self._unpaired: List[Optional[np.ndarray]] = [None] * len(level_buckets)
+
+    def _write(self, level: int, threads: slice, first: int, times: np.ndarray, width: int):
+        buckets = slice(first, first + times.shape[1])
+        totals = times.sum(axis=2)
+        has_states = self.states.size > 0
+        dominant = np.where(totals > 0, self.states[times.argmax(axis=2)] if has_states else NO_STATE, NO_STATE)
+        self.dominants[level][threads, buckets] = dominant.astype("int16")
+        self.fractions[level][threads, buckets] = (times / (width * 2 ** level)).astype("float32")
+
+    def write_threads(self, threads: slice, times: np.ndarray, width: int):
+        """ Every level of the `threads`, from the times of all their buckets of level 0 """
+        for level in range(len(self.level_buckets)):
+            self._write(level, threads, 0, times, width)
+            times = _level_times(times)
+
+    def append(self, times: np.ndarray, width: int, level: int = 0):
+        """ The next buckets of `level` of every thread, and the buckets of the levels above they complete """
+        self._write(level, slice(None), self._written[level], times, width)
+        self._written[level] += times.shape[1]
+        if level + 1 == len(self.level_buckets):
+            return
+        if self._unpaired[level] is not None:
+            times = np.concatenate((self._unpaired[level], times), axis=1)
+        paired = times.shape[1] - times.shape[1] % 2
+        self._unpaired[level] = times[:, paired:] if paired < times.shape[1] else None
+        if paired > 0:
+            self.append(times[:, 0:paired:2] + times[:, 1:paired:2], width, level + 1)
+
+    def finish(self, width: int):
+        """ Writes the last buckets left unpaired, as if their pair was empty """
+        for level in range(len(self.level_buckets) - 1):
+            if self._unpaired[level] is not None:
+                unpaired, self._unpaired[level] = self._unpaired[level], None
+                self.append(unpaired, width, level + 1)
+
+
+def build_timeline(
+    store: pd.HDFStore,
+    key: str = "States",
+    filters: Optional[tables.Filters] = None,
+    offsets: Optional[np.ndarray] = None,
+):
+    """ Stores in TIMELINE the level of detail pyramid of the timelines of the threads of the table `key`. Level 0
+    has at most TIMELINE_BUCKETS buckets of a power of two ns, each level above merges pairs of buckets of the
+    previous one up to a single bucket. For each thread and bucket, the pyramid stores the fraction of the bucket
+    spent in each state and the dominant state.
+    A first pass of TIMELINE_ROWS rows finds the threads, states and end time. Then the table, sorted by time_ini,
+    is read once more while the buckets of all the threads are built in blocks that fit in TIMELINE_BYTES (see
+    _time_blocks), each one written to every level before the next one. Tables partitioned by thread, the rows of
+    the i-th thread being `offsets[i]:offsets[i + 1]`, are built in groups of threads that fit in it instead, each
+    one reading just the rows of its threads
+    """
+    handle = store._handle
+    if TIMELINE in handle:
+        handle.remove_node(TIMELINE, recursive=True)
+    nrows = store.get_storer(key).nrows
+    keys, states, end = np.empty(0, dtype="int64"), np.empty(0, dtype="int64"), 0
+    for start in range(0, nrows, TIMELINE_ROWS):
+        chunk_keys, chunk_states, _, time_fi = _state_columns(store, key, start, start + TIMELINE_ROWS)
+        keys = np.union1d(keys, chunk_keys)
+        states = np.union1d(states, chunk_states)
+        end = max(end, int(time_fi.max()))
+    width = 2 ** max(0, math.ceil(math.log2(max(end, 1) / TIMELINE_BUCKETS)))
+    buckets = max(1, math.ceil(end / width))
+    level_buckets = _level_buckets(buckets)
+
+    group = handle.create_group("/RECORDS", TIMELINE.rsplit("/", 1)[1])
+    handle.create_array(group, "threads", obj=split_thread_keys(keys))
+    handle.create_array(group, "states", obj=states)
+    pyramid = _Pyramid(handle, group, keys.size, states, level_buckets, filters)
+    # Bucket times and their difference arrays, float64
+    bucket_bytes = 2 * 8 * max(1, states.size)
+    if offsets is not None:
+        group_threads = max(1, TIMELINE_BYTES // (bucket_bytes * (buckets + 1)))
+        for first_thread in range(0, keys.size, group_threads):
+            threads = slice(first_thread, min(first_thread + group_threads, keys.size))
+            rows = (int(offsets[threads.start]), int(offsets[threads.stop]))
+            times = _thread_times(store, key, rows, keys, states, threads, width, buckets)
+            pyramid.write_threads(threads, times, width)
+        logger.debug(f"Built the timeline of {keys.size} threads, {group_threads} at a time")
+    else:
+        block = max(1, TIMELINE_BYTES // (bucket_bytes * max(1, keys.size)))
+        for _, times in _time_blocks(store, key, nrows, keys, states, width, buckets, block):
+            pyramid.append(times, width)
+        pyramid.finish(width)
+        logger.debug(f"Built the timeline of {keys.size} threads, {block} buckets at a time")
+    group._v_attrs.bucket_width = width
+    group._v_attrs.levels = len(level_buckets)
+    group._v_attrs.end = end
+    logger.debug(f"Built {len(level_buckets)} timeline levels from {buckets} buckets of {width} ns")
+
+
+def read_timeline(file: str, start: int = None, end: int = None, pixels: int = 1000) -> Optional[Timeline]:
+    """ The coarsest level of the pyramid with at least `pixels` buckets in [start, end) (the finest one if none
+    has), only the buckets that overlap the window. None if the file has no pyramid
+    """
+    with tables.open_file(file, mode="r") as f:
+        if TIMELINE not in f:
+            return None
+        group = f.get_node(TIMELINE)
+        width, levels = int(group._v_attrs.bucket_width), int(group._v_attrs.levels)
+        start = 0 if start is None else max(0, start)
+        end = int(group._v_attrs.end) if end is None else end
+        desired = max(1, (end - start) / max(1, pixels))
+        level = min(levels - 1, max(0, math.floor(math.log2(desired / width)))) if desired > width else 0
+        level_width = width * 2 ** level
+        first = start // level_width
+        last = max(first, math.ceil(end / level_width))
+        return Timeline(
+            group.threads.read(),
+            group.states.read(),
+            level,
+            first * level_width,
+            level_width,
+            group._f_get_child(f"dominant_{level}")[:, first:last],
+            group._f_get_child(f"fractions_{level}")[:, first:last, :],
+        )
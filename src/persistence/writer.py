@@ -1,23 +1,294 @@
 import logging
+import os
+from typing import Dict, Iterable, Tuple
 
 import dask.dataframe as dd
+import numpy as np
 import pandas as pd
+import tables
+
+from src.CONST import CommRecord, EventRecord, StateRecord
+from src.core.intervals import INTERVALS, iter_intervals
+from src.core.profile import split_thread_keys, thread_keys
+from src.persistence.event_index import build_event_index
+from src.persistence.instrumentation import span
+from src.persistence.schema import compact_dataframe, records_to_dataframe, widen_dtypes
+from src.persistence.timeline import build_timeline
 
 logging.basicConfig(format="%(levelname)s :: %(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+TABLES = (("States", StateRecord), ("Events", EventRecord), ("Comm", CommRecord))
+RECORDS = dict(TABLES)
+# Rows copied at once when a table has to be rewritten with wider dtypes
+REWRITE_ROWS = 1000000
+
+# Storage layout of the record tables, stored in the RECORDS group attrs. Version 1: tables sorted by
+# time, compressed, every column is a data column and the time and event type columns are indexed.
+# Version 2: plus the inverted index of the event types (see event_index.build_event_index).
+# Version 3: plus the level of detail pyramid of the timelines of the threads (see timeline.build_timeline).
+# Version 4: plus the Intervals table of the paired entry and exit events (see core.intervals)
+LAYOUT_VERSION = 4
+SORT_COLUMNS = {"States": "time_ini", "Events": "time", "Comm": "lsend", INTERVALS: "time_ini"}
+INDEX_COLUMNS = {"States": ["time_ini"], "Events": ["time", "event_t"], "Comm": ["lsend"], INTERVALS: ["time_ini"]}
+COMPLIB = "blosc"
+COMPLEVEL = 5
+TABLE_OPTIONS = dict(format="table", data_columns=True, complib=COMPLIB, complevel=COMPLEVEL)
+# Rows of each chunk whose min/max time is stored in RECORDS/<table>_chunks
+CHUNK_ROWS = 65536
+# Rows of the Events table read at once while pairing its events into intervals
+INTERVAL_ROWS = 1000000
+# Write the tables partitioned by thread instead of sorted by time (see Writer._partition_table)
+PARTITION_THREADS = bool(int(os.environ.get("PARTITION_THREADS", 0)))
+# Columns of the thread of the rows of each table, the ones it's partitioned by
+THREAD_COLUMNS = {
+    "States": ("appl_id", "task_id", "thread_id"),
+    "Events": ("appl_id", "task_id", "thread_id"),
+    "Comm": ("ptask_send_id", "task_send_id", "thread_send_id"),
+    INTERVALS: ("appl_id", "task_id", "thread_id"),
+}
+
+
+def partitions_node(key: str) -> str:
+    """ Group of the threads and offsets of the partitions of the table `key` """
+    return f"/RECORDS/{key}_threads"
+
 
 class Writer:
-    def _write_if_rows(self, df, *args, **kwargs):
+    def __init__(self, partition_threads: bool = PARTITION_THREADS):
+        self.partition_threads = partition_threads
+
+    def _rewrite_table(self, store: pd.HDFStore, key: str, dtypes):
+        logger.warning(f"Rewriting table {key} with wider dtypes: {dtypes}")
+        tmp_key = f"{key}_widened"
+        for chunk in store.select(key, chunksize=REWRITE_ROWS):
+            store.append(tmp_key, chunk.astype(dtypes), index=False, **TABLE_OPTIONS)
+        store.remove(key)
+        store._handle.rename_node(f"/{tmp_key}", key)
+
+    def _append(self, store: pd.HDFStore, key: str, df: pd.DataFrame):
+        """ Appends `df` to the table `key` with the storage dtypes of its record. If some values don't fit in
+        the dtypes of the rows already written, the table is rewritten with wider dtypes first
+        """
+        with span("append") as appended:
+            if key in RECORDS:
+                df = compact_dataframe(df, RECORDS[key])
+            if key in store:
+                table_dtypes = store.select(key, stop=0).dtypes.to_dict()
+                dtypes = widen_dtypes(table_dtypes, df.dtypes.to_dict())
+                if dtypes != table_dtypes:
+                    self._rewrite_table(store, key, dtypes)
+                df = df.astype(dtypes)
+            store.append(key, df, index=False, **TABLE_OPTIONS)
+            appended.add(bytes=df.memory_usage(index=True).sum(), records=df.shape[0])
+
+    def _is_sorted(self, store: pd.HDFStore, key: str, column: str) -> bool:
+        last = None
+        nrows = store.get_storer(key).nrows
+        for start in range(0, nrows, REWRITE_ROWS):
+            values = store.select_column(key, column, start=start, stop=start + REWRITE_ROWS).to_numpy()
+            if np.any(values[1:] < values[:-1]) or (last is not None and values[0] < last):
+                return False
+            last = values[-1]
+        return True
+
+    def _max_duration(self, store: pd.HDFStore, key: str) -> int:
+        """ Duration of the longest interval (time_fi - time_ini) of the table `key` """
+        longest = 0
+        nrows = store.get_storer(key).nrows
+        for start in range(0, nrows, REWRITE_ROWS):
+            time_ini = store.select_column(key, "time_ini", start=start, stop=start + REWRITE_ROWS).to_numpy()
+            time_fi = store.select_column(key, "time_fi", start=start, stop=start + REWRITE_ROWS).to_numpy()
+            longest = max(longest, int((time_fi - time_ini).max(initial=0)))
+        return longest
+
+    def _sort_table(self, store: pd.HDFStore, key: str, column: str):
+        """ Sorts the table out of core with a completely sorted (CSI) index of `column` and renumbers its
+        row index
+        """
+        logger.warning(f"Table {key} is not sorted by {column}. Sorting it...")
+        table = store.get_storer(key).table
+        table.colinstances[column].create_csindex()
+        sorted_table = table.copy(newname="sorted_table", sortby=column, checkCSI=True, propindexes=False)
+        table.remove()
+        sorted_table.move(newname="table")
+        for start in range(0, sorted_table.nrows, REWRITE_ROWS):
+            stop = min(start + REWRITE_ROWS, sorted_table.nrows)
+            sorted_table.modify_column(start, stop, column=np.arange(start, stop), colname="index")
+
+    def _chunk_bounds(self, store: pd.HDFStore, key: str, column: str) -> np.ndarray:
+        """ Min and max value of `column` (the sort column) for every CHUNK_ROWS rows """
+        nrows = store.get_storer(key).nrows
+        starts = np.arange(0, nrows, CHUNK_ROWS)
+        stops = np.minimum(starts + CHUNK_ROWS, nrows) - 1
+        table = store.get_storer(key).table
+        return np.stack((table.read_coordinates(starts, field=column), table.read_coordinates(stops, field=column)), 1)
+
+    def _partition_table(self, store: pd.HDFStore, key: str):
+        """ Reorders the table, already sorted by time, by thread: the rows of each thread become a contiguous slice,
+        still sorted by time. The sorted thread `threads` (appl, task, thread) and the `offsets` of their slices, the
+        rows of threads[i] being offsets[i]:offsets[i + 1], are stored in partitions_node(key).
+        A counting sort in two passes of REWRITE_ROWS rows: the first counts the rows of each thread, the second
+        copies the rows of each chunk to the slice of their thread and renumbers their row index
+        """
+        table = store.get_storer(key).table
+        nrows = table.nrows
+
+        counts = pd.Series(dtype="int64")
+        for start in range(0, nrows, REWRITE_ROWS):
+            columns = (table.read(start, start + REWRITE_ROWS, field=column) for column in THREAD_COLUMNS[key])
+            counts = counts.add(pd.Series(thread_keys(*columns)).value_counts(), fill_value=0)
+        counts = counts.sort_index()
+        threads = counts.index.to_numpy(dtype="int64")
+        offsets = np.concatenate(([0], np.cumsum(counts.to_numpy(dtype="int64"))))
+
+        partitioned = table.copy(newname="partitioned_table", propindexes=False)
+        cursor = offsets[:-1].copy()
+        for start in range(0, nrows, REWRITE_ROWS):
+            rows = table.read(start, start + REWRITE_ROWS)
+            thread_idx = np.searchsorted(threads, thread_keys(*(rows[column] for column in THREAD_COLUMNS[key])))
+            order = np.argsort(thread_idx, kind="stable")
+            rows, thread_idx = rows[order], thread_idx[order]
+            chunk_threads, first = np.unique(thread_idx, return_index=True)
+            last = np.append(first[1:], thread_idx.size)
+            for i, thread in enumerate(chunk_threads):
+                n = last[i] - first[i]
+                block = rows[first[i]: last[i]]
+                block["index"] = np.arange(cursor[thread], cursor[thread] + n)
+                partitioned.modify_rows(cursor[thread], cursor[thread] + n, rows=block)
+                cursor[thread] += n
+        table.remove()
+        partitioned.move(newname="table")
+
+        handle = store._handle
+        group = handle.create_group("/RECORDS", partitions_node(key).rsplit("/", 1)[1])
+        handle.create_array(group, "threads", obj=split_thread_keys(threads))
+        handle.create_array(group, "offsets", obj=offsets)
+        logger.debug(f"Partitioned {key} in {threads.size} threads")
+
+    def _finalize_table(self, store: pd.HDFStore, key: str):
+        """ Leaves the table in the layout LAYOUT_VERSION: sorted by its time column, with its chunk bounds
+        and column indexes. With partition_threads, partitioned by thread instead (see _partition_table)
+        """
+        if key not in store:
+            return
+        with span("finalize") as finalized:
+            finalized.add(records=store.get_storer(key).nrows)
+            sort_column = SORT_COLUMNS[key]
+            if not self._is_sorted(store, key, sort_column):
+                with span("sort"):
+                    self._sort_table(store, key, sort_column)
+            handle = store._handle
+            if "/RECORDS" not in handle:
+                handle.create_group("/", "RECORDS")
+            for node in (f"/RECORDS/{key}_chunks", partitions_node(key)):
+                if node in handle:
+                    handle.remove_node(node, recursive=True)
+            if self.partition_threads:
+                with span("partition"):
+                    self._partition_table(store, key)
+            with span("index"):
+                store.create_table_index(key, columns=INDEX_COLUMNS[key], optlevel=6, kind="medium")
+                if not self.partition_threads:
+                    handle.create_array("/RECORDS", f"{key}_chunks", obj=self._chunk_bounds(store, key, sort_column))
+            records = handle.get_node("/RECORDS")
+            records._v_attrs.layout_version = LAYOUT_VERSION
+            records._v_attrs.chunk_rows = CHUNK_ROWS
+            records._v_attrs.partitioned = self.partition_threads
+            # Partitioned tables are only sorted by time within each thread
+            if self.partition_threads:
+                records._v_attrs[f"{key}_partitioned_by"] = "thread"
+                stale = f"{key}_sorted_by"
+            else:
+                records._v_attrs[f"{key}_sorted_by"] = sort_column
+                stale = f"{key}_partitioned_by"
+            if stale in records._v_attrs:
+                del records._v_attrs[stale]
+            if "time_fi" in store.get_storer(key).table.colnames:
+                # Bounds the rows searched for the states that overlap a time window (see time_window.state_window)
+                records._v_attrs[f"{key}_max_duration"] = self._max_duration(store, key)
+            filters = tables.Filters(complevel=COMPLEVEL, complib=COMPLIB)
+            if key == "Events":
+                with span("event_index"):
+                    build_event_index(store, key, filters=filters)
+                with span("intervals"):
+                    self._write_intervals(store, key)
+            elif key == "States":
+                with span("timeline"):
+                    # Partitioned tables are built a group of threads at a time, reading just their rows
+                    offsets = None
+                    if self.partition_threads:
+                        offsets = handle.get_node(partitions_node(key), "offsets").read()
+                    build_timeline(store, key, filters=filters, offsets=offsets)
+
+    def _write_intervals(self, store: pd.HDFStore, key: str):
+        """ Writes the INTERVALS table of the entry and exit events of the table `key`, read INTERVAL_ROWS rows at a
+        time, and leaves it sorted and indexed like the record tables
+        """
+        self._remove(store, INTERVALS)
+        nrows = store.get_storer(key).nrows
+
+        def read_chunks():
+            for start in range(0, nrows, INTERVAL_ROWS):
+                yield store.select(key, start=start, stop=start + INTERVAL_ROWS)
+
+        for intervals in iter_intervals(read_chunks):
+            if intervals.shape[0] > 0:
+                self._append(store, INTERVALS, intervals)
+        self._finalize_table(store, INTERVALS)
+
+    def _remove(self, store: pd.HDFStore, key: str):
+        """ Removes the table `key`, and the tables derived from it """
+        for table in (key, INTERVALS) if key == "Events" else (key,):
+            if table in store:
+                store.remove(table)
+
+    def _write_if_rows(self, df, file: str, key: str):
         if isinstance(df, dd.DataFrame):
-            df = df.compute()
+            # Write partition by partition instead of computing the whole DataFrame first
+            self._write_partitions_if_rows(df, file, key)
+            return
         if df.shape[0] > 0:
-            df.to_hdf(index=False, *args, **kwargs)
+            with pd.HDFStore(file, mode="a") as store:
+                self._remove(store, key)
+                self._append(store, key, df)
+                self._finalize_table(store, key)
+
+    def _write_partitions_if_rows(self, df: dd.DataFrame, file: str, key: str):
+        with pd.HDFStore(file, mode="a") as store:
+            self._remove(store, key)
+            for partition in df.partitions:
+                partition = partition.compute()
+                if partition.shape[0] > 0:
+                    self._append(store, key, partition)
+            self._finalize_table(store, key)
 
     def dataframe_to_hdf5(self, file: str, df_state, df_event, df_comm):
-        self._write_if_rows(df_state, file, key="States", format="table")
-        self._write_if_rows(df_event, file, key="Events", format="table")
-        self._write_if_rows(df_comm, file, key="Comm", format="table")
+        with span("dataframe_to_hdf5"):
+            self._write_if_rows(df_state, file, key="States")
+            self._write_if_rows(df_event, file, key="Events")
+            self._write_if_rows(df_comm, file, key="Comm")
+
+    def records_to_hdf5(self, file: str, records: Iterable[Tuple[np.ndarray, np.ndarray, np.ndarray]]) -> Dict:
+        """ Streaming version of dataframe_to_hdf5. Appends each (State, Event, Comm) chunk of 2D arrays
+        yielded by `records` (see ParaverToHDF5.iter_records) to the tables and drops it, so the memory used
+        is bounded by the chunk size. Returns the number of rows written to each table
+        """
+        rows = {key: 0 for key, _ in TABLES}
+        with span("records_to_hdf5"), pd.HDFStore(file, mode="a") as store:
+            for key, _ in TABLES:
+                self._remove(store, key)
+            for chunk in records:
+                for (key, record), arr in zip(TABLES, chunk):
+                    if arr.shape[0] == 0:
+                        continue
+                    df = records_to_dataframe(arr, record, index=pd.RangeIndex(rows[key], rows[key] + arr.shape[0]))
+                    self._append(store, key, df)
+                    rows[key] += arr.shape[0]
+            for key, _ in TABLES:
+                self._finalize_table(store, key)
+        logger.debug(f"Rows written to {file}: {rows}")
+        return rows
 
     def dataframe_to_excel(self, file: str, df_state, df_event, df_comm):
         writer = pd.ExcelWriter(file)